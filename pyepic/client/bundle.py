@@ -0,0 +1,268 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import json
+import tarfile
+import threading
+import uuid
+
+from botocore.exceptions import ClientError
+
+from .sync import RemoteFile, merge_sorted
+from .transfer import replace_on_success
+
+BUNDLE_FOLDER = ".pyepic-bundles/"
+MANIFEST_NAME = "manifest.json"
+
+
+def is_bundle_path(rel_path):
+    """Is rel_path inside the bundle folder of a synced prefix?"""
+    return rel_path.startswith(BUNDLE_FOLDER)
+
+
+def new_bundle_name():
+    """Generate a unique name for a new bundle"""
+    return "{}.tar".format(uuid.uuid4().hex)
+
+
+class BundleManifest(object):
+    """Index of the small files packed into tar bundles below an S3 prefix.
+    The manifest is stored as JSON in the bundle folder of the prefix.
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: Bucket containing the prefix
+    :type bucket_name: str
+    :param s3_prefix: Prefix of the synced folder
+    :type s3_prefix: str
+    """
+
+    def __init__(self, s3_client, bucket_name, s3_prefix):
+        """Constructor method"""
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self.s3_prefix = s3_prefix
+        self.files = {}
+        self.changed = False
+        self.listed_bundles = set()
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """S3 key of the manifest"""
+        return self.s3_prefix + BUNDLE_FOLDER + MANIFEST_NAME
+
+    def bundle_key(self, bundle_name):
+        """S3 key of a bundle"""
+        return self.s3_prefix + BUNDLE_FOLDER + bundle_name
+
+    def load(self):
+        """Fetch the manifest, leaving it empty if the prefix has no bundles"""
+        try:
+            response = self._s3_client.get_object(
+                Bucket=self._bucket_name, Key=self.key
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return self
+            raise e
+        self.files = json.loads(response["Body"].read().decode("utf-8"))["files"]
+        return self
+
+    def save(self, meta_data={}):
+        """Write the manifest back to S3"""
+        body = json.dumps({"version": 1, "files": self.files}).encode("utf-8")
+        self._s3_client.put_object(
+            Bucket=self._bucket_name, Key=self.key, Body=body, Metadata=meta_data
+        )
+
+    def record(self, rel_path, bundle_name, size, mtime, uploaded):
+        """Record that rel_path is stored in bundle_name, uploaded is the LastModified time of the bundle object"""
+        with self._lock:
+            self.files[rel_path] = {
+                "bundle": bundle_name,
+                "size": size,
+                "mtime": mtime,
+                "uploaded": uploaded,
+            }
+            self.changed = True
+
+    def discard(self, rel_path):
+        """Remove rel_path from the manifest if present"""
+        with self._lock:
+            if self.files.pop(rel_path, None) is not None:
+                self.changed = True
+
+    def remote_file(self, rel_path):
+        """
+        Describe a bundled file in the same way as a listed S3 object.
+        The ETag is the name of the bundle and the last modified time is the LastModified time of the bundle object.
+            :return: Entry for the file
+            :rtype: :class:`pyepic.client.sync.RemoteFile`
+        """
+        entry = self.files[rel_path]
+        return RemoteFile(
+            self.s3_prefix + rel_path,
+            entry["size"],
+            '"{}"'.format(entry["bundle"]),
+            entry["uploaded"],
+        )
+
+    def merge(self, remote, sync_filter=None):
+        """
+        Merge the bundled files into a stream of remote objects, replacing any object that is older than its bundle.
+        The objects in the bundle folder are dropped from the stream and the bundles found are recorded for unused_bundles.
+            :param remote: Objects from iter_remote, sorted by path
+            :type remote: iterable
+            :param sync_filter: Rules for the bundled files to include
+            :type sync_filter: :class:`pyepic.client.sync.SyncFilter`, optional
+
+            :return: Iterable of (relative path, RemoteFile) sorted by path
+            :rtype: collections.Iterable[tuple]
+        """
+        with self._lock:
+            bundled = sorted(self.files)
+        for rel_path, (existing, _) in merge_sorted(remote, ((p, p) for p in bundled)):
+            if is_bundle_path(rel_path):
+                name = rel_path[len(BUNDLE_FOLDER) :]
+                if existing is not None and name != MANIFEST_NAME:
+                    self.listed_bundles.add(name)
+                continue
+            entry = self.files.get(rel_path)
+            if (
+                entry is not None
+                and (existing is None or entry["uploaded"] > existing.last_modified)
+                and (sync_filter is None or sync_filter.match(rel_path, True))
+            ):
+                yield rel_path, self.remote_file(rel_path)
+            elif existing is not None:
+                yield rel_path, existing
+
+    def is_bundled(self, rel_path, remote_file):
+        """Is remote_file, yielded by merge, a file stored in a bundle?"""
+        entry = self.files.get(rel_path)
+        return entry is not None and remote_file.etag == '"{}"'.format(entry["bundle"])
+
+    def bundle_ends(self):
+        """
+        The last path in each bundle, used to tell when every file of a bundle has been planned
+            :return: Dictionary of bundle name to the greatest relative path in the bundle
+            :rtype: dict
+        """
+        ends = {}
+        with self._lock:
+            for rel_path, entry in self.files.items():
+                name = entry["bundle"]
+                if name not in ends or rel_path > ends[name]:
+                    ends[name] = rel_path
+        return ends
+
+    def unused_bundles(self):
+        """
+        Bundles found by merge that no longer hold any file in the manifest
+            :return: List of bundle names
+            :rtype: list
+        """
+        with self._lock:
+            used = set(entry["bundle"] for entry in self.files.values())
+        return sorted(self.listed_bundles - used)
+
+
+class TarStream(io.RawIOBase):
+    """Readable stream of a tar archive generated as it is read.
+    Members are added to the archive only when the reader needs more data,
+    so at most one member is held in memory at a time.
+
+    :param members: Iterable of (archive name, local path)
+    :type members: iterable
+    """
+
+    def __init__(self, members):
+        """Constructor method"""
+        super().__init__()
+        self._members = iter(members)
+        self._buffer = bytearray()
+        self._tar = tarfile.open(fileobj=self, mode="w|", format=tarfile.PAX_FORMAT)
+        self._finished = False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        # Only used by tarfile to append to the buffer
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b) and not self._finished:
+            member = next(self._members, None)
+            if member is None:
+                self._tar.close()
+                self._finished = True
+            else:
+                arcname, path = member
+                self._tar.add(path, arcname=arcname, recursive=False)
+        count = min(len(b), len(self._buffer))
+        b[:count] = self._buffer[:count]
+        del self._buffer[:count]
+        return count
+
+
+def extract_bundle(body, targets):
+    """
+    Extract members of a streamed tar bundle. Each member is written to a temporary file that
+    replaces its target once complete, so a failed extraction leaves the existing file untouched
+    and a target that is a hard link is replaced rather than written through.
+        :param body: Readable stream of the bundle
+        :param targets: Dictionary of member name to local path for the members to extract, the folders of the paths must exist
+        :type targets: dict
+
+        :return: Iterable of the member names extracted
+        :rtype: collections.Iterable[str]
+    """
+    with tarfile.open(fileobj=body, mode="r|") as tar:
+        for member in tar:
+            path = targets.get(member.name)
+            if path is None or not member.isfile():
+                continue
+            with tar.extractfile(member) as source, replace_on_success(
+                path
+            ) as tmp_path, open(tmp_path, "wb") as target:
+                while True:
+                    chunk = source.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    target.write(chunk)
+            yield member.name
@@ -0,0 +1,316 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
+
+# Linux ioctl that makes one file share the data of another (a reflink)
+FICLONE = 0x40049409
+
+_CACHEABLE_ETAG = re.compile(r"[0-9a-f]+(-[0-9]+)?\Z")
+
+
+class ListingCache(object):
+    """In-process cache of folder listings, keyed by S3 prefix.
+    Entries expire after ttl seconds and the least recently used entry is evicted
+    once more than max_entries prefixes are cached.
+
+    :param ttl: Seconds a listing stays valid
+    :type ttl: float, optional
+    :param max_entries: Maximum number of prefixes cached
+    :type max_entries: int, optional
+    """
+
+    def __init__(self, ttl=60, max_entries=128):
+        """Constructor method"""
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, s3_prefix):
+        """
+        Fetch a listing
+            :param s3_prefix: Prefix that was listed
+            :type s3_prefix: str
+
+            :return: The cached listing, or None if it is not cached or has expired
+            :rtype: list
+        """
+        with self._lock:
+            entry = self._entries.get(s3_prefix)
+            if entry is None:
+                return None
+            expires, listing = entry
+            if time.monotonic() >= expires:
+                del self._entries[s3_prefix]
+                return None
+            self._entries.move_to_end(s3_prefix)
+            return listing
+
+    def put(self, s3_prefix, listing):
+        """Cache the listing of s3_prefix"""
+        with self._lock:
+            self._entries[s3_prefix] = (time.monotonic() + self.ttl, listing)
+            self._entries.move_to_end(s3_prefix)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, s3_path):
+        """
+        Drop every listing affected by a change to s3_path.
+        That is the listings of its parent folders and, if s3_path is a folder, of the folders inside it.
+            :param s3_path: Key or prefix that has changed
+            :type s3_path: str
+        """
+        with self._lock:
+            for s3_prefix in [
+                p
+                for p in self._entries
+                if s3_path.startswith(p) or p.startswith(s3_path)
+            ]:
+                del self._entries[s3_prefix]
+
+    def clear(self):
+        """Drop every cached listing"""
+        with self._lock:
+            self._entries.clear()
+
+
+def clone_file(source, target, hardlink=False):
+    """
+    Create target with the contents of source as cheaply as the file system allows.
+    A reflink (copy on write clone) is tried first, then a hard link if requested and finally a copy.
+        :param source: Path of the existing file
+        :type source: str
+        :param target: Path of the file to create, which must not exist
+        :type target: str
+        :param hardlink: Try a hard link if reflinks are not supported. The two paths then share one file, so writing to either changes both.
+        :type hardlink: bool, optional
+
+        :return: How the file was created, "reflink", "hardlink" or "copy"
+        :rtype: str
+    """
+    if fcntl is not None:
+        try:
+            with open(source, "rb") as src, open(target, "xb") as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return "reflink"
+        except OSError:
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+    if hardlink:
+        try:
+            os.link(source, target)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(source, target)
+    return "copy"
+
+
+class DownloadCache(object):
+    """Content addressed cache of downloaded files that can be shared by several local folders and processes.
+    Files are keyed by the ETag and size of their object, so an object downloaded into many case folders is only fetched once.
+    The least recently used files are evicted once the cache holds more than max_size bytes.
+
+    Cached files are placed with a reflink where the file system supports them and are copied otherwise,
+    so every downloaded file is independent of the cache. Hard links avoid the copy but share one file between the cache
+    and every folder holding the object, so an in-place edit of any of them changes all of them. Only enable hardlink for
+    trees that are never modified in place.
+
+    :param path: Folder to keep the cache in
+    :type path: str
+    :param max_size: Maximum number of bytes to cache, None for no limit
+    :type max_size: int, optional
+    :param hardlink: Place cached files with hard links instead of copies when reflinks are not supported
+    :type hardlink: bool, optional
+    """
+
+    DB_NAME = "cache.db"
+
+    def __init__(self, path, max_size=None, hardlink=False):
+        """Constructor method"""
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        self.hardlink = hardlink
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(self.path, self.DB_NAME), timeout=60, check_same_thread=False
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "name TEXT PRIMARY KEY, size INTEGER, last_used REAL)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _name(etag, size):
+        # Objects without an MD5 based ETag, such as bundled files, are not cached
+        etag = etag.strip('"').lower()
+        if not _CACHEABLE_ETAG.match(etag):
+            return None
+        return "{}-{}".format(etag, size)
+
+    def _file(self, name):
+        return os.path.join(self.path, "objects", name[:2], name)
+
+    def fetch(self, etag, size, target):
+        """
+        Place the cached copy of an object at target, replacing any existing file
+            :param etag: ETag of the object
+            :type etag: str
+            :param size: Size of the object in bytes
+            :type size: int
+            :param target: Local path to place the file at
+            :type target: str
+
+            :return: True if the object was cached
+            :rtype: bool
+        """
+        name = self._name(etag, size)
+        if name is None:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM entries WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return False
+        path = self._file(name)
+        try:
+            if os.path.getsize(path) != row[0]:
+                raise OSError("Cached file has changed")
+            if os.path.lexists(target):
+                os.remove(target)
+            clone_file(path, target, self.hardlink)
+        except OSError:
+            # Evicted by another process or modified through a hard link
+            with self._lock:
+                self._conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+                self._conn.commit()
+            return False
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET last_used = ? WHERE name = ?", (time.time(), name)
+            )
+            self._conn.commit()
+        return True
+
+    def store(self, etag, size, source):
+        """
+        Add a downloaded file to the cache, evicting the least recently used files if the cache is full
+            :param etag: ETag of the object
+            :type etag: str
+            :param size: Size of the object in bytes
+            :type size: int
+            :param source: Local path of the downloaded file
+            :type source: str
+        """
+        name = self._name(etag, size)
+        if name is None:
+            return
+        file_size = os.path.getsize(source)
+        if self.max_size is not None and file_size > self.max_size:
+            return
+        path = self._file(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Other processes only ever see a complete file
+        temp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        clone_file(source, temp_path, self.hardlink)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+                (name, file_size, time.time()),
+            )
+            self._conn.commit()
+        self._evict()
+
+    def _evict(self):
+        if self.max_size is None:
+            return
+        with self._lock:
+            total = self._conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+            if not total or total <= self.max_size:
+                return
+            rows = self._conn.execute(
+                "SELECT name, size FROM entries ORDER BY last_used"
+            ).fetchall()
+            for name, size in rows:
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(self._file(name))
+                except FileNotFoundError:
+                    pass
+                self._conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+                total -= size
+            self._conn.commit()
+
+    @property
+    def size(self):
+        """Number of bytes cached"""
+        with self._lock:
+            total = self._conn.execute("SELECT SUM(size) FROM entries").fetchone()[0]
+        return total or 0
+
+    def clear(self):
+        """Remove every cached file"""
+        with self._lock:
+            for (name,) in self._conn.execute("SELECT name FROM entries").fetchall():
+                try:
+                    os.remove(self._file(name))
+                except FileNotFoundError:
+                    pass
+            self._conn.execute("DELETE FROM entries")
+            self._conn.commit()
+
+    def close(self):
+        """Close the cache index"""
+        with self._lock:
+            self._conn.close()
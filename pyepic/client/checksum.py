@@ -0,0 +1,210 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import deque, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor
+import hashlib
+import mmap
+import os
+
+from .transfer import MB, MIN_PART_SIZE
+
+# Files smaller than this are read rather than mapped
+MMAP_THRESHOLD = 4 * MB
+
+FileHash = namedtuple("FileHash", ["md5", "etag"])
+FileHash.__doc__ = """Hashes of the contents of a local file
+
+:param md5: Hex MD5 digest of the whole file
+:param etag: ETag S3 gives the file when it is uploaded with the chunksize the hash was computed for
+"""
+
+
+def hash_chunksize(etag, size, chunksize):
+    """
+    Work out the part size an object was uploaded with from its ETag.
+    A multipart ETag ends in the number of parts, the part size is taken to be chunksize if that
+    gives the same number of parts, otherwise the smallest whole number of MB that does.
+        :param etag: ETag of the object
+        :type etag: str
+        :param size: Size of the object in bytes
+        :type size: int
+        :param chunksize: Part size the object is most likely to have been uploaded with
+        :type chunksize: int
+
+        :return: 0 for an object uploaded in one request, the part size, or None if the ETag can not be matched
+        :rtype: int
+    """
+    etag = etag.strip('"')
+    if "-" not in etag:
+        return 0
+    try:
+        parts = int(etag.rsplit("-", 1)[1])
+    except ValueError:
+        return None
+    if parts < 1:
+        return None
+    if -(-size // chunksize) == parts:
+        return chunksize
+    part_size = -(-size // parts)
+    guess = max(-(-part_size // MB) * MB, MIN_PART_SIZE)
+    if -(-size // guess) == parts:
+        return guess
+    return None
+
+
+def file_hash(path, chunksize=0):
+    """
+    Hash a file, mapping large files into memory rather than reading them.
+        :param path: Local path of the file
+        :type path: str
+        :param chunksize: Part size to compute the multipart ETag with, 0 for the ETag of a single part upload
+        :type chunksize: int, optional
+
+        :return: Hashes of the file
+        :rtype: :class:`FileHash`
+    """
+    md5 = hashlib.md5()
+    parts = []
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        step = chunksize if chunksize else 8 * MB
+        if size < MMAP_THRESHOLD:
+            data = memoryview(f.read())
+            mm = None
+        else:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(mm)
+        try:
+            for start in range(0, max(size, 1), step):
+                with data[start : start + step] as chunk:
+                    md5.update(chunk)
+                    if chunksize:
+                        parts.append(hashlib.md5(chunk).digest())
+        finally:
+            data.release()
+            if mm is not None:
+                mm.close()
+    if not chunksize:
+        return FileHash(md5.hexdigest(), '"{}"'.format(md5.hexdigest()))
+    etag = hashlib.md5(b"".join(parts)).hexdigest()
+    return FileHash(md5.hexdigest(), '"{}-{}"'.format(etag, len(parts)))
+
+
+class Hasher(object):
+    """Hashes local files in a pool of processes for checksum syncs.
+    Hashes are cached in a :class:`pyepic.client.sync_state.SyncIndex` against the size and modification time of each file,
+    so a file is only hashed again once it changes.
+
+    The processes are started by start(), before the sync starts any threads of its own.
+
+    :param index: Index to cache the hashes in
+    :type index: :class:`pyepic.client.sync_state.SyncIndex`, optional
+    :param processes: Number of processes, defaults to the number of CPUs
+    :type processes: int, optional
+    """
+
+    def __init__(self, index=None, processes=None):
+        """Constructor method"""
+        self._index = index
+        self._processes = processes if processes else (os.cpu_count() or 1)
+        self._executor = None
+
+    def start(self):
+        """Start the hashing processes"""
+        self._executor = ProcessPoolExecutor(self._processes)
+        # Start the processes now rather than on the first hash
+        self._executor.submit(int).result()
+        return self
+
+    def close(self):
+        """Stop the hashing processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _hash(self, rel_path, local_file, chunksize):
+        if self._index is not None:
+            cached = self._index.file_hash(
+                rel_path, local_file.size, local_file.mtime, chunksize
+            )
+            if cached is not None:
+                return cached
+        return self._executor.submit(file_hash, local_file.path, chunksize)
+
+    def _result(self, request, result):
+        if not isinstance(result, Future):
+            return result
+        result = result.result()
+        if self._index is not None:
+            rel_path, local_file, chunksize = request
+            self._index.record_hash(
+                rel_path, local_file.size, local_file.mtime, chunksize, result
+            )
+        return result
+
+    def map(self, items, request):
+        """
+        Hash the files needed by a stream of items, keeping the items in order.
+        Only a few items per process are held back waiting for their hashes.
+            :param items: Items to pass through
+            :type items: iterable
+            :param request: Callable that returns (relative path, LocalFile, chunksize) for an item that needs a hash, or None
+            :type request: method
+
+            :return: Iterable of (item, FileHash or None)
+            :rtype: collections.Iterable[tuple]
+        """
+        window = self._processes * 4
+        pending = deque()
+        for item in items:
+            hash_request = request(item)
+            result = None
+            if hash_request is not None:
+                result = self._hash(*hash_request)
+            pending.append((item, hash_request, result))
+            while pending and (
+                len(pending) > window
+                or not isinstance(pending[0][2], Future)
+                or pending[0][2].done()
+            ):
+                item, hash_request, result = pending.popleft()
+                yield item, self._result(hash_request, result)
+        while pending:
+            item, hash_request, result = pending.popleft()
+            yield item, self._result(hash_request, result)
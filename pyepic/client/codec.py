@@ -0,0 +1,169 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import posixpath
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Metadata key used to record the codec of an object. S3 returns metadata keys in lower case.
+CODEC_METADATA_KEY = "Codec"
+
+# Extensions of text-heavy files compressed by default. "" matches files without an
+# extension, such as OpenFOAM field files.
+DEFAULT_EXTENSIONS = (
+    "",
+    ".log",
+    ".txt",
+    ".csv",
+    ".dat",
+    ".out",
+    ".xy",
+    ".vtk",
+    ".obj",
+    ".stl",
+    ".foam",
+    ".orig",
+    ".json",
+    ".py",
+)
+
+# Files that are already compressed are never compressed again
+COMPRESSED_EXTENSIONS = (
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".zip",
+    ".7z",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".mp4",
+)
+
+
+class ZstdCodec(object):
+    """Streaming zstd compression for uploads and downloads.
+    Requires the zstandard package.
+
+    :param extensions: File extensions to compress, "" matches files with no extension
+    :type extensions: list, optional
+    :param level: zstd compression level
+    :type level: int, optional
+    :param min_size: Files smaller than this many bytes are not compressed
+    :type min_size: int, optional
+    """
+
+    name = "zstd"
+
+    def __init__(self, extensions=DEFAULT_EXTENSIONS, level=3, min_size=1024):
+        """Constructor method"""
+        if zstandard is None:
+            raise ImportError(
+                "The zstandard package is required for compression, install it with 'pip install zstandard'"
+            )
+        self.extensions = set(ext.lower() for ext in extensions)
+        self.level = level
+        self.min_size = min_size
+
+    def eligible(self, path, size=None):
+        """
+        Should the file at path be compressed?
+            :param path: Local path or S3 key of the file
+            :type path: str
+            :param size: Size of the file in bytes, if known
+            :type size: int, optional
+
+            :rtype: bool
+        """
+        name = posixpath.basename(path.replace(os.path.sep, "/"))
+        ext = os.path.splitext(name)[1].lower()
+        if ext in COMPRESSED_EXTENSIONS:
+            return False
+        if size is not None and size < self.min_size:
+            return False
+        return ext in self.extensions
+
+    def meta_data(self, meta_data):
+        """Add the codec to the meta-data of an object"""
+        meta_data = dict(meta_data)
+        meta_data[CODEC_METADATA_KEY] = self.name
+        return meta_data
+
+    def compress_stream(self, fileobj):
+        """
+        Wrap a readable file-like object in a stream of its compressed contents
+            :param fileobj: Readable file-like object
+            :return: Readable file-like object
+        """
+        return zstandard.ZstdCompressor(level=self.level).stream_reader(fileobj)
+
+
+def object_codec(meta_data):
+    """Return the name of the codec recorded in an object's meta-data, or None"""
+    return meta_data.get(CODEC_METADATA_KEY.lower())
+
+
+def decompress_stream(body, codec_name):
+    """
+    Wrap a response body in a stream of its decompressed contents
+        :param body: Readable stream of the object
+        :param codec_name: Codec recorded in the object's meta-data
+        :type codec_name: str
+
+        :return: Readable file-like object
+    """
+    if codec_name is None:
+        return body
+    if codec_name != ZstdCodec.name:
+        raise ValueError("Unsupported codec {}".format(codec_name))
+    if zstandard is None:
+        raise ImportError(
+            "The zstandard package is required to download compressed files, install it with 'pip install zstandard'"
+        )
+    return zstandard.ZstdDecompressor().stream_reader(body)
+
+
+def copy_stream(source, target, chunk_size=1024 * 1024, callback=None):
+    """Copy a readable stream to a writable file-like object, calling callback with the size of each chunk"""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        target.write(chunk)
+        if callback is not None:
+            callback(len(chunk))
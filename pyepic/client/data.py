@@ -31,178 +31,438 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import boto3
-from botocore.credentials import RefreshableCredentials
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from botocore.credentials import RefreshableCredentials
 from botocore.session import get_session
+from contextlib import ExitStack
 import epiccore
-import errno
+import heapq
+import itertools
+import json
 import os
 from pathlib import Path
-from queue import Queue, Empty
 import sys
+import tempfile
 import threading
+import time
 
 from .base import Client
+from .bundle import (
+    BUNDLE_FOLDER,
+    BundleManifest,
+    TarStream,
+    extract_bundle,
+    new_bundle_name,
+)
+from .checksum import Hasher, hash_chunksize
+from .codec import copy_stream, decompress_stream, object_codec
+from .listing import FileMetaData, ListingTree, ShardedLister, head_objects
+from .reader import BufferReader, RemoteFileReader
+from .sync import (
+    SyncFilter,
+    SyncStats,
+    glob_to_regex,
+    iter_remote,
+    merge_sorted,
+    valid_local_path,
+    walk_local,
+    plan_copy,
+    plan_download,
+    plan_upload,
+)
+from .sync_state import SyncIndex
+from .transfer import (
+    MAX_DELETE_KEYS,
+    BandwidthLimiter,
+    MB,
+    TransferProfile,
+    WorkerPool,
+    delete_batch,
+    ranged_download,
+    read_into,
+    replace_on_success,
+    resumable_upload,
+)
+
+# Most uploads per sync whose ETags are fetched with a HEAD each rather than a listing
+MAX_ETAG_HEADS = 10000
 
 
-class DataThread(threading.Thread):
+class DataTransfer(object):
     """
-    Thread class used internally by pyepic for managaing upload/download functions
+    Class used internally by pyepic for managing upload/download functions.
+    The download and upload methods are run on the threads of a :class:`pyepic.client.transfer.WorkerPool`.
     """
 
     def __init__(
         self,
         s3_client,
         bucket_name,
-        s3_prefix,
-        local_path,
-        file_queue,
-        cancel_event=None,
+        transfer_profile=None,
+        workers=1,
         dryrun=False,
         callback=None,
-        download_thread=True,
-        overwrite_existing=False,
         meta_data={},
+        index=None,
+        bundle_manifest=None,
+        codec=None,
+        resume=False,
+        cancel_event=None,
+        progress=None,
+        delta=False,
+        download_cache=None,
     ):
-        threading.Thread.__init__(self)
         self.__s3_client = s3_client
         self.__bucket_name = bucket_name
-        self.__s3_prefix = s3_prefix
-        self.__file_q = file_queue
-        self.__cancelled = cancel_event
-        self.__local_path = local_path
-        self.__overwrite_existing = overwrite_existing
-        self.__download_thread = download_thread
+        self.__transfer_profile = (
+            transfer_profile if transfer_profile is not None else TransferProfile()
+        )
+        self.__workers = workers
         self.__callback = callback
         self.__dryrun = dryrun
         self.__meta_data = meta_data
+        self.__index = index
+        self.__bundle_manifest = bundle_manifest
+        self.__codec = codec
+        self.__resume = resume
+        self.__cancel_event = cancel_event
+        self.__progress = progress
+        self.__delta = delta
+        self.__download_cache = download_cache
+        # Keys uploaded without their ETag being returned, None once there are too many to HEAD
+        self.__missing_etags = []
+        self.__missing_etags_lock = threading.Lock()
 
-    def __validate_s3_key_as_dir_name(self, s3_key_name):
+    @property
+    def missing_etags(self):
+        """(relative path, key) of the files uploaded by this transfer whose ETag is not yet in the index, or None if there are more than MAX_ETAG_HEADS"""
+        return self.__missing_etags
 
-        ERROR_INVALID_NAME = 123
+    def download(self, item):
+        source_path, target_path, status = self.download_key(item)
+        source_path = "epic://" + source_path.split("/", 1)[1]
+        if self.__callback is not None:
+            self.__callback(source_path, target_path, status, self.__dryrun)
 
-        try:
-            for pathname_part in s3_key_name.split("/"):
-                try:
-                    os.lstat("/" + pathname_part)
-                    # If an OS-specific exception is raised, its error code
-                    # indicates whether this pathname is valid or not. Unless this
-                    # is the case, this exception implies an ignorable kernel or
-                    # filesystem complaint (e.g., path not found or inaccessible).
-                    #
-                    # Only the following exceptions indicate invalid pathnames:
-                    #
-                    # * Instances of the Windows-specific "WindowsError" class
-                    #   defining the "winerror" attribute whose value is
-                    #   "ERROR_INVALID_NAME". Under Windows, "winerror" is more
-                    #   fine-grained and hence useful than the generic "errno"
-                    #   attribute. When a too-long pathname is passed, for example,
-                    #   "errno" is "ENOENT" (i.e., no such file or directory) rather
-                    #   than "ENAMETOOLONG" (i.e., file name too long).
-                    # * Instances of the cross-platform "OSError" class defining the
-                    #   generic "errno" attribute whose value is either:
-                    #   * Under most POSIX-compatible OSes, "ENAMETOOLONG".
-                    #   * Under some edge-case OSes (e.g., SunOS, *BSD), "ERANGE".
-                except OSError as exc:
-                    if hasattr(exc, "winerror"):
-                        if exc.winerror == ERROR_INVALID_NAME:
-                            return False
-                    elif exc.errno in {errno.ENAMETOOLONG, errno.ERANGE}:
-                        return False
-        # If a "TypeError" exception was raised, it almost certainly has the
-        # error message "embedded NUL character" indicating an invalid pathname.
-        except TypeError as exc:
-            return False
-        except ValueError as exc:
-            return False
-        else:
-            return True
+    def upload(self, item):
+        source_path, target_path, status = self.upload_file(item)
+        target_path = "epic://" + target_path.split("/", 1)[1]
+        if self.__callback is not None:
+            self.__callback(source_path, target_path, status, self.__dryrun)
 
-    def run(self):
-        while not self.__cancelled.is_set():
-            try:
-                item = self.__file_q.get(True, 5)
-                if self.__download_thread:
-                    source_path, target_path, status = self.download_key(item)
-                    source_path = "epic://" + source_path.split("/", 1)[1]
-                else:
-                    source_path, target_path, status = self.upload_file(item)
-                    target_path = "epic://" + target_path.split("/", 1)[1]
-                if self.__callback is not None:
-                    self.__callback(source_path, target_path, status, self.__dryrun)
-            except Empty:
-                break
-            except Exception as e:
-                raise e
-        return
-
-    def download_key(self, key_name):
-        file_path = os.path.sep.join(key_name.split(self.__s3_prefix)[1].split("/"))
-        full_file_path = os.path.join(self.__local_path, file_path)
-
-        if not self.__validate_s3_key_as_dir_name(key_name):
-            raise ValueError("Invalid key name: %s" % str(key_name))
-
-        if full_file_path.endswith("/"):
-            if not os.path.isdir(full_file_path) and not self.__dryrun:
-                try:
-                    os.makedirs(full_file_path)
-                except FileExistsError:
-                    # Directory created on another thread
-                    pass
+    def download_key(self, item):
+        # The key has been validated and its folder created by the planner
+        rel_path, remote_file, full_file_path, replace = item
+        key_name = remote_file.key
+
+        if self.__dryrun:
             return (key_name, full_file_path, False)
-        if os.path.exists(full_file_path):
-            if not self.__overwrite_existing:
-                return (key_name, full_file_path, False)
-            local_modified = os.path.getmtime(full_file_path)
-            s3_modified = self.__s3_client.head_object(
-                Bucket=self.__bucket_name, Key=key_name
-            )["LastModified"]
-            if s3_modified.timestamp() < local_modified:
-                return (key_name, full_file_path, False)
-            os.remove(full_file_path)
-        file_dir = os.path.dirname(full_file_path)
-        if not os.path.isdir(file_dir) and not self.__dryrun:
+        if replace:
+            # Never write through a link to the existing file
             try:
-                os.makedirs(file_dir)
-            except FileExistsError:
-                # Directory created on another thread
+                os.remove(full_file_path)
+            except FileNotFoundError:
                 pass
-        if self.__dryrun:
-            return (key_name, full_file_path, False)
-        else:
-            self.__s3_client.download_file(self.__bucket_name, key_name, full_file_path)
+        cache = self.__download_cache
+        if cache is not None and cache.fetch(
+            remote_file.etag, remote_file.size, full_file_path
+        ):
+            self.__set_mtime(rel_path, remote_file, full_file_path)
             return (key_name, full_file_path, True)
+        # Whether to decompress is decided by the codec recorded on the object.
+        # Small files are fetched with a single GET that also returns the meta-data,
+        # larger ones are checked with a HEAD so plain files keep multipart downloads.
+        response = None
+        if remote_file.size < self.__transfer_profile.multipart_threshold:
+            response = self.__s3_client.get_object(
+                Bucket=self.__bucket_name, Key=key_name
+            )
+            codec_name = object_codec(response["Metadata"])
+        else:
+            head = self.__s3_client.head_object(Bucket=self.__bucket_name, Key=key_name)
+            codec_name = object_codec(head["Metadata"])
+        if response is not None or codec_name is not None:
+            if response is None:
+                response = self.__s3_client.get_object(
+                    Bucket=self.__bucket_name, Key=key_name
+                )
+            body = decompress_stream(response["Body"], codec_name)
+            with replace_on_success(full_file_path) as tmp_path:
+                with open(tmp_path, "wb") as f:
+                    copy_stream(body, f, callback=self.__progress)
+        else:
+            self.__s3_client.download_file(
+                self.__bucket_name,
+                key_name,
+                full_file_path,
+                Config=self.__transfer_profile.transfer_config(
+                    remote_file.size, self.__workers
+                ),
+                Callback=self.__progress,
+            )
+        if cache is not None:
+            cache.store(remote_file.etag, remote_file.size, full_file_path)
+        self.__set_mtime(rel_path, remote_file, full_file_path)
+        return (key_name, full_file_path, True)
+
+    def __set_mtime(self, rel_path, remote_file, full_file_path):
+        # Give the file the LastModified time of the object so that later syncs
+        # can tell it is unchanged from the listing alone
+        os.utime(full_file_path, (time.time(), remote_file.last_modified))
+        if self.__index is not None:
+            self.__index.record(
+                rel_path,
+                os.path.getsize(full_file_path),
+                remote_file.last_modified,
+                remote_file.etag,
+            )
+
+    def upload_file(self, item):
+        rel_path, local_file, s3_key_name, md5, verify = item
+        file_full_path = local_file.path
+        if verify:
+            etag = self.__object_with_md5(s3_key_name, md5)
+            if etag is not None:
+                # The object already holds the same content
+                if self.__index is not None and not self.__dryrun:
+                    self.__index.record(
+                        rel_path, local_file.size, local_file.mtime, etag
+                    )
+                return (file_full_path, s3_key_name, False)
+        if not self.__dryrun:
+            config = self.__transfer_profile.transfer_config(
+                local_file.size, self.__workers
+            )
+            meta_data = self.__meta_data
+            if md5 is not None:
+                meta_data = dict(meta_data, md5=md5)
+            etag = None
+            if self.__codec is not None and self.__codec.eligible(
+                file_full_path, local_file.size
+            ):
+                with open(file_full_path, "rb") as f:
+                    self.__s3_client.upload_fileobj(
+                        self.__codec.compress_stream(f),
+                        self.__bucket_name,
+                        s3_key_name,
+                        ExtraArgs={"Metadata": self.__codec.meta_data(meta_data)},
+                        Config=config,
+                        Callback=self.__progress,
+                    )
+            elif (
+                (self.__resume or self.__delta)
+                and self.__index is not None
+                and local_file.size >= config.multipart_threshold
+            ):
+                # Upload the parts ourselves so an interrupted upload can be resumed
+                # and unchanged parts can be copied from the existing object
+                etag = resumable_upload(
+                    self.__s3_client,
+                    self.__bucket_name,
+                    s3_key_name,
+                    rel_path,
+                    local_file,
+                    config.multipart_chunksize,
+                    config.max_concurrency,
+                    self.__index,
+                    extra_args={"Metadata": meta_data},
+                    cancel_event=self.__cancel_event,
+                    callback=self.__progress,
+                    delta=self.__delta,
+                )
+                if etag is None:
+                    # Cancelled, the completed parts are kept for the next sync
+                    return (file_full_path, s3_key_name, False)
+            else:
+                self.__s3_client.upload_file(
+                    file_full_path,
+                    self.__bucket_name,
+                    s3_key_name,
+                    ExtraArgs={"Metadata": meta_data},
+                    Config=config,
+                    Callback=self.__progress,
+                )
+            if self.__bundle_manifest is not None:
+                # The uploaded object replaces any bundled copy
+                self.__bundle_manifest.discard(rel_path)
+            if self.__index is not None:
+                # If not known the ETag is filled in once the sync completes
+                self.__index.record(rel_path, local_file.size, local_file.mtime, etag)
+                if etag is None:
+                    self.__add_missing_etag(rel_path, s3_key_name)
+            return (file_full_path, s3_key_name, True)
+        return (file_full_path, s3_key_name, False)
 
-    def upload_file(self, file_full_path):
-        last_modified = os.path.getmtime(file_full_path)
-        key_name = os.path.relpath(file_full_path, self.__local_path)
-        if key_name.startswith("/"):
-            key_name = key_name[1:]
-        s3_key_name = self.__s3_prefix + key_name
-        upload = False
+    def __add_missing_etag(self, rel_path, s3_key_name):
+        with self.__missing_etags_lock:
+            if self.__missing_etags is None:
+                return
+            if len(self.__missing_etags) >= MAX_ETAG_HEADS:
+                self.__missing_etags = None
+                return
+            self.__missing_etags.append((rel_path, s3_key_name))
+
+    def __object_with_md5(self, s3_key_name, md5):
+        # ETag of the object if it was uploaded from a file with the same MD5 hash
         try:
-            s3_head = self.__s3_client.head_object(
+            response = self.__s3_client.head_object(
                 Bucket=self.__bucket_name, Key=s3_key_name
             )
-            if self.__overwrite_existing:
-                s3_modified = s3_head["LastModified"].timestamp()
-                if last_modified > s3_modified:
-                    upload = True
         except ClientError as e:
-            if e.response["Error"]["Code"] == "404":
-                upload = True
-            else:
-                raise e
-        if upload and not self.__dryrun:
-            self.__s3_client.upload_file(
-                file_full_path,
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise e
+        if response["Metadata"].get("md5") != md5:
+            return None
+        return response["ETag"]
+
+    def copy(self, item):
+        source_path, target_path, status = self.copy_key(item)
+        source_path = "epic://" + source_path.split("/", 1)[1]
+        target_path = "epic://" + target_path.split("/", 1)[1]
+        if self.__callback is not None:
+            self.__callback(source_path, target_path, status, self.__dryrun)
+
+    def copy_key(self, item):
+        rel_path, source_file, target_key = item
+        if self.__dryrun:
+            return (source_file.key, target_key, False)
+        copy_source = {"Bucket": self.__bucket_name, "Key": source_file.key}
+        if source_file.size < self.__transfer_profile.multipart_threshold:
+            # Single request copy, the meta-data is copied with the object
+            self.__s3_client.copy_object(
+                Bucket=self.__bucket_name, Key=target_key, CopySource=copy_source
+            )
+        else:
+            # Multipart copy with upload_part_copy. Multipart uploads don't
+            # copy the meta-data so it is passed on explicitly.
+            head = self.__s3_client.head_object(
+                Bucket=self.__bucket_name, Key=source_file.key
+            )
+            self.__s3_client.copy(
+                copy_source,
                 self.__bucket_name,
-                s3_key_name,
-                ExtraArgs={"Metadata": self.__meta_data},
+                target_key,
+                ExtraArgs={
+                    "Metadata": head["Metadata"],
+                    "MetadataDirective": "REPLACE",
+                },
+                Config=self.__transfer_profile.transfer_config(
+                    source_file.size, self.__workers
+                ),
             )
-            return (file_full_path, s3_key_name, True)
-        return (file_full_path, s3_key_name, False)
+        return (source_file.key, target_key, True)
+
+    def delete_keys(self, items):
+        # items is a batch of (relative path, key) deleted with one delete_objects request
+        failed = {}
+        if not self.__dryrun:
+            _, failed = delete_batch(
+                self.__s3_client, self.__bucket_name, [key for _, key in items]
+            )
+        for rel_path, key in items:
+            deleted = not self.__dryrun and key not in failed
+            if deleted and self.__index is not None:
+                self.__index.discard(rel_path)
+            if self.__callback is not None:
+                target_path = "epic://" + key.split("/", 1)[1]
+                self.__callback(None, target_path, deleted, self.__dryrun)
+
+    def remove_file(self, item):
+        rel_path, full_file_path = item
+        if not self.__dryrun:
+            try:
+                os.remove(full_file_path)
+            except FileNotFoundError:
+                pass
+            if self.__index is not None:
+                self.__index.discard(rel_path)
+        if self.__callback is not None:
+            self.__callback(None, full_file_path, not self.__dryrun, self.__dryrun)
+
+    def upload_bundle(self, item):
+        bundle_name, files = item
+        manifest = self.__bundle_manifest
+        if not self.__dryrun:
+            members = [(rel_path, local_file.path) for rel_path, local_file in files]
+            stream = TarStream(members)
+            meta_data = self.__meta_data
+            if self.__codec is not None:
+                stream = self.__codec.compress_stream(stream)
+                meta_data = self.__codec.meta_data(meta_data)
+            self.__s3_client.upload_fileobj(
+                stream,
+                self.__bucket_name,
+                manifest.bundle_key(bundle_name),
+                ExtraArgs={"Metadata": meta_data},
+                Config=self.__transfer_profile.transfer_config(None, self.__workers),
+                Callback=self.__progress,
+            )
+            # Compare bundles with individual objects by the S3 clock, not the local one
+            uploaded = self.__s3_client.head_object(
+                Bucket=self.__bucket_name, Key=manifest.bundle_key(bundle_name)
+            )["LastModified"].timestamp()
+            for rel_path, local_file in files:
+                manifest.record(
+                    rel_path, bundle_name, local_file.size, local_file.mtime, uploaded
+                )
+                if self.__index is not None:
+                    self.__index.record(
+                        rel_path,
+                        local_file.size,
+                        local_file.mtime,
+                        manifest.remote_file(rel_path).etag,
+                    )
+        if self.__callback is not None:
+            for rel_path, local_file in files:
+                target_path = (
+                    "epic://" + (manifest.s3_prefix + rel_path).split("/", 1)[1]
+                )
+                self.__callback(
+                    local_file.path, target_path, not self.__dryrun, self.__dryrun
+                )
+
+    def download_bundle(self, item):
+        bundle_name, targets = item
+        manifest = self.__bundle_manifest
+        extracted = []
+        if not self.__dryrun:
+            response = self.__s3_client.get_object(
+                Bucket=self.__bucket_name, Key=manifest.bundle_key(bundle_name)
+            )
+            paths = {rel_path: target[1] for rel_path, target in targets.items()}
+            body = decompress_stream(
+                response["Body"], object_codec(response["Metadata"])
+            )
+            for rel_path in extract_bundle(body, paths):
+                extracted.append(rel_path)
+                if self.__progress is not None:
+                    self.__progress(targets[rel_path][0].size)
+                self.__set_mtime(rel_path, targets[rel_path][0], paths[rel_path])
+            if len(extracted) != len(targets):
+                missing = set(targets) - set(extracted)
+                raise ValueError(
+                    "Bundle {} is missing {}".format(bundle_name, sorted(missing))
+                )
+        if self.__callback is not None:
+            for rel_path, (remote_file, full_file_path) in targets.items():
+                source_path = "epic://" + remote_file.key.split("/", 1)[1]
+                self.__callback(
+                    source_path, full_file_path, not self.__dryrun, self.__dryrun
+                )
+
+
+class DeleteResult(list):
+    """List of the paths deleted by :meth:`DataClient.delete`
+
+    :var failed: Dictionary of path to error message for the files that could not be deleted
+    :vartype failed: dict
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.failed = {}
 
 
 class DataObject(object):
@@ -242,6 +502,14 @@ class DataClient(Client):
     _s3_prefix = None
     _s3_bucket = None
     _s3_client = None
+    _s3_session = None
+    _max_pool_connections = 10
+    _transfer_profile = None
+    _codec = None
+    _bandwidth_limiter = None
+    _listing_cache = None
+    _download_cache = None
+    _listing_threads = 8
 
     meta_source = "SDK"
 
@@ -280,8 +548,17 @@ class DataClient(Client):
             session = get_session()
             session._credentials = session_credentials
             session.set_config_variable("region", session_details["region"])
-            autorefresh_session = boto3.Session(botocore_session=session)
-            self._s3_client = autorefresh_session.client("s3")
+            self._s3_session = boto3.Session(botocore_session=session)
+            # Size the pool for the transfers and listings a single call makes,
+            # larger pools get their own client from _pool_client
+            self._max_pool_connections = max(
+                self._max_pool_connections,
+                self._get_transfer_profile().pool_connections(),
+                self._listing_threads + 2,
+            )
+            self._s3_client = self._create_s3_client()
+            self._pool_clients = {}
+            self._pool_clients_lock = threading.Lock()
             self._s3_prefix = session_details["s3_obj_key"]
             self._s3_bucket = session_details["s3_location"]
             profile_details = self._fetch_profile_details_from_epic()
@@ -290,6 +567,108 @@ class DataClient(Client):
                 "User-Profile": str(profile_details.id),
             }
 
+    def _create_s3_client(self, connections=None):
+        return self._s3_session.client(
+            "s3",
+            config=Config(
+                max_pool_connections=(
+                    connections
+                    if connections is not None
+                    else self._max_pool_connections
+                )
+            ),
+        )
+
+    def _pool_client(self, connections):
+        "S3 client with a connection pool of at least connections"
+        self._connect()
+        if connections <= self._max_pool_connections:
+            return self._s3_client
+        # Clients are kept for each size rather than replacing the shared client,
+        # which may be in use by other threads or have handlers registered on it
+        size = -(-connections // 32) * 32
+        with self._pool_clients_lock:
+            client = self._pool_clients.get(size)
+            if client is None:
+                client = self._create_s3_client(size)
+                self._pool_clients[size] = client
+        return client
+
+    def _get_transfer_profile(self, transfer_profile=None):
+        if transfer_profile is not None:
+            return transfer_profile
+        if self._transfer_profile is not None:
+            return self._transfer_profile
+        return TransferProfile()
+
+    def set_transfer_profile(self, transfer_profile):
+        """
+        Set the multipart transfer settings used by this client
+            :param transfer_profile: Transfer settings, or None to use the boto3 defaults
+            :type transfer_profile: :class:`pyepic.client.transfer.TransferProfile`
+        """
+        self._transfer_profile = transfer_profile
+
+    def _get_codec(self, codec=None):
+        return codec if codec is not None else self._codec
+
+    def set_codec(self, codec):
+        """
+        Set the compression codec used by this client. Eligible files are compressed as they are uploaded. Compressed files are always decompressed as they are downloaded, whatever codec is set.
+            :param codec: Compression codec, or None to disable compression
+            :type codec: :class:`pyepic.client.codec.ZstdCodec`
+        """
+        self._codec = codec
+
+    def set_listing_cache(self, listing_cache):
+        """
+        Cache the results of ls. Cached listings are dropped when upload_file, delete or sync change the folder through this client.
+            :param listing_cache: Listing cache, or None to disable caching
+            :type listing_cache: :class:`pyepic.client.cache.ListingCache`
+        """
+        self._listing_cache = listing_cache
+
+    def set_download_cache(self, download_cache):
+        """
+        Keep a copy of downloaded files in a cache folder that is checked before anything is downloaded by download_file or sync.
+        Objects with the same ETag and size as a cached file are placed with a reflink or copy instead of being downloaded again.
+            :param download_cache: Download cache, or None to disable caching
+            :type download_cache: :class:`pyepic.client.cache.DownloadCache`
+        """
+        self._download_cache = download_cache
+
+    def _invalidate_listings(self, s3_path):
+        if self._listing_cache is not None:
+            self._listing_cache.invalidate(s3_path)
+
+    def set_max_bandwidth(self, bytes_per_second):
+        """
+        Cap the combined transfer rate of every upload and download made by this client
+            :param bytes_per_second: Maximum average transfer rate, or None to remove the cap
+            :type bytes_per_second: int
+        """
+        self._bandwidth_limiter = (
+            BandwidthLimiter(bytes_per_second) if bytes_per_second else None
+        )
+
+    def _progress_callback(self, concurrency=None):
+        # boto3 transfer callback feeding the bandwidth cap and adaptive concurrency
+        limiter = self._bandwidth_limiter
+        if limiter is None and concurrency is None:
+            return None
+
+        def progress(amount):
+            if concurrency is not None:
+                concurrency.record(amount)
+            if limiter is not None:
+                limiter.consume(amount)
+
+        return progress
+
+    @staticmethod
+    def _adaptive(worker, concurrency):
+        return concurrency.wrap(worker) if concurrency is not None else worker
+
     def _epic_path_to_s3(self, epic_path):
         self._connect()
         if epic_path[:7] != "epic://":
@@ -310,8 +689,29 @@ class DataClient(Client):
         )
         return pages
 
+    def _list_pages(self, s3_prefix):
+        "Page through every object below s3_prefix, listing large prefixes in concurrent shards"
+        if self._listing_threads <= 1:
+            return self._page_keys(s3_prefix)
+        lister = ShardedLister(
+            self._s3_client, self._s3_bucket, threads=self._listing_threads
+        )
+        return lister.pages(s3_prefix)
+
+    def set_listing_threads(self, threads):
+        """
+        Set the number of threads used to list large folders. Folders with more than 1000 objects are split into their sub-folders, which are listed concurrently.
+        This is used by walk, du, glob, delete and sync. ls lists a single level with a delimiter so is not split.
+            :param threads: Number of concurrent listings, 1 to list folders one page at a time
+            :type threads: int
+        """
+        self._listing_threads = threads
+
     def _list_contents(self, s3_prefix, delimeter=""):
-        response_pages = self._page_keys(s3_prefix, delimeter=delimeter)
+        if delimeter:
+            response_pages = self._page_keys(s3_prefix, delimeter=delimeter)
+        else:
+            response_pages = self._list_pages(s3_prefix)
         for response in response_pages:
             if response["KeyCount"] == 0:
                 raise ValueError("EPIC Path not found")
@@ -331,6 +731,18 @@ class DataClient(Client):
         if not epic_path.endswith("/"):
             epic_path = epic_path + "/"
         prefix = self._epic_path_to_s3(epic_path)
+        if self._listing_cache is not None:
+            listing = self._listing_cache.get(prefix)
+            if listing is None:
+                listing = list(self._ls_pages(prefix))
+                self._listing_cache.put(prefix, listing)
+            for data_object in listing:
+                yield data_object
+        else:
+            for data_object in self._ls_pages(prefix):
+                yield data_object
+
+    def _ls_pages(self, prefix):
         response_pages = self._page_keys(prefix, delimeter="/")
         for response in response_pages:
             if response["KeyCount"] == 0:
@@ -354,6 +766,82 @@ class DataClient(Client):
                     )
                     yield file
 
+    def _file_object(self, s3_obj):
+        return DataObject(
+            s3_obj["Key"].split("/")[-1],
+            self._s3_to_epic_path(s3_obj["Key"]),
+            folder=False,
+            size=s3_obj["Size"],
+            last_modified=s3_obj["LastModified"].isoformat(),
+        )
+
+    def _listing_tree(self, epic_path):
+        self._connect()
+        if not epic_path.endswith("/"):
+            epic_path = epic_path + "/"
+        prefix = self._epic_path_to_s3(epic_path)
+        tree = ListingTree(self._list_pages(prefix), prefix)
+        if len(tree.folders) == 1 and not tree.folders[""][1]:
+            raise ValueError("Path not found")
+        return epic_path, tree
+
+    def walk(self, epic_path):
+        """
+        Walk the folders below epic_path top-down in the style of os.walk.
+        The whole tree is fetched with a single flat listing rather than one listing per folder.
+            :param epic_path: Path in the form epic://[<folder>]/
+            :type epic_path: str
+
+            :return: Iterable of (folder path, sub-folders, files) where sub-folders and files are lists of DataObject
+            :rtype: collections.Iterable[tuple]
+        """
+        epic_path, tree = self._listing_tree(epic_path)
+        for rel_folder, names, files in tree.walk():
+            folder_path = epic_path + rel_folder
+            folders = [
+                DataObject(name, folder_path + name + "/", folder=True)
+                for name in names
+            ]
+            yield folder_path, folders, [self._file_object(f) for f in files]
+
+    def du(self, epic_path):
+        """
+        Total the size and number of files of every folder below epic_path, using a single flat listing
+            :param epic_path: Path in the form epic://[<folder>]/
+            :type epic_path: str
+
+            :return: Dictionary of folder path to the totals for that folder and everything below it
+            :rtype: dict of :class:`pyepic.client.listing.DiskUsage`
+        """
+        epic_path, tree = self._listing_tree(epic_path)
+        return {
+            epic_path + rel_folder: usage for rel_folder, usage in tree.usage().items()
+        }
+
+    def glob(self, epic_pattern):
+        """
+        Find the files matching a glob pattern. "*" and "?" match within a folder name and "**" matches any number of folders,
+        for example "epic://case/**/*.h5". Everything below the folder part of the pattern before the first wildcard is listed with a single flat listing.
+            :param epic_pattern: Pattern in the form epic://[<folder>]/<pattern>
+            :type epic_pattern: str
+
+            :return: Iterable collection of DataObject for the matching files
+            :rtype: collections.Iterable[:class:`pyepic.client.data.DataObject`]
+        """
+        self._connect()
+        wildcard = min(
+            [epic_pattern.find(c) for c in "*?[" if c in epic_pattern]
+            or [len(epic_pattern)]
+        )
+        folder_end = epic_pattern.rfind("/", 0, wildcard) + 1
+        prefix = self._epic_path_to_s3(epic_pattern[:folder_end])
+        regex = glob_to_regex(epic_pattern[folder_end:])
+        for page in self._list_pages(prefix):
+            for s3_obj in page.get("Contents", []):
+                key = s3_obj["Key"]
+                if not key.endswith("/") and regex.match(key[len(prefix) :]):
+                    yield self._file_object(s3_obj)
+
     def get_file_meta_data(self, epic_path):
         """
         Get the meta-data for the file at epic_path
@@ -367,71 +855,351 @@ class DataClient(Client):
         if epic_path.endswith("/"):
             raise ValueError("Invalid file epic path")
         s3_path = self._epic_path_to_s3(epic_path)
-        # bytes_buffer = io.BytesIO()
-        print(s3_path)
         head = self._s3_client.head_object(Bucket=self._s3_bucket, Key=s3_path)
         return head["Metadata"]
 
-    def download_file(self, epic_path, destination):
+    def get_files_meta_data(self, epic_paths, threads=8, meta_data=True):
+        """
+        Get the meta-data of many files, fetching it with concurrent requests.
+        The sizes and ETags of the files are taken from listings, so only the meta-data itself needs a request per file.
+            :param epic_paths: Paths of files in the form epic://[<folder>]/<file>, or the path of a folder in the form epic://[<folder>]/ to get every file below it
+            :type epic_paths: list or str
+            :param threads: Number of concurrent requests
+            :type threads: int, optional
+            :param meta_data: Fetch the meta-data of each file. If False no request is made per file, the files are looked up in a listing of each folder holding them instead.
+            :type meta_data: bool, optional
+
+            :return: Iterable of the meta-data of each file, in the order of epic_paths or of the folder listing. Files that do not exist are returned with every field but the path set to None.
+            :rtype: collections.Iterable[:class:`pyepic.client.listing.FileMetaData`]
+        """
+        self._connect()
+        if isinstance(epic_paths, str):
+            if not epic_paths.endswith("/"):
+                raise ValueError("Invalid folder epic path")
+            listed = (
+                s3_obj
+                for page in self._list_pages(self._epic_path_to_s3(epic_paths))
+                for s3_obj in page.get("Contents", [])
+                if not s3_obj["Key"].endswith("/")
+            )
+            if not meta_data:
+                for s3_obj in listed:
+                    yield FileMetaData(
+                        self._s3_to_epic_path(s3_obj["Key"]),
+                        None,
+                        s3_obj["Size"],
+                        s3_obj["ETag"],
+                    )
+                return
+            keys = (s3_obj["Key"] for s3_obj in listed)
+        else:
+            keys = (self._file_key(epic_path) for epic_path in epic_paths)
+            if not meta_data:
+                for key, s3_obj in self._folder_lookup(keys):
+                    if s3_obj is None:
+                        yield FileMetaData(self._s3_to_epic_path(key), None, None, None)
+                    else:
+                        yield FileMetaData(
+                            self._s3_to_epic_path(key),
+                            None,
+                            s3_obj["Size"],
+                            s3_obj["ETag"],
+                        )
+                return
+        # Only the HEAD requests use the pool, the listing uses the shared client
+        s3_client = self._pool_client(threads)
+        for key, head in head_objects(
+            s3_client, self._s3_bucket, keys, threads=threads
+        ):
+            if head is None:
+                yield FileMetaData(self._s3_to_epic_path(key), None, None, None)
+            else:
+                yield FileMetaData(
+                    self._s3_to_epic_path(key),
+                    head["Metadata"],
+                    head["ContentLength"],
+                    head["ETag"],
+                )
+
+    def _folder_lookup(self, keys):
+        # Find each key in a delimited listing of its folder, listing each folder once
+        listings = {}
+        for key in keys:
+            prefix = key[: key.rfind("/") + 1]
+            listing = listings.get(prefix)
+            if listing is None:
+                listing = listings[prefix] = {
+                    s3_obj["Key"]: s3_obj
+                    for page in self._page_keys(prefix, delimeter="/")
+                    for s3_obj in page.get("Contents", [])
+                }
+            yield key, listing.get(key)
+
+    def _file_key(self, epic_path):
+        if epic_path.endswith("/"):
+            raise ValueError("Invalid file epic path")
+        return self._epic_path_to_s3(epic_path)
+
+    def download_file(
+        self, epic_path, destination, transfer_profile=None, ranged=False
+    ):
         """
         Download the contents of epic_path
             :param epic_path: Path of a file in the form epic://[<folder>]/<file>
             :type epic_path: str
             :param destination: Location to download file to, can be a string or a writable file-like object
             :type destination: str
+            :param transfer_profile: Multipart transfer settings, defaults to the client transfer profile
+            :type transfer_profile: :class:`pyepic.client.transfer.TransferProfile`, optional
+            :param ranged: If ranged == True and destination is a path then the file is preallocated and downloaded with concurrent ranged requests written directly into a memory map of the file. This lets a single large file use the full bandwidth available.
+            :type ranged: bool, optional
         """
         self._connect()
         if epic_path.endswith("/"):
             raise ValueError("Invalid file epic path")
         s3_path = self._epic_path_to_s3(epic_path)
-        if destination.endswith(os.path.sep):
-            if not os.path.isdir(destination):
-                os.makedirs(destination)
-        if os.path.isdir(destination):
-            destination = os.path.join(destination, epic_path.split("/")[-1])
+        profile = self._get_transfer_profile(transfer_profile)
+        s3_client = self._pool_client(profile.pool_connections())
+        cache = self._download_cache if type(destination) == str else None
+        # The HEAD gives the codec the object was compressed with, if any
+        head = s3_client.head_object(Bucket=self._s3_bucket, Key=s3_path)
+        file_size = head["ContentLength"]
+        config = profile.transfer_config(file_size)
         if type(destination) == str:
-            self._s3_client.download_file(self._s3_bucket, s3_path, destination)
+            if destination.endswith(os.path.sep):
+                if not os.path.isdir(destination):
+                    os.makedirs(destination)
+            if os.path.isdir(destination):
+                destination = os.path.join(destination, epic_path.split("/")[-1])
+        if cache is not None and cache.fetch(
+            head["ETag"], head["ContentLength"], destination
+        ):
+            return
+        progress = self._progress_callback()
+        codec_name = object_codec(head["Metadata"])
+        if codec_name is not None:
+            response = s3_client.get_object(
+                Bucket=self._s3_bucket, Key=s3_path, IfMatch=head["ETag"]
+            )
+            body = decompress_stream(response["Body"], codec_name)
+            if type(destination) == str:
+                with replace_on_success(destination) as tmp_path:
+                    with open(tmp_path, "wb") as f:
+                        copy_stream(body, f, callback=progress)
+            else:
+                copy_stream(body, destination, callback=progress)
+        elif type(destination) == str and ranged:
+            ranged_download(
+                s3_client,
+                self._s3_bucket,
+                s3_path,
+                destination,
+                file_size,
+                head["ETag"],
+                profile.chunksize(file_size),
+                profile.concurrency(),
+                callback=progress,
+            )
+        elif type(destination) == str:
+            s3_client.download_file(
+                self._s3_bucket, s3_path, destination, Config=config, Callback=progress
+            )
         else:
-            self._s3_client.download_fileobj(self._s3_bucket, s3_path, destination)
+            s3_client.download_fileobj(
+                self._s3_bucket, s3_path, destination, Config=config, Callback=progress
+            )
+        if cache is not None:
+            cache.store(head["ETag"], head["ContentLength"], destination)
+
+    def open(self, epic_path, block_size=1 * MB, cache_blocks=64, readahead=4):
+        """
+        Open a file for reading without downloading it. Only the parts of the file that are read are fetched. Files that were compressed on upload cannot be read in parts and raise a ValueError.
+            :param epic_path: Path of a file in the form epic://[<folder>]/<file>
+            :type epic_path: str
+            :param block_size: Size in bytes of each block fetched and cached
+            :type block_size: int, optional
+            :param cache_blocks: Maximum number of blocks to keep in the cache
+            :type cache_blocks: int, optional
+            :param readahead: Number of extra blocks to fetch when the file is read sequentially
+            :type readahead: int, optional
+
+            :return: Read-only seekable file-like object
+            :rtype: :class:`pyepic.client.reader.RemoteFileReader`
+        """
+        self._connect()
+        if epic_path.endswith("/"):
+            raise ValueError("Invalid file epic path")
+        s3_path = self._epic_path_to_s3(epic_path)
+        return RemoteFileReader(
+            self._s3_client,
+            self._s3_bucket,
+            s3_path,
+            block_size=block_size,
+            cache_blocks=cache_blocks,
+            readahead=readahead,
+        )
+
+    def read_bytes(self, epic_path):
+        """
+        Read the contents of a file into memory without writing it to disk
+            :param epic_path: Path of a file in the form epic://[<folder>]/<file>
+            :type epic_path: str
+
+            :return: Contents of the file, read straight into a buffer allocated to the size of the object. Compressed files are decompressed.
+            :rtype: bytearray
+        """
+        self._connect()
+        if epic_path.endswith("/"):
+            raise ValueError("Invalid file epic path")
+        s3_path = self._epic_path_to_s3(epic_path)
+        response = self._s3_client.get_object(Bucket=self._s3_bucket, Key=s3_path)
+        buffer = bytearray(response["ContentLength"])
+        read_into(response["Body"], memoryview(buffer))
+        progress = self._progress_callback()
+        if progress is not None:
+            progress(len(buffer))
+        codec_name = object_codec(response["Metadata"])
+        if codec_name is not None:
+            with BufferReader(buffer) as body:
+                return bytearray(decompress_stream(body, codec_name).read())
+        return buffer
+
+    def read_text(self, epic_path, encoding="utf-8"):
+        """
+        Read the contents of a text file
+            :param epic_path: Path of a file in the form epic://[<folder>]/<file>
+            :type epic_path: str
+            :param encoding: Text encoding of the file
+            :type encoding: str, optional
+
+            :return: Contents of the file
+            :rtype: str
+        """
+        return self.read_bytes(epic_path).decode(encoding)
+
+    def write_bytes(self, data, epic_path, transfer_profile=None, codec=None):
+        """
+        Write the contents of a buffer to epic_path without going through a file on disk
+            :param data: Object supporting the buffer protocol, such as bytes, bytearray, memoryview or a C-contiguous NumPy array. It is read in place rather than copied into a new buffer first. Buffers smaller than the multipart threshold are sent straight from it, larger ones are copied one part at a time as the parts are sent.
+            :type data: bytes
+            :param epic_path: Destination path of a file in the form epic://[<folder>]/<file>
+            :type epic_path: str
+            :param transfer_profile: Multipart transfer settings, defaults to the client transfer profile
+            :type transfer_profile: :class:`pyepic.client.transfer.TransferProfile`, optional
+            :param codec: Compression codec, defaults to the client codec. Eligible files are compressed as they are uploaded.
+            :type codec: :class:`pyepic.client.codec.ZstdCodec`, optional
+        """
+        self._connect()
+        if epic_path.endswith("/"):
+            raise ValueError("Invalid file epic path")
+        s3_path = self._epic_path_to_s3(epic_path)
+        profile = self._get_transfer_profile(transfer_profile)
+        s3_client = self._pool_client(profile.pool_connections())
+        codec = self._get_codec(codec)
+        progress = self._progress_callback()
+        with BufferReader(data) as body:
+            size = body.size
+            meta_data = self._meta_data
+            if codec is not None and codec.eligible(s3_path, size):
+                body = codec.compress_stream(body)
+                meta_data = codec.meta_data(meta_data)
+                size = None
+            if size is not None and size < profile.multipart_threshold:
+                # The only copy is made by the HTTP layer as the body is sent
+                s3_client.put_object(
+                    Bucket=self._s3_bucket, Key=s3_path, Body=body, Metadata=meta_data
+                )
+                if progress is not None:
+                    progress(size)
+            else:
+                s3_client.upload_fileobj(
+                    body,
+                    self._s3_bucket,
+                    s3_path,
+                    ExtraArgs={"Metadata": meta_data},
+                    Config=profile.transfer_config(size),
+                    Callback=progress,
+                )
+        self._invalidate_listings(s3_path)
 
-    def upload_file(self, file, epic_path):
+    def upload_file(self, file, epic_path, transfer_profile=None, codec=None):
         """
         Upload the contents of file to epic_path
             :param destination: Location of the file to upload OR a readable file-like object
             :type destination: str
             :param epic_path: Destination path of a file in the form epic://[<folder>]/<file>
             :type epic_path: str
+            :param transfer_profile: Multipart transfer settings, defaults to the client transfer profile
+            :type transfer_profile: :class:`pyepic.client.transfer.TransferProfile`, optional
+            :param codec: Compression codec, defaults to the client codec. Eligible files are compressed as they are uploaded.
+            :type codec: :class:`pyepic.client.codec.ZstdCodec`, optional
         """
         self._connect()
+        profile = self._get_transfer_profile(transfer_profile)
+        s3_client = self._pool_client(profile.pool_connections())
+        codec = self._get_codec(codec)
+        progress = self._progress_callback()
         if type(file) == str:
             if epic_path.endswith("/"):
                 file_name = os.path.basename(file)
                 epic_path += file_name
             s3_path = self._epic_path_to_s3(epic_path)
-            self._s3_client.upload_file(
-                file, self._s3_bucket, s3_path, ExtraArgs={"Metadata": self._meta_data}
-            )
+            file_size = os.path.getsize(file)
+            if codec is not None and codec.eligible(file, file_size):
+                with open(file, "rb") as f:
+                    s3_client.upload_fileobj(
+                        codec.compress_stream(f),
+                        self._s3_bucket,
+                        s3_path,
+                        ExtraArgs={"Metadata": codec.meta_data(self._meta_data)},
+                        Config=profile.transfer_config(file_size),
+                        Callback=progress,
+                    )
+            else:
+                s3_client.upload_file(
+                    file,
+                    self._s3_bucket,
+                    s3_path,
+                    ExtraArgs={"Metadata": self._meta_data},
+                    Config=profile.transfer_config(file_size),
+                    Callback=progress,
+                )
         else:
             if epic_path.endswith("/"):
                 raise ValueError("Invalid file epic path")
             s3_path = self._epic_path_to_s3(epic_path)
-            self._s3_client.upload_fileobj(
-                file, self._s3_bucket, s3_path, ExtraArgs={"Metadata": self._meta_data}
+            meta_data = self._meta_data
+            if codec is not None and codec.eligible(s3_path):
+                file = codec.compress_stream(file)
+                meta_data = codec.meta_data(meta_data)
+            s3_client.upload_fileobj(
+                file,
+                self._s3_bucket,
+                s3_path,
+                ExtraArgs={"Metadata": meta_data},
+                Config=profile.transfer_config(),
+                Callback=progress,
             )
+        self._invalidate_listings(s3_path)
 
-    def delete(self, epic_path, dryrun=False):
+    def delete(self, epic_path, dryrun=False, threads=4, retries=3):
         """
-        Delete the file of folder at epic_path
+        Delete the file of folder at epic_path. The files in a folder are deleted in batches of 1000 as they are listed,
+        with several batches deleted at once. Files that S3 fails to delete are retried.
             :param epic_path: Path of a file or folder to delete in the form epic://[<folder>]/<file>
             :type epic_path: str
             :param dryrun: If dryrun is True then return a list of files that would be deleted without actually deleting them
             :type dryrun: bool
+            :param threads: Number of batches deleted at once
+            :type threads: int, optional
+            :param retries: Number of times a file that failed to delete is retried
+            :type retries: int, optional
 
-            :return: List of the files deleted
-            :rtype: List[str]
+            :return: List of the files deleted, any files that could not be deleted are in its failed attribute
+            :rtype: :class:`pyepic.client.data.DeleteResult`
         """
         self._connect()
-        deleted = []
+        deleted = DeleteResult()
         if not epic_path.endswith("/"):
             key = self._epic_path_to_s3(epic_path)
             deleted.append(epic_path)
@@ -439,22 +1207,41 @@ class DataClient(Client):
                 response = self._s3_client.delete_object(
                     Bucket=self._s3_bucket, Key=key
                 )
+                self._invalidate_listings(key)
             return deleted
         else:
-            objects = []
             prefix = self._epic_path_to_s3(epic_path)
             key_list = self._list_contents(prefix)
-            for item in key_list:
-                deleted.append(self._s3_to_epic_path(item))
-                objects.append({"Key": item})
-            if not dryrun:
-                response = self._s3_client.delete_objects(
-                    Bucket=self._s3_bucket,
-                    Delete={"Objects": objects},
+            if dryrun:
+                deleted.extend(self._s3_to_epic_path(key) for key in key_list)
+                return deleted
+            # Results are kept per batch so the deleted list stays in listing order
+            batches = []
+
+            def delete_keys(item):
+                index, keys = item
+                batches[index] = delete_batch(
+                    self._s3_client, self._s3_bucket, keys, retries=retries
                 )
-                if "Errors" in response:
-                    # TODO, remove any error files for deleted list
-                    pass
+
+            try:
+                with WorkerPool(delete_keys, threads=threads) as pool:
+                    batch = []
+                    for key in key_list:
+                        batch.append(key)
+                        if len(batch) == MAX_DELETE_KEYS:
+                            batches.append(None)
+                            pool.submit((len(batches) - 1, batch))
+                            batch = []
+                    if batch:
+                        batches.append(None)
+                        pool.submit((len(batches) - 1, batch))
+            finally:
+                self._invalidate_listings(prefix)
+            for batch_deleted, batch_failed in batches:
+                deleted.extend(self._s3_to_epic_path(key) for key in batch_deleted)
+                for key, error in batch_failed.items():
+                    deleted.failed[self._s3_to_epic_path(key)] = error
             return deleted
 
     def sync(
@@ -466,9 +1253,25 @@ class DataClient(Client):
         callback=None,
         threads=3,
         cancel_event=None,
+        use_index=False,
+        transfer_profile=None,
+        bundle_threshold=None,
+        bundle_size=64 * MB,
+        codec=None,
+        include=None,
+        exclude=None,
+        mirror=False,
+        resume=False,
+        concurrency=None,
+        stats=None,
+        checksum=False,
+        delta=False,
     ):
         """
         Synchronize the data from one directory to another, source_path or target_path can be a remote folder or a local folder.
+        If both are remote folders then the files are copied within EPIC without passing through the client.
+        The folders are walked and listed in key order and compared as they are read, with the work handed to the threads
+        through bounded queues, so memory use does not grow with the number of files.
             :param source_path: Source folder to syncronise from. For remote folders use form epic://[<folder>]/<file>.
             :type source_path: str
             :param target_path: Target folder to syncronise to. For remote folders use form epic://[<folder>]/<file>.
@@ -477,48 +1280,291 @@ class DataClient(Client):
             :type dryrun: bool, optional
             :param overwrite_existing: If overwrite_existing == True then files with newer modification timestamps in source_path will replace existing files in target_path
             :type overwrite_existing: bool, optional
-            :param callback: A callback method that accepts four parameters. These are source, destination, a boolean indicating if a copy has taken place and a boolean to indicate if the copy was a dryrun. The callback is called after each file is processed.
+            :param callback: A callback method that accepts four parameters. These are source, destination, a boolean indicating if a copy has taken place and a boolean to indicate if the copy was a dryrun. The callback is called after each file is processed. Keys that cannot be used as local paths, such as ones with empty or ".." folder names, are skipped and reported with a destination of None and listed in the returned stats.
             :type callback: method, optional
             :param threads: Number of threads to use for sync
             :type threads: int, optional
             :param cancel_event: An instance of threading.Event that can be set to cancel the sync.
             :type cancel_event: :class:`threading.Event`
+            :param use_index: If use_index == True then a record of every file transferred is kept in an index file (.pyepic-sync.db) in the local folder. Later syncs of the same folders skip files that have not changed on either side since they were last synced.
+            :type use_index: bool, optional
+            :param transfer_profile: Multipart transfer settings, defaults to the client transfer profile
+            :type transfer_profile: :class:`pyepic.client.transfer.TransferProfile`, optional
+            :param bundle_threshold: When uploading, files smaller than bundle_threshold bytes are packed into tar bundles instead of being uploaded individually. Bundled files are unpacked automatically when the folder is synced back.
+            :type bundle_threshold: int, optional
+            :param bundle_size: Maximum number of bytes of file data in each bundle
+            :type bundle_size: int, optional
+            :param codec: Compression codec, defaults to the client codec. Eligible files are compressed as they are uploaded. Compressed files are always decompressed as they are downloaded, whatever codec is set.
+            :type codec: :class:`pyepic.client.codec.ZstdCodec`, optional
+            :param include: Glob patterns or compiled regular expressions, if given only files matching at least one are synced. See :class:`pyepic.client.sync.SyncFilter`.
+            :type include: list, optional
+            :param exclude: Glob patterns or compiled regular expressions for files and folders to skip. Excluded folders are not walked or listed.
+            :type exclude: list, optional
+            :param mirror: If mirror == True then files in target_path that are not in source_path are deleted once every transfer has completed. Nothing is deleted if a transfer fails or the sync is cancelled. The callback is called with a source of None for each deleted file. Files excluded by the include and exclude rules are never deleted.
+            :type mirror: bool, optional
+            :param resume: If resume == True then progress is journaled in the index file so that a sync that fails or is cancelled can be continued by running it again. Completed files are skipped and large uploads continue from their last completed part. Implies use_index.
+            :type resume: bool, optional
+            :param concurrency: Adjust the number of files transferred at once from the observed throughput and throttling instead of using a fixed number of threads. max_workers threads are started and the threads kwarg is ignored.
+            :type concurrency: :class:`pyepic.client.transfer.AdaptiveConcurrency`, optional
+            :param stats: Stats to update as the sync runs, pass one in to monitor the queue depth and memory use from another thread
+            :type stats: :class:`pyepic.client.sync.SyncStats`, optional
+
+            :param checksum: If checksum == True then files are compared by their contents rather than their timestamps. Local files are hashed in a pool of processes and compared with the ETag of the remote object, and only files whose contents differ are transferred. Compressed objects are compared with the MD5 of the file stored when it was uploaded, so are always downloaded. Requires overwrite_existing to replace existing files. Hashes are cached in the index file, so implies use_index.
+            :type checksum: bool, optional
+            :param delta: If delta == True then the MD5 of each part of a large file is recorded in the index file when it is uploaded. When the file is uploaded again the parts that have not changed are copied from the existing object within EPIC and only the changed parts are sent. Implies use_index.
+            :type delta: bool, optional
+
+            :return: Stats of the sync
+            :rtype: :class:`pyepic.client.sync.SyncStats`
         """
-        if source_path.startswith("epic://"):
-            if target_path.startswith("epic://"):
-                raise ValueError("Both source_path and target_path are EPIC paths")
-            if not source_path.endswith("/"):
-                source_path = source_path + "/"
-            target_path = os.path.expanduser(target_path)
-            Path(target_path).mkdir(parents=True, exist_ok=True)
-            prefix = self._epic_path_to_s3(source_path)
-            self._download(
-                prefix,
-                target_path,
-                dryrun=dryrun,
-                callback=callback,
-                overwrite_existing=overwrite_existing,
-                cancel_event=cancel_event,
+        use_index = use_index or resume or checksum or delta
+        stats = stats if stats is not None else SyncStats()
+        sync_filter = None
+        if include or exclude:
+            sync_filter = SyncFilter(include, exclude, always_include=[BUNDLE_FOLDER])
+        if concurrency is not None:
+            threads = concurrency.max_workers
+            # The transfers use the client for the size of their pipeline
+            watched_client = self._pool_client(
+                self._pipeline_connections(
+                    self._get_transfer_profile(transfer_profile), threads
+                )
             )
-        elif target_path.startswith("epic://"):
-            if source_path.startswith("epic://"):
-                raise ValueError("Both source_path and target_path are EPIC paths")
-            if not target_path.endswith("/"):
-                target_path = target_path + "/"
-            source_path = os.path.expanduser(source_path)
-            if not os.path.isdir(source_path):
-                raise ValueError("source_path does not exist")
-            prefix = self._epic_path_to_s3(target_path)
-            self._upload(
-                source_path,
-                prefix,
-                dryrun=dryrun,
-                callback=callback,
-                overwrite_existing=overwrite_existing,
-                cancel_event=cancel_event,
+            concurrency.watch(watched_client)
+        try:
+            if source_path.startswith("epic://") and target_path.startswith("epic://"):
+                if not source_path.endswith("/"):
+                    source_path = source_path + "/"
+                if not target_path.endswith("/"):
+                    target_path = target_path + "/"
+                source_prefix = self._epic_path_to_s3(source_path)
+                target_prefix = self._epic_path_to_s3(target_path)
+                if source_prefix.startswith(target_prefix) or target_prefix.startswith(
+                    source_prefix
+                ):
+                    raise ValueError("source_path and target_path must not overlap")
+                self._copy(
+                    source_prefix,
+                    target_prefix,
+                    dryrun=dryrun,
+                    callback=callback,
+                    overwrite_existing=overwrite_existing,
+                    threads=threads,
+                    cancel_event=cancel_event,
+                    transfer_profile=transfer_profile,
+                    sync_filter=sync_filter,
+                    mirror=mirror,
+                    concurrency=concurrency,
+                    stats=stats,
+                )
+            elif source_path.startswith("epic://"):
+                if not source_path.endswith("/"):
+                    source_path = source_path + "/"
+                target_path = os.path.expanduser(target_path)
+                Path(target_path).mkdir(parents=True, exist_ok=True)
+                prefix = self._epic_path_to_s3(source_path)
+                index = self._open_index(target_path, prefix, use_index, dryrun)
+                hasher = Hasher(index).start() if checksum else None
+                try:
+                    self._download(
+                        prefix,
+                        target_path,
+                        dryrun=dryrun,
+                        callback=callback,
+                        overwrite_existing=overwrite_existing,
+                        threads=threads,
+                        cancel_event=cancel_event,
+                        index=index,
+                        transfer_profile=transfer_profile,
+                        sync_filter=sync_filter,
+                        mirror=mirror,
+                        concurrency=concurrency,
+                        stats=stats,
+                        hasher=hasher,
+                    )
+                finally:
+                    if hasher is not None:
+                        hasher.close()
+                    if index is not None:
+                        index.close()
+            elif target_path.startswith("epic://"):
+                if not target_path.endswith("/"):
+                    target_path = target_path + "/"
+                source_path = os.path.expanduser(source_path)
+                if not os.path.isdir(source_path):
+                    raise ValueError("source_path does not exist")
+                prefix = self._epic_path_to_s3(target_path)
+                index = self._open_index(source_path, prefix, use_index, dryrun)
+                hasher = Hasher(index).start() if checksum else None
+                try:
+                    self._upload(
+                        source_path,
+                        prefix,
+                        dryrun=dryrun,
+                        callback=callback,
+                        overwrite_existing=overwrite_existing,
+                        threads=threads,
+                        cancel_event=cancel_event,
+                        index=index,
+                        transfer_profile=transfer_profile,
+                        bundle_threshold=bundle_threshold,
+                        bundle_size=bundle_size,
+                        codec=codec,
+                        sync_filter=sync_filter,
+                        mirror=mirror,
+                        concurrency=concurrency,
+                        resume=resume,
+                        delta=delta,
+                        stats=stats,
+                        hasher=hasher,
+                    )
+                finally:
+                    if hasher is not None:
+                        hasher.close()
+                    if index is not None:
+                        index.close()
+            else:
+                raise ValueError("At least one epic:// path must be specified")
+        finally:
+            if concurrency is not None:
+                concurrency.unwatch(watched_client)
+            if target_path.startswith("epic://") and not dryrun:
+                self._invalidate_listings(self._epic_path_to_s3(target_path))
+        return stats
+
+    def _open_index(self, local_root, s3_prefix, use_index, dryrun):
+        if not use_index:
+            return None
+        index_path = os.path.join(local_root, SyncIndex.FILE_NAME)
+        if dryrun and not os.path.exists(index_path):
+            # Don't create an index for a dryrun
+            return None
+        return SyncIndex(local_root, s3_prefix)
+
+    def _pipeline_connections(self, profile, threads):
+        # Listings run alongside the transfers, and bundles and mirror add a second pool of workers
+        return profile.pool_connections(2 * threads) + self._listing_threads
+
+    @staticmethod
+    def _start_pool(stack, worker, threads, cancel_event, stats):
+        pool = stack.enter_context(
+            WorkerPool(worker, threads=threads, cancel_event=cancel_event)
+        )
+        stats.watch(pool)
+        stack.callback(stats.unwatch, pool)
+        return pool
+
+    def _remote_stream(self, s3_prefix, sync_filter=None, must_exist=False):
+        # Objects below s3_prefix in key order
+        if must_exist:
+            # Check the folder exists before anything is transferred or deleted,
+            # whether or not a filter is set, so a mistyped source cannot look
+            # like an empty one to mirror
+            response = self._s3_client.list_objects_v2(
+                Bucket=self._s3_bucket, Prefix=s3_prefix, MaxKeys=1
             )
-        else:
-            raise ValueError("At least one epic:// path must be specified")
+            if response["KeyCount"] == 0:
+                raise ValueError("EPIC Path not found")
+        if sync_filter is None:
+            return iter_remote(self._list_pages(s3_prefix), s3_prefix)
+        # Only list the parts of the folder that can contain included files
+        return itertools.chain.from_iterable(
+            iter_remote(
+                self._list_pages(s3_prefix + rel_prefix), s3_prefix, sync_filter
+            )
+            for rel_prefix in sync_filter.list_prefixes()
+        )
+
+    def _delete_keys(self, transfer, items, threads=3, cancel_event=None, stats=None):
+        # Delete an iterable of (relative path, key) in batches of up to MAX_DELETE_KEYS keys
+        stats = stats if stats is not None else SyncStats()
+        with ExitStack() as stack:
+            deletes = _Batches(
+                self._start_pool(
+                    stack, transfer.delete_keys, threads, cancel_event, stats
+                ),
+                stats,
+                max_items=MAX_DELETE_KEYS,
+            )
+            for item in items:
+                deletes.add(item)
+            deletes.flush()
+
+    def _copy(
+        self,
+        source_prefix,
+        target_prefix,
+        dryrun=False,
+        callback=None,
+        threads=3,
+        overwrite_existing=False,
+        cancel_event=None,
+        transfer_profile=None,
+        sync_filter=None,
+        mirror=False,
+        concurrency=None,
+        stats=None,
+    ):
+        stats = stats if stats is not None else SyncStats()
+        profile = self._get_transfer_profile(transfer_profile)
+        s3_client = self._pool_client(self._pipeline_connections(profile, threads))
+        source = self._remote_stream(source_prefix, sync_filter, must_exist=True)
+        target = self._remote_stream(target_prefix, sync_filter)
+        transfer = DataTransfer(
+            s3_client,
+            self._s3_bucket,
+            transfer_profile=profile,
+            workers=threads,
+            dryrun=dryrun,
+            callback=callback,
+            progress=self._progress_callback(concurrency),
+        )
+        # Target only objects are deleted once every copy has succeeded
+        deletes = _Spool() if mirror else None
+        try:
+            with ExitStack() as stack:
+                pool = self._start_pool(
+                    stack,
+                    self._adaptive(transfer.copy, concurrency),
+                    threads,
+                    cancel_event,
+                    stats,
+                )
+                for rel_path, source_file, target_file, copy in plan_copy(
+                    source, target, overwrite_existing=overwrite_existing
+                ):
+                    if pool.cancelled:
+                        break
+                    stats.path()
+                    target_key = target_prefix + rel_path
+                    if source_file is None:
+                        if deletes is not None:
+                            deletes.add((rel_path, target_file.key))
+                    elif copy:
+                        stats.submit(pool, (rel_path, source_file, target_key))
+                    elif callback is not None:
+                        callback(
+                            self._s3_to_epic_path(source_file.key),
+                            self._s3_to_epic_path(target_key),
+                            False,
+                            dryrun,
+                        )
+            if deletes is not None and not pool.cancelled:
+                self._delete_keys(transfer, deletes, threads, cancel_event, stats)
+        finally:
+            if deletes is not None:
+                deletes.close()
+        return stats
+
+    @staticmethod
+    def _known_folder(local_root, rel_folder, known, create):
+        # Folders are planned in key order, so a folder is known to exist if it
+        # is the last known folder or one of its parents
+        if rel_folder == "" or (known is not None and known.startswith(rel_folder)):
+            return known
+        if create:
+            os.makedirs(os.path.join(local_root, *rel_folder.split("/")), exist_ok=True)
+        return rel_folder
 
     def _download(
         self,
@@ -529,73 +1575,541 @@ class DataClient(Client):
         threads=3,
         overwrite_existing=False,
         cancel_event=None,
+        index=None,
+        transfer_profile=None,
+        sync_filter=None,
+        mirror=False,
+        concurrency=None,
+        stats=None,
+        hasher=None,
     ):
-        file_queue = Queue()
-        if cancel_event is None:
-            cancel_event = threading.Event()
-        thread_pool = []
-        for i in range(threads):
-            t = DataThread(
-                self._s3_client,
-                self._s3_bucket,
-                s3_prefix,
-                local_destination,
-                file_queue,
-                cancel_event=cancel_event,
-                dryrun=dryrun,
-                callback=callback,
-                download_thread=True,
-                overwrite_existing=overwrite_existing,
-            )
-            t.daemon = True
-            t.start()
-            thread_pool.append(t)
-        file_count = 0
-        keys = self._list_contents(s3_prefix)
-        for key in keys:
-            file_count += 1
-            file_queue.put(key)
-        for i in range(threads):
-            while thread_pool[i].is_alive():
-                thread_pool[i].join(1)
+        stats = stats if stats is not None else SyncStats()
+        profile = self._get_transfer_profile(transfer_profile)
+        s3_client = self._pool_client(self._pipeline_connections(profile, threads))
+        remote = self._remote_stream(s3_prefix, sync_filter, must_exist=True)
+        manifest = BundleManifest(self._s3_client, self._s3_bucket, s3_prefix).load()
+        remote = manifest.merge(remote, sync_filter)
+        local = walk_local(local_destination, sync_filter)
+        index_entries = index.iter_entries() if index is not None else None
+        bundle_ends = manifest.bundle_ends()
+        transfer = DataTransfer(
+            s3_client,
+            self._s3_bucket,
+            transfer_profile=profile,
+            workers=threads,
+            dryrun=dryrun,
+            callback=callback,
+            index=index,
+            bundle_manifest=manifest,
+            progress=self._progress_callback(concurrency),
+            download_cache=self._download_cache,
+        )
+        # Bundles are extracted once every file in them has been planned
+        bundles = {}
+        bundle_queue = []
+        known_folder = None
+        removed_folders = set()
+        # Local only files are removed once every download has succeeded
+        removals = _Spool() if mirror else None
+        try:
+            with ExitStack() as stack:
+                pool = self._start_pool(
+                    stack,
+                    self._adaptive(transfer.download, concurrency),
+                    threads,
+                    cancel_event,
+                    stats,
+                )
+                if bundle_ends:
+                    bundle_pool = self._start_pool(
+                        stack,
+                        self._adaptive(transfer.download_bundle, concurrency),
+                        threads,
+                        cancel_event,
+                        stats,
+                    )
+                planned = plan_download(
+                    remote,
+                    local,
+                    overwrite_existing=overwrite_existing,
+                    index=index_entries,
+                    checksum=hasher is not None,
+                )
+                if hasher is not None:
+
+                    def hash_request(item):
+                        # Existing files that may already match their object
+                        rel_path, remote_file, local_file, download = item
+                        if (
+                            not download
+                            or local_file is None
+                            or local_file.size != remote_file.size
+                            or manifest.is_bundled(rel_path, remote_file)
+                        ):
+                            return None
+                        chunksize = hash_chunksize(
+                            remote_file.etag,
+                            remote_file.size,
+                            profile.chunksize(remote_file.size),
+                        )
+                        if chunksize is None:
+                            return None
+                        return rel_path, local_file, chunksize
+
+                    planned = hasher.map(planned, hash_request)
+                else:
+                    planned = ((item, None) for item in planned)
+                for (rel_path, remote_file, local_file, download), file_hash in planned:
+                    if pool.cancelled:
+                        break
+                    stats.path()
+                    if file_hash is not None and file_hash.etag == remote_file.etag:
+                        # The local file already has the same content
+                        download = False
+                        if index is not None and not dryrun:
+                            index.record(
+                                rel_path,
+                                local_file.size,
+                                local_file.mtime,
+                                remote_file.etag,
+                            )
+                    while bundle_queue and bundle_queue[0][0] < rel_path:
+                        bundle_name = heapq.heappop(bundle_queue)[1]
+                        stats.submit(
+                            bundle_pool, (bundle_name, bundles.pop(bundle_name))
+                        )
+                    rel_folder = rel_path[: rel_path.rfind("/") + 1]
+                    if local_file is not None:
+                        known_folder = self._known_folder(
+                            local_destination, rel_folder, known_folder, False
+                        )
+                    if remote_file is None:
+                        if mirror and not SyncIndex.is_index_file(rel_path):
+                            removals.add((rel_path, local_file.path))
+                            removed_folders.add(rel_folder)
+                        continue
+                    if rel_path and not valid_local_path(rel_path):
+                        # Keys such as "a//b" or "../b" are valid in S3 but cannot be
+                        # written safely, report them rather than failing the sync
+                        stats.skipped.append(remote_file.key)
+                        if callback is not None:
+                            callback(
+                                self._s3_to_epic_path(remote_file.key),
+                                None,
+                                False,
+                                dryrun,
+                            )
+                        continue
+                    full_file_path = os.path.join(
+                        local_destination, os.path.sep.join(rel_path.split("/"))
+                    )
+                    if rel_path.endswith("/") or download:
+                        known_folder = self._known_folder(
+                            local_destination,
+                            rel_folder,
+                            known_folder,
+                            not dryrun,
+                        )
+                    if not download:
+                        if callback is not None:
+                            callback(
+                                self._s3_to_epic_path(remote_file.key),
+                                full_file_path,
+                                False,
+                                dryrun,
+                            )
+                    elif manifest.is_bundled(rel_path, remote_file):
+                        bundle_name = manifest.files[rel_path]["bundle"]
+                        if bundle_name not in bundles:
+                            bundles[bundle_name] = {}
+                            heapq.heappush(
+                                bundle_queue, (bundle_ends[bundle_name], bundle_name)
+                            )
+                        bundles[bundle_name][rel_path] = (remote_file, full_file_path)
+                    else:
+                        stats.submit(
+                            pool,
+                            (
+                                rel_path,
+                                remote_file,
+                                full_file_path,
+                                local_file is not None,
+                            ),
+                        )
+                while bundle_queue and not pool.cancelled:
+                    bundle_name = heapq.heappop(bundle_queue)[1]
+                    stats.submit(bundle_pool, (bundle_name, bundles.pop(bundle_name)))
+            if removals is not None and not pool.cancelled:
+                with ExitStack() as stack:
+                    remove_pool = self._start_pool(
+                        stack, transfer.remove_file, threads, cancel_event, stats
+                    )
+                    for item in removals:
+                        if not stats.submit(remove_pool, item):
+                            break
+        finally:
+            if removals is not None:
+                removals.close()
+        if mirror and not dryrun:
+            self._remove_empty_folders(local_destination, removed_folders)
+        return stats
+
+    @staticmethod
+    def _remove_empty_folders(local_root, rel_folders):
+        # Remove the folders that files were removed from, and their parents, once they are empty
+        folders = set()
+        for rel_folder in rel_folders:
+            parts = rel_folder.split("/")[:-1]
+            for i in range(1, len(parts) + 1):
+                folders.add(os.path.join(local_root, *parts[:i]))
+        for folder in sorted(folders, key=len, reverse=True):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # Not empty
+                pass
 
     def _upload(
         self,
         local_source,
         s3_prefix,
-        threads=1,
+        threads=3,
         dryrun=False,
         callback=None,
         overwrite_existing=False,
         cancel_event=None,
+        index=None,
+        transfer_profile=None,
+        bundle_threshold=None,
+        bundle_size=64 * MB,
+        codec=None,
+        sync_filter=None,
+        mirror=False,
+        resume=False,
+        delta=False,
+        concurrency=None,
+        stats=None,
+        hasher=None,
     ):
-        file_queue = Queue()
-        if cancel_event is None:
-            cancel_event = threading.Event()
-        thread_pool = []
-        for i in range(threads):
-            t = DataThread(
-                self._s3_client,
-                self._s3_bucket,
-                s3_prefix,
-                local_source,
-                file_queue,
+        stats = stats if stats is not None else SyncStats()
+        profile = self._get_transfer_profile(transfer_profile)
+        codec = self._get_codec(codec)
+        s3_client = self._pool_client(self._pipeline_connections(profile, threads))
+        local = (
+            (rel_path, local_file)
+            for rel_path, local_file in walk_local(local_source, sync_filter)
+            if not SyncIndex.is_index_file(rel_path)
+        )
+        remote = self._remote_stream(s3_prefix, sync_filter)
+        manifest = BundleManifest(self._s3_client, self._s3_bucket, s3_prefix).load()
+        remote = manifest.merge(remote, sync_filter)
+        index_entries = index.iter_entries() if index is not None else None
+        transfer = DataTransfer(
+            s3_client,
+            self._s3_bucket,
+            transfer_profile=profile,
+            workers=threads,
+            dryrun=dryrun,
+            callback=callback,
+            meta_data=self._meta_data,
+            index=index,
+            bundle_manifest=manifest,
+            codec=codec,
+            resume=resume,
+            cancel_event=cancel_event,
+            progress=self._progress_callback(concurrency),
+            delta=delta,
+        )
+        # Remote only files are deleted once every upload has succeeded
+        deletes = _Spool() if mirror else None
+        try:
+            with ExitStack() as stack:
+                pool = self._start_pool(
+                    stack,
+                    self._adaptive(transfer.upload, concurrency),
+                    threads,
+                    cancel_event,
+                    stats,
+                )
+                small_files = None
+                if bundle_threshold is not None:
+                    small_files = _Batches(
+                        self._start_pool(
+                            stack,
+                            self._adaptive(transfer.upload_bundle, concurrency),
+                            threads,
+                            cancel_event,
+                            stats,
+                        ),
+                        stats,
+                        max_size=bundle_size,
+                        size=lambda item: item[1].size,
+                        name=new_bundle_name,
+                    )
+                planned = plan_upload(
+                    local,
+                    remote,
+                    overwrite_existing=overwrite_existing,
+                    index=index_entries,
+                    checksum=hasher is not None,
+                )
+                if hasher is not None:
+
+                    def hash_request(item):
+                        rel_path, local_file, remote_file, upload = item
+                        if not upload:
+                            return None
+                        if remote_file is None:
+                            # Compressed objects are given the MD5 of their contents
+                            # as metadata so that they can be compared later
+                            if codec is not None and codec.eligible(
+                                local_file.path, local_file.size
+                            ):
+                                return rel_path, local_file, 0
+                            return None
+                        if manifest.is_bundled(rel_path, remote_file):
+                            return None
+                        chunksize = self._etag_chunksize(
+                            profile, codec, local_file, remote_file
+                        )
+                        if chunksize is None:
+                            return rel_path, local_file, 0
+                        if local_file.size != remote_file.size:
+                            return None
+                        return rel_path, local_file, chunksize
+
+                    planned = hasher.map(planned, hash_request)
+                else:
+                    planned = ((item, None) for item in planned)
+                for (rel_path, local_file, remote_file, upload), file_hash in planned:
+                    if pool.cancelled:
+                        break
+                    stats.path()
+                    s3_key_name = s3_prefix + rel_path
+                    md5 = None
+                    verify = False
+                    if file_hash is not None:
+                        md5 = file_hash.md5
+                    if file_hash is not None and remote_file is not None:
+                        if file_hash.etag == remote_file.etag:
+                            # The remote object already has the same content
+                            upload = False
+                            if index is not None and not dryrun:
+                                index.record(
+                                    rel_path,
+                                    local_file.size,
+                                    local_file.mtime,
+                                    remote_file.etag,
+                                )
+                        else:
+                            # Compare with the MD5 stored when the object was uploaded
+                            verify = (
+                                self._etag_chunksize(
+                                    profile, codec, local_file, remote_file
+                                )
+                                is None
+                            )
+                    if local_file is None:
+                        if (
+                            deletes is not None
+                            and not rel_path.endswith("/")
+                            and not SyncIndex.is_index_file(rel_path)
+                        ):
+                            deletes.add(
+                                (
+                                    rel_path,
+                                    remote_file.key,
+                                    manifest.is_bundled(rel_path, remote_file),
+                                )
+                            )
+                    elif (
+                        upload
+                        and small_files is not None
+                        and local_file.size < bundle_threshold
+                    ):
+                        small_files.add((rel_path, local_file))
+                    elif upload:
+                        stats.submit(
+                            pool, (rel_path, local_file, s3_key_name, md5, verify)
+                        )
+                    elif callback is not None:
+                        callback(
+                            local_file.path,
+                            self._s3_to_epic_path(s3_key_name),
+                            False,
+                            dryrun,
+                        )
+                if small_files is not None:
+                    small_files.flush()
+            if deletes is not None and not pool.cancelled:
+                self._delete_keys(
+                    transfer,
+                    self._mirror_remote(manifest, index, deletes, dryrun, callback),
+                    threads,
+                    cancel_event,
+                    stats,
+                )
+        finally:
+            if manifest.changed and not dryrun:
+                manifest.save(self._meta_data)
+            if deletes is not None:
+                deletes.close()
+        if mirror and not dryrun and not pool.cancelled:
+            self._delete_keys(
+                transfer,
+                [
+                    (None, manifest.bundle_key(name))
+                    for name in manifest.unused_bundles()
+                ],
+                threads=threads,
                 cancel_event=cancel_event,
-                dryrun=dryrun,
-                callback=callback,
-                download_thread=False,
-                overwrite_existing=overwrite_existing,
-                meta_data=self._meta_data,
             )
-            t.daemon = True
-            t.start()
-            thread_pool.append(t)
-        file_count = 0
-        for dirname, _, filenames in os.walk(local_source):
-            for filename in filenames:
-                full_path = os.path.join(dirname, filename)
-                file_count += 1
-                file_queue.put(full_path)
-        for i in range(threads):
-            while thread_pool[i].is_alive():
-                thread_pool[i].join(1)
+        if index is not None and not dryrun:
+            self._update_index_etags(
+                index,
+                s3_prefix,
+                transfer.missing_etags,
+                stats.paths,
+                threads,
+                sync_filter,
+            )
+        return stats
+
+    @staticmethod
+    def _etag_chunksize(profile, codec, local_file, remote_file):
+        # Part size that gives local_file the ETag of remote_file if their contents match,
+        # None if the ETag can't be compared because the object is compressed or its parts are unknown
+        if codec is not None and codec.eligible(local_file.path, local_file.size):
+            return None
+        return hash_chunksize(
+            remote_file.etag, local_file.size, profile.chunksize(local_file.size)
+        )
+
+    def _mirror_remote(self, manifest, index, items, dryrun, callback):
+        # Remove the remote files that are not in the local folder, given as
+        # (relative path, key, bundled), yielding the (relative path, key) of
+        # each object to delete
+        for rel_path, key, bundled in items:
+            if bundled:
+                # Bundled files are dropped from the manifest, the bundle
+                # itself is deleted once none of its files are left
+                if not dryrun:
+                    manifest.discard(rel_path)
+                    if index is not None:
+                        index.discard(rel_path)
+                if callback is not None:
+                    callback(None, self._s3_to_epic_path(key), not dryrun, dryrun)
+            else:
+                if not dryrun:
+                    manifest.discard(rel_path)
+                yield rel_path, key
+
+    def _update_index_etags(
+        self, index, s3_prefix, missing, paths, threads, sync_filter=None
+    ):
+        # ETags of uploaded files are not returned by upload_file. A few uploads
+        # are checked with a HEAD each, but when that would take more requests
+        # than listing the folder they all come from a single listing instead.
+        if missing is not None and len(missing) <= max(1, paths // 1000):
+            keys = {key: rel_path for rel_path, key in missing}
+            for key, head in head_objects(
+                self._s3_client, self._s3_bucket, iter(keys), threads=threads
+            ):
+                if head is not None:
+                    index.update_etag(keys[key], head["ETag"])
+            return
+        unknown = (
+            (rel_path, entry)
+            for rel_path, entry in index.iter_entries()
+            if entry.etag is None
+        )
+        first = next(unknown, None)
+        if first is None:
+            return
+        remote = self._remote_stream(s3_prefix, sync_filter)
+        for rel_path, (entry, remote_file) in merge_sorted(
+            itertools.chain([first], unknown), remote
+        ):
+            if entry is not None and remote_file is not None:
+                index.update_etag(rel_path, remote_file.etag)
+
+
+class _Batches(object):
+    """Groups items into batches that are submitted to a :class:`pyepic.client.transfer.WorkerPool` as each one fills up.
+    A batch is full when it holds max_items items or the next item would take the total size over max_size.
+
+    :param pool: Pool the batches are submitted to
+    :type pool: :class:`pyepic.client.transfer.WorkerPool`
+    :param stats: Stats that count the submitted batches
+    :type stats: :class:`pyepic.client.sync.SyncStats`
+    :param max_items: Maximum number of items in a batch
+    :type max_items: int, optional
+    :param max_size: Maximum total size of the items in a batch
+    :type max_size: int, optional
+    :param size: Callable that returns the size of an item
+    :type size: method, optional
+    :param name: Callable that generates a name for each batch, if given batches are submitted as (name, batch)
+    :type name: method, optional
+    """
+
+    def __init__(
+        self, pool, stats, max_items=None, max_size=None, size=None, name=None
+    ):
+        """Constructor method"""
+        self._pool = pool
+        self._stats = stats
+        self._max_items = max_items
+        self._max_size = max_size
+        self._size = size
+        self._name = name
+        self._batch = []
+        self._batch_size = 0
+
+    def add(self, item):
+        """Add an item, submitting the current batch first if the item does not fit"""
+        item_size = self._size(item) if self._size is not None else 0
+        if self._batch and (
+            (self._max_items is not None and len(self._batch) >= self._max_items)
+            or (
+                self._max_size is not None
+                and self._batch_size + item_size > self._max_size
+            )
+        ):
+            self.flush()
+        self._batch.append(item)
+        self._batch_size += item_size
+
+    def flush(self):
+        """Submit the current batch if it is not empty"""
+        if not self._batch:
+            return
+        batch = self._batch
+        self._batch = []
+        self._batch_size = 0
+        self._stats.submit(
+            self._pool, (self._name(), batch) if self._name is not None else batch
+        )
+
+
+class _Spool(object):
+    """Items written to a temporary file to be read back later, so that work deferred to the end of a sync
+    does not hold every item in memory. Items are tuples of strings, numbers and booleans.
+    """
+
+    def __init__(self):
+        """Constructor method"""
+        self._file = tempfile.TemporaryFile("w+", encoding="utf-8")
+
+    def add(self, item):
+        """Append an item"""
+        self._file.write(json.dumps(item))
+        self._file.write("\n")
+
+    def __iter__(self):
+        self._file.seek(0)
+        for line in self._file:
+            yield tuple(json.loads(line))
+
+    def close(self):
+        """Remove the temporary file"""
+        self._file.close()
@@ -0,0 +1,328 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from botocore.exceptions import ClientError
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Full
+import threading
+
+DiskUsage = namedtuple("DiskUsage", ["size", "files", "folders"])
+DiskUsage.__doc__ = """Totals for a folder and everything below it
+
+:param size: Total size of the files in bytes
+:param files: Number of files
+:param folders: Number of folders
+"""
+
+FileMetaData = namedtuple("FileMetaData", ["path", "meta_data", "size", "etag"])
+FileMetaData.__doc__ = """Meta-data of a file in EPIC
+
+:param path: Path of the file in the form epic://[<folder>]/<file>
+:param meta_data: Dictionary of the file's meta-data, None if it was not fetched or the file does not exist
+:param size: Size of the file in bytes, None if the file does not exist
+:param etag: ETag of the file, None if the file does not exist
+"""
+
+
+class ListingTree(object):
+    """Folder tree built in memory from a flat (non-delimited) listing of a prefix.
+
+    :param pages: Pages returned by the list_objects_v2 paginator
+    :type pages: iterable
+    :param s3_prefix: Prefix the pages were listed with, must end in "/"
+    :type s3_prefix: str
+
+    :var folders: Dictionary of relative folder path ("" for the root, otherwise ending in "/") to a tuple of the set of sub-folder names and the list of listed objects
+    :vartype folders: dict
+    """
+
+    def __init__(self, pages, s3_prefix):
+        """Constructor method"""
+        self.s3_prefix = s3_prefix
+        self.folders = {"": (set(), [])}
+        for page in pages:
+            for s3_obj in page.get("Contents", []):
+                rel_path = s3_obj["Key"][len(s3_prefix) :]
+                if not rel_path:
+                    continue
+                folder = self._add_folder(rel_path[: rel_path.rfind("/") + 1])
+                if not rel_path.endswith("/"):
+                    folder[1].append(s3_obj)
+
+    def _add_folder(self, rel_folder):
+        folder = self.folders.get(rel_folder)
+        if folder is None:
+            folder = self.folders[rel_folder] = (set(), [])
+            name_start = rel_folder.rfind("/", 0, len(rel_folder) - 1) + 1
+            parent = self._add_folder(rel_folder[:name_start])
+            parent[0].add(rel_folder[name_start:-1])
+        return folder
+
+    def __len__(self):
+        return sum(len(files) for _, files in self.folders.values())
+
+    def walk(self):
+        """
+        Walk the tree top-down in the style of os.walk
+            :return: Iterable of (relative folder path, sorted sub-folder names, listed objects)
+            :rtype: collections.Iterable[tuple]
+        """
+        pending = [""]
+        while pending:
+            rel_folder = pending.pop()
+            sub_folders, files = self.folders[rel_folder]
+            names = sorted(sub_folders)
+            yield rel_folder, names, files
+            pending.extend(rel_folder + name + "/" for name in reversed(names))
+
+    def usage(self):
+        """
+        Total the sizes and counts of every folder, including everything below it
+            :return: Dictionary of relative folder path to DiskUsage
+            :rtype: dict
+        """
+        totals = {}
+        # Deepest folders first so children are totalled before their parents
+        for rel_folder in sorted(
+            self.folders, key=lambda p: p.count("/"), reverse=True
+        ):
+            sub_folders, files = self.folders[rel_folder]
+            size = sum(s3_obj["Size"] for s3_obj in files)
+            count = len(files)
+            folders = len(sub_folders)
+            for name in sub_folders:
+                child = totals[rel_folder + name + "/"]
+                size += child.size
+                count += child.files
+                folders += child.folders
+            totals[rel_folder] = DiskUsage(size, count, folders)
+        return totals
+
+
+class ShardedLister(object):
+    """Lists every object below a prefix, splitting large prefixes into shards that are listed concurrently.
+
+    The first page is listed as normal, so small prefixes cost a single request. If there are more
+    objects the rest of the prefix is split into its child folders with delimited listings, going up to
+    max_depth folders deep until there are at least as many shards as threads. The shards are listed
+    on threads and the pages are merged back into a single stream in key order.
+    Folders holding more than a page of files directly are not split further.
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: Bucket to list
+    :type bucket_name: str
+    :param threads: Number of shards listed at once
+    :type threads: int, optional
+    :param max_depth: Number of folder levels to split into shards
+    :type max_depth: int, optional
+    :param queued_pages: Number of pages each shard can list ahead of the reader
+    :type queued_pages: int, optional
+    """
+
+    _END = object()
+
+    def __init__(self, s3_client, bucket_name, threads=8, max_depth=3, queued_pages=4):
+        """Constructor method"""
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self.threads = threads
+        self.max_depth = max_depth
+        self.queued_pages = queued_pages
+
+    def pages(self, s3_prefix):
+        """
+        List the objects below s3_prefix
+            :param s3_prefix: Prefix to list
+            :type s3_prefix: str
+
+            :return: Iterable of list_objects_v2 pages, in key order
+            :rtype: collections.Iterable[dict]
+        """
+        first = self._s3_client.list_objects_v2(
+            Bucket=self._bucket_name, Prefix=s3_prefix
+        )
+        yield first
+        if not first.get("IsTruncated"):
+            return
+        start_after = first["Contents"][-1]["Key"]
+        files, shards = self._split(s3_prefix, start_after, 1)
+        if shards is None:
+            # Too many files directly below the prefix to split it
+            files, shards = [], [s3_prefix]
+        # Every file and shard covers a separate range of keys, so sorting
+        # them by key and prefix gives the order of the keys
+        units = sorted(
+            [(s3_obj["Key"], s3_obj) for s3_obj in files]
+            + [(shard, None) for shard in shards],
+            key=lambda unit: unit[0],
+        )
+        queues = [Queue(self.queued_pages) for _ in shards]
+        stop = threading.Event()
+        self._start_workers(shards, queues, start_after, stop)
+        try:
+            pending = []
+            shard_index = 0
+            for key, s3_obj in units:
+                if s3_obj is not None:
+                    pending.append(s3_obj)
+                    continue
+                if pending:
+                    yield {"Contents": pending, "KeyCount": len(pending)}
+                    pending = []
+                for page in self._drain(queues[shard_index]):
+                    yield page
+                shard_index += 1
+            if pending:
+                yield {"Contents": pending, "KeyCount": len(pending)}
+        finally:
+            stop.set()
+
+    def _split(self, s3_prefix, start_after, depth):
+        # Returns the files directly below s3_prefix and the shards for its sub-folders,
+        # or None for the shards if s3_prefix should not be split
+        files = []
+        shards = []
+        paginator = self._s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+            Bucket=self._bucket_name, Prefix=s3_prefix, Delimiter="/"
+        ):
+            # Skip everything already returned in the first page. StartAfter is not
+            # used here as it can hide the folder holding the start_after key.
+            files.extend(o for o in page.get("Contents", []) if o["Key"] > start_after)
+            if len(files) > 1000:
+                return [], None
+            shards.extend(
+                p["Prefix"]
+                for p in page.get("CommonPrefixes", [])
+                if p["Prefix"] > start_after or start_after.startswith(p["Prefix"])
+            )
+        if depth < self.max_depth and 0 < len(shards) < self.threads:
+            expanded = []
+            for shard in shards:
+                shard_files, shard_shards = self._split(shard, start_after, depth + 1)
+                if shard_shards is None:
+                    expanded.append(shard)
+                else:
+                    files.extend(shard_files)
+                    expanded.extend(shard_shards)
+            shards = expanded
+        return files, shards
+
+    def _start_workers(self, shards, queues, start_after, stop):
+        next_shard = iter(range(len(shards)))
+        lock = threading.Lock()
+
+        def put(queue, item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def run():
+            paginator = self._s3_client.get_paginator("list_objects_v2")
+            while not stop.is_set():
+                with lock:
+                    index = next(next_shard, None)
+                if index is None:
+                    return
+                try:
+                    for page in paginator.paginate(
+                        Bucket=self._bucket_name,
+                        Prefix=shards[index],
+                        StartAfter=start_after,
+                    ):
+                        if page.get("KeyCount", 0) and not put(queues[index], page):
+                            return
+                except Exception as e:
+                    put(queues[index], e)
+                    return
+                put(queues[index], self._END)
+
+        for i in range(min(self.threads, len(shards))):
+            t = threading.Thread(target=run)
+            t.daemon = True
+            t.start()
+
+    def _drain(self, queue):
+        while True:
+            item = queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def head_objects(s3_client, bucket_name, keys, threads=8):
+    """
+    HEAD a stream of objects concurrently, keeping them in order.
+    Only a few requests per thread are in flight or waiting to be returned at once.
+        :param s3_client: boto3 S3 client
+        :param bucket_name: Bucket containing the objects
+        :type bucket_name: str
+        :param keys: Keys of the objects
+        :type keys: iterable
+        :param threads: Number of concurrent requests
+        :type threads: int, optional
+
+        :return: Iterable of (key, head_object response or None if the object does not exist)
+        :rtype: collections.Iterable[tuple]
+    """
+
+    def head(key):
+        try:
+            return s3_client.head_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    window = threads * 4
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        for key in keys:
+            pending.append((key, executor.submit(head, key)))
+            while pending and (len(pending) > window or pending[0][1].done()):
+                key, future = pending.popleft()
+                yield key, future.result()
+        while pending:
+            key, future = pending.popleft()
+            yield key, future.result()
+    finally:
+        for key, future in pending:
+            future.cancel()
+        executor.shutdown()
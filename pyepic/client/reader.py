@@ -0,0 +1,238 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import OrderedDict
+import io
+import threading
+
+from .codec import object_codec
+from .transfer import MB, read_into
+
+
+class RemoteFileReader(io.RawIOBase):
+    """Read-only, seekable file-like object for a file in EPIC.
+    Files that were compressed on upload cannot be opened and raise a ValueError.
+    Data is fetched with ranged requests in fixed size blocks that are kept in an LRU cache.
+    When the file is read sequentially the following blocks are fetched in the same request.
+
+    :param s3_client: boto3 S3 client
+    :param bucket_name: Bucket containing the file
+    :type bucket_name: str
+    :param key_name: Key of the file
+    :type key_name: str
+    :param block_size: Size in bytes of each cached block
+    :type block_size: int, optional
+    :param cache_blocks: Maximum number of blocks kept in the cache
+    :type cache_blocks: int, optional
+    :param readahead: Number of extra blocks fetched when reading sequentially
+    :type readahead: int, optional
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        bucket_name,
+        key_name,
+        block_size=1 * MB,
+        cache_blocks=64,
+        readahead=4,
+    ):
+        """Constructor method"""
+        super().__init__()
+        if block_size < 1 or cache_blocks < 1:
+            raise ValueError("block_size and cache_blocks must be at least 1")
+        self._s3_client = s3_client
+        self._bucket_name = bucket_name
+        self.name = key_name
+        self._block_size = block_size
+        self._cache_blocks = cache_blocks
+        self._readahead = min(readahead, cache_blocks - 1)
+        head = s3_client.head_object(Bucket=bucket_name, Key=key_name)
+        if object_codec(head["Metadata"]) is not None:
+            # Ranges of a compressed stream cannot be decompressed on their own
+            raise ValueError(
+                "{} is compressed and cannot be opened for random access, use download_file or read_bytes".format(
+                    key_name
+                )
+            )
+        self.size = head["ContentLength"]
+        self._etag = head["ETag"]
+        self._pos = 0
+        self._last_block = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast("B")
+        length = min(len(view), max(0, self.size - self._pos))
+        written = 0
+        while written < length:
+            block_index, offset = divmod(self._pos, self._block_size)
+            block = self._get_block(block_index)
+            count = min(len(block) - offset, length - written)
+            view[written : written + count] = block[offset : offset + count]
+            written += count
+            self._pos += count
+        return written
+
+    def _get_block(self, block_index):
+        with self._lock:
+            block = self._cache.get(block_index)
+            if block is not None:
+                self._cache.move_to_end(block_index)
+                self._last_block = block_index
+                return block
+            count = 1
+            if self._last_block is not None and block_index == self._last_block + 1:
+                count += self._readahead
+            last_index = (self.size - 1) // self._block_size
+            count = min(count, last_index - block_index + 1)
+            # Stop the readahead at the first block that is already cached
+            for i in range(1, count):
+                if block_index + i in self._cache:
+                    count = i
+                    break
+            self._fetch(block_index, count)
+            self._last_block = block_index
+            return self._cache[block_index]
+
+    def _fetch(self, block_index, count):
+        start = block_index * self._block_size
+        end = min(start + count * self._block_size, self.size)
+        buffer = bytearray(end - start)
+        response = self._s3_client.get_object(
+            Bucket=self._bucket_name,
+            Key=self.name,
+            Range="bytes={}-{}".format(start, end - 1),
+            IfMatch=self._etag,
+        )
+        read_into(response["Body"], memoryview(buffer))
+        view = memoryview(buffer)
+        for i in range(count):
+            block_start = i * self._block_size
+            self._cache[block_index + i] = view[
+                block_start : block_start + self._block_size
+            ]
+            self._cache.move_to_end(block_index + i)
+        while len(self._cache) > self._cache_blocks:
+            self._cache.popitem(last=False)
+
+    def close(self):
+        self._cache.clear()
+        super().close()
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only, seekable file-like object over a buffer held in memory.
+    The buffer is wrapped in a memoryview rather than copied, so it can be passed to
+    boto3 in place of a file. Each read returns a copy of just the bytes read.
+
+    :param data: Object supporting the buffer protocol, such as bytes, bytearray, memoryview or a C-contiguous NumPy array
+    """
+
+    def __init__(self, data):
+        """Constructor method"""
+        super().__init__()
+        self._view = memoryview(data).cast("B")
+        self.size = len(self._view)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        self._checkClosed()
+        start = min(self._pos, self.size)
+        end = self.size if size is None or size < 0 else min(start + size, self.size)
+        self._pos = end
+        return self._view[start:end].tobytes()
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast("B")
+        start = min(self._pos, self.size)
+        count = min(len(view), self.size - start)
+        view[:count] = self._view[start : start + count]
+        self._pos = start + count
+        return count
+
+    def close(self):
+        self._view.release()
+        super().close()
@@ -0,0 +1,621 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import namedtuple
+import os
+import re
+import sys
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+LocalFile = namedtuple("LocalFile", ["path", "size", "mtime"])
+LocalFile.__doc__ = """A file found by walking a local folder
+
+:param path: Full local path of the file
+:param size: Size of the file in bytes
+:param mtime: Modification time of the file as a POSIX timestamp
+"""
+
+RemoteFile = namedtuple("RemoteFile", ["key", "size", "etag", "last_modified"])
+RemoteFile.__doc__ = """An object found by listing an S3 prefix
+
+:param key: Full S3 key of the object
+:param size: Size of the object in bytes
+:param etag: ETag reported by S3
+:param last_modified: Last modified time of the object as a POSIX timestamp
+"""
+
+
+class SyncStats(object):
+    """Progress of a sync and the state of its pipeline.
+    A sync streams its listings through the planner into the bounded queues of its worker pools,
+    so the stats can be read from another thread while the sync is running to check that it is keeping up.
+
+    :ivar paths: Number of paths compared so far
+    :ivar submitted: Number of transfers and deletions queued for the workers
+    :ivar max_queue_depth: Largest number of items seen waiting in the queues at once
+    :ivar skipped: Keys that were not downloaded because they cannot be used as local paths
+    """
+
+    def __init__(self):
+        """Constructor method"""
+        self.paths = 0
+        self.submitted = 0
+        self.max_queue_depth = 0
+        self.skipped = []
+        self._pools = []
+        self._lock = threading.Lock()
+
+    def watch(self, pool):
+        """Include the queue of a :class:`pyepic.client.transfer.WorkerPool` in the queue depth"""
+        with self._lock:
+            self._pools.append(pool)
+        return pool
+
+    def unwatch(self, pool):
+        """Stop including the queue of a pool in the queue depth"""
+        with self._lock:
+            self._pools.remove(pool)
+
+    @property
+    def queue_depth(self):
+        """Number of items currently waiting in the queues of the watched pools"""
+        with self._lock:
+            return sum(pool.queued for pool in self._pools)
+
+    @property
+    def peak_memory(self):
+        """Peak resident memory of the process in bytes, None where it can not be measured"""
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Reported in bytes on macOS and kilobytes elsewhere
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def path(self):
+        """Count a compared path and sample the queue depth"""
+        self.paths += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def submit(self, pool, item):
+        """
+        Queue an item with pool.submit and count it
+            :return: False if the pool has been cancelled and the item was not queued
+            :rtype: bool
+        """
+        if not pool.submit(item):
+            return False
+        self.submitted += 1
+        return True
+
+    def __repr__(self):
+        return (
+            "SyncStats(paths={}, submitted={}, queue_depth={}, "
+            "max_queue_depth={}, peak_memory={})".format(
+                self.paths,
+                self.submitted,
+                self.queue_depth,
+                self.max_queue_depth,
+                self.peak_memory,
+            )
+        )
+
+
+def glob_to_regex(pattern):
+    """
+    Compile a glob pattern for matching "/" separated paths.
+    Unlike fnmatch "*" and "?" do not match "/", while "**" matches any number of folders.
+        :param pattern: Glob pattern
+        :type pattern: str
+
+        :return: Compiled regular expression that must match the whole path
+        :rtype: :class:`re.Pattern`
+    """
+    i = 0
+    regex = []
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            regex.append("[^/]*")
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            chars = pattern[i + 1 : end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            regex.append("[" + chars + "]")
+            i = end
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return re.compile("".join(regex) + r"\Z")
+
+
+class _Rule(object):
+    def __init__(self, pattern):
+        self.dir_only = False
+        if isinstance(pattern, str):
+            self.dir_only = pattern.endswith("/")
+            pattern = pattern.strip("/")
+            # Patterns containing a "/" are matched against the whole path,
+            # others against the file or folder name at any depth
+            self.anchored = "/" in pattern
+            self.regex = glob_to_regex(pattern)
+            self.search = self.regex.match
+            wildcard = re.search(r"[*?\[]", pattern)
+            literal = pattern[: wildcard.start()] if wildcard else pattern
+            if self.anchored and self.dir_only and not wildcard:
+                # Only this folder can contain the files the rule includes
+                self.literal_dir = literal + "/"
+            elif self.anchored:
+                self.literal_dir = literal[: literal.rfind("/") + 1]
+            else:
+                self.literal_dir = ""
+        else:
+            # Precompiled regular expressions are searched for in the whole path
+            self.anchored = True
+            self.regex = pattern
+            self.search = pattern.search
+            self.literal_dir = ""
+
+    def matches(self, rel_path, is_dir=False):
+        if self.dir_only and not is_dir:
+            return False
+        if self.anchored:
+            return self.search(rel_path) is not None
+        return self.search(rel_path.rsplit("/", 1)[-1]) is not None
+
+    def matches_parent(self, rel_dir):
+        # Does the rule match rel_dir, ending in "/", or any of its parent folders?
+        end = rel_dir.find("/")
+        while end != -1:
+            if self.matches(rel_dir[:end], True):
+                return True
+            end = rel_dir.find("/", end + 1)
+        return False
+
+
+class SyncFilter(object):
+    """Include and exclude rules for sync.
+
+    Rules are glob patterns or precompiled regular expressions (re.compile).
+    Glob patterns without a "/" match a file or folder name at any depth, patterns with a "/" match the
+    path relative to the synced folder. "*" and "?" do not match "/" while "**" matches any number of folders.
+    A trailing "/" only matches folders, so an include rule ending in "/" includes every file below the
+    folders it matches. Regular expressions are searched for in the relative path.
+
+    Excluded folders are not walked or listed at all. If include rules are given only files matching
+    at least one of them are synced, and folders that cannot contain a match are not walked.
+
+    :param include: Rules for the files to sync
+    :type include: list, optional
+    :param exclude: Rules for the files and folders to skip
+    :type exclude: list, optional
+    :param always_include: Relative path prefixes that are never filtered
+    :type always_include: list, optional
+    """
+
+    def __init__(self, include=None, exclude=None, always_include=()):
+        """Constructor method"""
+        self._include = [_Rule(p) for p in include] if include else []
+        self._exclude = [_Rule(p) for p in exclude] if exclude else []
+        self._always_include = tuple(always_include)
+        self._dir_cache = {}
+        self._included_dirs = {}
+
+    def _kept(self, rel_path):
+        return bool(self._always_include) and rel_path.startswith(self._always_include)
+
+    def _excluded(self, rel_path, is_dir):
+        return any(rule.matches(rel_path, is_dir) for rule in self._exclude)
+
+    def prune(self, rel_dir):
+        """
+        Should the folder rel_dir be skipped?
+            :param rel_dir: Relative path of a folder, ending in "/"
+            :type rel_dir: str
+
+            :rtype: bool
+        """
+        if self._kept(rel_dir):
+            return False
+        if self._excluded(rel_dir.rstrip("/"), True):
+            return True
+        if not self._include:
+            return False
+        for rule in self._include:
+            literal_dir = rule.literal_dir
+            if literal_dir.startswith(rel_dir) or rel_dir.startswith(literal_dir):
+                return False
+        return True
+
+    def _excluded_parent(self, rel_path):
+        # Listings are not walked folder by folder so check every parent folder,
+        # caching the result for each one
+        rel_dir = rel_path[: rel_path.rfind("/", 0, len(rel_path) - 1) + 1]
+        if not rel_dir:
+            return False
+        excluded = self._dir_cache.get(rel_dir)
+        if excluded is None:
+            excluded = self._excluded_parent(rel_dir) or self._excluded(
+                rel_dir.rstrip("/"), True
+            )
+            self._dir_cache[rel_dir] = excluded
+        return excluded
+
+    def match(self, rel_path, check_parents=False):
+        """
+        Should the file rel_path be synced?
+            :param rel_path: Path relative to the synced folder
+            :type rel_path: str
+            :param check_parents: Also check whether any parent folder is excluded
+            :type check_parents: bool, optional
+
+            :rtype: bool
+        """
+        if self._kept(rel_path):
+            return True
+        if check_parents and self._excluded_parent(rel_path):
+            return False
+        if rel_path.endswith("/"):
+            # Folder marker object
+            return not self._include and not self._excluded(rel_path[:-1], True)
+        if self._excluded(rel_path, False):
+            return False
+        if not self._include:
+            return True
+        if any(rule.matches(rel_path) for rule in self._include):
+            return True
+        return self._included_parent(rel_path)
+
+    def _included_parent(self, rel_path):
+        # Is any parent folder matched by a folder include rule? Cached for each folder
+        rel_dir = rel_path[: rel_path.rfind("/") + 1]
+        if not rel_dir:
+            return False
+        included = self._included_dirs.get(rel_dir)
+        if included is None:
+            included = any(
+                rule.matches_parent(rel_dir) for rule in self._include if rule.dir_only
+            )
+            self._included_dirs[rel_dir] = included
+        return included
+
+    def list_prefixes(self):
+        """
+        Relative prefixes that need to be listed to find every file that can match
+            :return: List of relative prefixes, [""] if the whole folder must be listed
+            :rtype: List[str]
+        """
+        if not self._include or any(not r.literal_dir for r in self._include):
+            return [""]
+        prefixes = set(r.literal_dir for r in self._include)
+        prefixes.update(self._always_include)
+        return sorted(
+            p for p in prefixes if not any(p != q and p.startswith(q) for q in prefixes)
+        )
+
+
+# Longest file or folder name allowed by common file systems, in bytes
+NAME_MAX = 255
+_WINDOWS_INVALID = re.compile(r'[<>:"\\|?*\x00-\x1f]')
+_WINDOWS_RESERVED = frozenset(
+    ["CON", "PRN", "AUX", "NUL"]
+    + ["COM%d" % i for i in range(1, 10)]
+    + ["LPT%d" % i for i in range(1, 10)]
+)
+
+
+def valid_local_path(rel_path):
+    """
+    Check that a relative "/" separated path from a key can be used as a local path, without touching the file system.
+    Paths with empty, "." or ".." components, NUL characters or names that are too long are rejected,
+    and on Windows so are reserved names and characters.
+        :param rel_path: Path relative to the synced folder, folders end in "/"
+        :type rel_path: str
+
+        :rtype: bool
+    """
+    names = rel_path[:-1].split("/") if rel_path.endswith("/") else rel_path.split("/")
+    for name in names:
+        if name in ("", ".", "..") or "\x00" in name:
+            return False
+        if len(name.encode("utf-8", "surrogateescape")) > NAME_MAX:
+            return False
+        if os.name == "nt" and (
+            _WINDOWS_INVALID.search(name)
+            or name.split(".")[0].upper() in _WINDOWS_RESERVED
+            or name[-1] in ". "
+        ):
+            return False
+    return True
+
+
+def _scan_folder(local_root, rel_dir, sync_filter):
+    # Names in a folder in S3 key order, folders sort as if they end with "/"
+    try:
+        entries = os.scandir(os.path.join(local_root, rel_dir))
+    except OSError:
+        return []
+    names = []
+    with entries:
+        for entry in entries:
+            rel_path = rel_dir + entry.name
+            try:
+                if entry.is_dir():
+                    # Like os.walk, symlinked folders are not descended
+                    if entry.is_symlink():
+                        continue
+                    if sync_filter is None or not sync_filter.prune(rel_path + "/"):
+                        names.append(entry.name + "/")
+                    continue
+            except OSError:
+                continue
+            if sync_filter is None or sync_filter.match(rel_path):
+                names.append(entry.name)
+    names.sort()
+    return names
+
+
+def walk_local(local_root, sync_filter=None):
+    """
+    Walk every file below local_root in the order S3 lists their keys.
+    Only the names in the folders on the current path are held in memory, files are stat'ed as they are yielded.
+        :param local_root: Folder to walk
+        :type local_root: str
+        :param sync_filter: Rules for the files and folders to include
+        :type sync_filter: :class:`SyncFilter`, optional
+
+        :return: Iterable of (relative "/" separated path, LocalFile) sorted by path
+        :rtype: collections.Iterable[tuple]
+    """
+    stack = [("", iter(_scan_folder(local_root, "", sync_filter)))]
+    while stack:
+        rel_dir, names = stack[-1]
+        name = next(names, None)
+        if name is None:
+            stack.pop()
+            continue
+        rel_path = rel_dir + name
+        if name.endswith("/"):
+            stack.append(
+                (rel_path, iter(_scan_folder(local_root, rel_path, sync_filter)))
+            )
+            continue
+        path = os.path.join(local_root, *rel_path.split("/"))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        yield rel_path, LocalFile(path, stat.st_size, stat.st_mtime)
+
+
+def iter_remote(pages, s3_prefix, sync_filter=None):
+    """
+    Iterate over the objects in a list_objects_v2 page iterator.
+        :param pages: Pages returned by the list_objects_v2 paginator
+        :type pages: iterable
+        :param s3_prefix: Prefix of the synced folder
+        :type s3_prefix: str
+        :param sync_filter: Rules for the objects to include
+        :type sync_filter: :class:`SyncFilter`, optional
+
+        :return: Iterable of (key relative to s3_prefix, RemoteFile) in listing order
+        :rtype: collections.Iterable[tuple]
+    """
+    for page in pages:
+        for s3_obj in page.get("Contents", []):
+            key = s3_obj["Key"]
+            rel_path = key[len(s3_prefix) :]
+            if sync_filter is not None and not sync_filter.match(
+                rel_path, check_parents=True
+            ):
+                continue
+            yield rel_path, RemoteFile(
+                key,
+                s3_obj["Size"],
+                s3_obj["ETag"],
+                s3_obj["LastModified"].timestamp(),
+            )
+
+
+def merge_sorted(*streams):
+    """
+    Join several streams of (relative path, value) on their paths. Every stream must be sorted by path,
+    as produced by walk_local, iter_remote and S3 listings, so only the current item of each stream is held in memory.
+        :param streams: Iterables of (relative path, value) sorted by path, dictionaries are sorted first
+        :type streams: iterable
+
+        :return: Iterable of (relative path, list of the value from each stream or None) sorted by path
+        :rtype: collections.Iterable[tuple]
+    """
+    iters = [
+        iter(sorted(s.items())) if isinstance(s, dict) else iter(s) for s in streams
+    ]
+    heads = [next(it, None) for it in iters]
+    while True:
+        current = min((head[0] for head in heads if head is not None), default=None)
+        if current is None:
+            return
+        values = []
+        for i, head in enumerate(heads):
+            if head is None or head[0] != current:
+                values.append(None)
+                continue
+            values.append(head[1])
+            heads[i] = next(iters[i], None)
+            if heads[i] is not None and heads[i][0] <= current:
+                raise ValueError("Paths are not in sorted order: %s" % heads[i][0])
+        yield current, values
+
+
+def _unchanged(local_file, entry):
+    return (
+        entry is not None
+        and local_file.size == entry.size
+        and local_file.mtime == entry.mtime
+    )
+
+
+def plan_upload(local, remote, overwrite_existing=False, index=None, checksum=False):
+    """
+    Join a local and a remote listing and decide which files to upload.
+    If an index of the previous sync is given then files that have not changed
+    on either side since they were last synced are skipped without comparing timestamps.
+        :param local: Files from walk_local
+        :type local: iterable
+        :param remote: Objects from iter_remote
+        :type remote: iterable
+        :param overwrite_existing: Upload files that are newer than the existing remote copy
+        :type overwrite_existing: bool, optional
+        :param index: Entries from a SyncIndex
+        :type index: iterable, optional
+        :param checksum: Don't compare timestamps, every file that differs from an existing remote copy is an upload candidate to be checked against its hash
+        :type checksum: bool, optional
+
+        :return: Iterable of (relative path, LocalFile, RemoteFile, upload required) sorted by path. The LocalFile is None for objects that only exist remotely.
+        :rtype: collections.Iterable[tuple]
+    """
+    for rel_path, (local_file, remote_file, entry) in merge_sorted(
+        local, remote, index if index is not None else ()
+    ):
+        if local_file is None:
+            if remote_file is not None:
+                yield rel_path, None, remote_file, False
+        elif remote_file is None:
+            yield rel_path, local_file, None, True
+        elif _unchanged(local_file, entry):
+            # Either both copies are in sync or the remote copy is newer
+            yield rel_path, local_file, remote_file, False
+        elif entry is not None and entry.etag == remote_file.etag:
+            # Only the local copy has changed since the last sync
+            yield rel_path, local_file, remote_file, overwrite_existing
+        elif overwrite_existing and (
+            checksum or local_file.mtime > remote_file.last_modified
+        ):
+            yield rel_path, local_file, remote_file, True
+        else:
+            yield rel_path, local_file, remote_file, False
+
+
+def plan_download(remote, local, overwrite_existing=False, index=None, checksum=False):
+    """
+    Join a remote and a local listing and decide which objects to download.
+    Folder marker objects (keys ending in "/") are never downloaded.
+    If an index of the previous sync is given then files that have not changed
+    on either side since they were last synced are skipped without comparing timestamps.
+        :param remote: Objects from iter_remote
+        :type remote: iterable
+        :param local: Files from walk_local
+        :type local: iterable
+        :param overwrite_existing: Download objects that are newer than the existing local copy
+        :type overwrite_existing: bool, optional
+        :param index: Entries from a SyncIndex
+        :type index: iterable, optional
+        :param checksum: Don't compare timestamps, every object that differs from an existing local copy is a download candidate to be checked against its hash
+        :type checksum: bool, optional
+
+        :return: Iterable of (relative path, RemoteFile, LocalFile, download required) sorted by path. The RemoteFile is None for files that only exist locally.
+        :rtype: collections.Iterable[tuple]
+    """
+    for rel_path, (remote_file, local_file, entry) in merge_sorted(
+        remote, local, index if index is not None else ()
+    ):
+        if remote_file is None:
+            if local_file is not None:
+                yield rel_path, None, local_file, False
+        elif rel_path.endswith("/") or rel_path == "":
+            yield rel_path, remote_file, local_file, False
+        elif local_file is None:
+            yield rel_path, remote_file, None, True
+        elif _unchanged(local_file, entry):
+            # Either both copies are in sync or only the remote copy has changed
+            yield rel_path, remote_file, local_file, (
+                overwrite_existing and entry.etag != remote_file.etag
+            )
+        elif entry is not None and entry.etag == remote_file.etag:
+            # Only the local copy has changed since the last sync
+            yield rel_path, remote_file, local_file, False
+        elif overwrite_existing and (
+            checksum or remote_file.last_modified > local_file.mtime
+        ):
+            # Downloaded files are given the LastModified time of their object,
+            # so a file that has not changed since it was downloaded is skipped
+            yield rel_path, remote_file, local_file, True
+        else:
+            yield rel_path, remote_file, local_file, False
+
+
+def plan_copy(source, target, overwrite_existing=False):
+    """
+    Join the remote listings of two prefixes and decide which objects to copy.
+    Objects with the same size and ETag in both are never copied.
+        :param source: Objects from iter_remote of the source prefix
+        :type source: iterable
+        :param target: Objects from iter_remote of the target prefix
+        :type target: iterable
+        :param overwrite_existing: Copy objects that are newer than the existing target copy
+        :type overwrite_existing: bool, optional
+
+        :return: Iterable of (relative path, source RemoteFile, target RemoteFile, copy required) sorted by path. The source is None for objects that only exist in the target.
+        :rtype: collections.Iterable[tuple]
+    """
+    for rel_path, (source_file, target_file) in merge_sorted(source, target):
+        if source_file is None:
+            yield rel_path, None, target_file, False
+        elif target_file is None:
+            yield rel_path, source_file, None, True
+        elif (
+            target_file.etag == source_file.etag
+            and target_file.size == source_file.size
+        ):
+            yield rel_path, source_file, target_file, False
+        elif (
+            overwrite_existing and source_file.last_modified > target_file.last_modified
+        ):
+            yield rel_path, source_file, target_file, True
+        else:
+            yield rel_path, source_file, target_file, False
@@ -0,0 +1,310 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from collections import namedtuple
+import os
+import sqlite3
+import threading
+import time
+
+from .checksum import FileHash
+
+MultipartState = namedtuple(
+    "MultipartState", ["key", "upload_id", "size", "mtime", "chunksize", "parts"]
+)
+MultipartState.__doc__ = """A multipart upload started by an earlier sync
+
+:param key: S3 key being uploaded
+:param upload_id: Id of the multipart upload
+:param size: Size of the local file when the upload started
+:param mtime: Modification time of the local file when the upload started
+:param chunksize: Size in bytes of each part
+:param parts: Dictionary of completed part number to part ETag
+"""
+
+PartChecksums = namedtuple("PartChecksums", ["etag", "size", "chunksize", "checksums"])
+PartChecksums.__doc__ = """The parts of an object uploaded by an earlier sync
+
+:param etag: ETag of the object
+:param size: Size of the object in bytes
+:param chunksize: Size in bytes of each part
+:param checksums: List of the hex MD5 of each part in order
+"""
+
+IndexEntry = namedtuple("IndexEntry", ["size", "mtime", "etag", "synced"])
+IndexEntry.__doc__ = """The state of a file the last time it was synced
+
+:param size: Size of the local file in bytes
+:param mtime: Modification time of the local file as a POSIX timestamp
+:param etag: ETag of the remote object
+:param synced: Time the file was synced as a POSIX timestamp
+"""
+
+
+class SyncIndex(object):
+    """On-disk record of the files transferred between a local folder and an EPIC prefix.
+    The index is stored as a SQLite database in the root of the local folder.
+
+    Hashes of local files computed by checksum syncs are cached in the index as well.
+
+    The index also acts as a journal for resuming an interrupted sync. Recorded files are
+    committed to disk at least every COMMIT_INTERVAL seconds and the parts of large uploads
+    are committed as each one completes.
+
+    :param local_root: Local folder being synced
+    :type local_root: str
+    :param s3_prefix: S3 prefix the folder is synced with
+    :type s3_prefix: str
+    """
+
+    FILE_NAME = ".pyepic-sync.db"
+    COMMIT_INTERVAL = 5
+
+    def __init__(self, local_root, s3_prefix):
+        """Constructor method"""
+        self.path = os.path.join(local_root, self.FILE_NAME)
+        self.s3_prefix = s3_prefix
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "prefix TEXT NOT NULL, path TEXT NOT NULL, size INTEGER, mtime REAL, "
+            "etag TEXT, synced REAL, PRIMARY KEY (prefix, path))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "prefix TEXT NOT NULL, path TEXT NOT NULL, key TEXT, upload_id TEXT, "
+            "size INTEGER, mtime REAL, chunksize INTEGER, PRIMARY KEY (prefix, path))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS parts ("
+            "upload_id TEXT NOT NULL, part INTEGER NOT NULL, etag TEXT, "
+            "PRIMARY KEY (upload_id, part))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "prefix TEXT NOT NULL, path TEXT NOT NULL, etag TEXT, size INTEGER, "
+            "chunksize INTEGER, checksums TEXT, PRIMARY KEY (prefix, path))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT NOT NULL, chunksize INTEGER NOT NULL, size INTEGER, "
+            "mtime REAL, md5 TEXT, etag TEXT, PRIMARY KEY (path, chunksize))"
+        )
+        self._conn.commit()
+        self._last_commit = time.time()
+
+    @classmethod
+    def is_index_file(cls, rel_path):
+        """Is rel_path the index or one of its SQLite journal files?"""
+        return rel_path.startswith(cls.FILE_NAME)
+
+    def iter_entries(self, batch_size=1000):
+        """
+        Iterate over the index for this prefix in path order, loading batch_size entries at a time
+            :return: Iterable of (relative path, IndexEntry) sorted by path
+            :rtype: collections.Iterable[tuple]
+        """
+        last = ""
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT path, size, mtime, etag, synced FROM files "
+                    "WHERE prefix = ? AND path > ? ORDER BY path LIMIT ?",
+                    (self.s3_prefix, last, batch_size),
+                ).fetchall()
+            for row in rows:
+                yield row[0], IndexEntry(*row[1:])
+            if len(rows) < batch_size:
+                return
+            last = rows[-1][0]
+
+    def record(self, rel_path, size, mtime, etag):
+        """
+        Record that rel_path has been synced
+            :param rel_path: Path relative to the synced folder
+            :type rel_path: str
+            :param size: Size of the local file
+            :type size: int
+            :param mtime: Modification time of the local file
+            :type mtime: float
+            :param etag: ETag of the remote object, None if not yet known
+            :type etag: str
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (self.s3_prefix, rel_path, size, mtime, etag, time.time()),
+            )
+            self._checkpoint()
+
+    def update_etag(self, rel_path, etag):
+        """Set the remote ETag of a previously recorded file"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET etag = ? WHERE prefix = ? AND path = ?",
+                (etag, self.s3_prefix, rel_path),
+            )
+
+    def discard(self, rel_path):
+        """Remove rel_path from the index if present"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM files WHERE prefix = ? AND path = ?",
+                (self.s3_prefix, rel_path),
+            )
+            self._conn.execute(
+                "DELETE FROM blocks WHERE prefix = ? AND path = ?",
+                (self.s3_prefix, rel_path),
+            )
+
+    def part_checksums(self, rel_path):
+        """
+        Find the parts rel_path was last uploaded in
+            :return: The parts or None if rel_path was not uploaded in parts
+            :rtype: :class:`PartChecksums`
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT etag, size, chunksize, checksums FROM blocks "
+                "WHERE prefix = ? AND path = ?",
+                (self.s3_prefix, rel_path),
+            ).fetchone()
+        if row is None:
+            return None
+        return PartChecksums(*row[:3], checksums=row[3].split(","))
+
+    def record_part_checksums(self, rel_path, etag, size, chunksize, checksums):
+        """Record the parts of a completed multipart upload of rel_path"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?, ?)",
+                (self.s3_prefix, rel_path, etag, size, chunksize, ",".join(checksums)),
+            )
+            self._checkpoint()
+
+    def multipart_upload(self, rel_path):
+        """
+        Find the multipart upload of rel_path started by an earlier sync
+            :return: The upload or None if there is no unfinished upload
+            :rtype: :class:`MultipartState`
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, upload_id, size, mtime, chunksize FROM uploads "
+                "WHERE prefix = ? AND path = ?",
+                (self.s3_prefix, rel_path),
+            ).fetchone()
+            if row is None:
+                return None
+            parts = self._conn.execute(
+                "SELECT part, etag FROM parts WHERE upload_id = ?", (row[1],)
+            ).fetchall()
+        return MultipartState(*row, parts=dict(parts))
+
+    def start_multipart_upload(self, rel_path, key, upload_id, size, mtime, chunksize):
+        """Record the start of a multipart upload of rel_path"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.s3_prefix, rel_path, key, upload_id, size, mtime, chunksize),
+            )
+            self._conn.commit()
+
+    def record_part(self, upload_id, part_number, etag):
+        """Record a completed part of a multipart upload"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO parts VALUES (?, ?, ?)",
+                (upload_id, part_number, etag),
+            )
+            self._conn.commit()
+
+    def finish_multipart_upload(self, rel_path):
+        """Forget the multipart upload of rel_path once it is completed or aborted"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM parts WHERE upload_id IN "
+                "(SELECT upload_id FROM uploads WHERE prefix = ? AND path = ?)",
+                (self.s3_prefix, rel_path),
+            )
+            self._conn.execute(
+                "DELETE FROM uploads WHERE prefix = ? AND path = ?",
+                (self.s3_prefix, rel_path),
+            )
+            self._conn.commit()
+
+    def file_hash(self, rel_path, size, mtime, chunksize):
+        """
+        Find the cached hash of a local file
+            :return: The hash or None if the file has not been hashed since it last changed
+            :rtype: :class:`pyepic.client.checksum.FileHash`
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT md5, etag FROM hashes WHERE path = ? AND chunksize = ? "
+                "AND size = ? AND mtime = ?",
+                (rel_path, chunksize, size, mtime),
+            ).fetchone()
+        return FileHash(*row) if row is not None else None
+
+    def record_hash(self, rel_path, size, mtime, chunksize, file_hash):
+        """Cache the hash of a local file computed with chunksize"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (rel_path, chunksize, size, mtime, file_hash.md5, file_hash.etag),
+            )
+            self._checkpoint()
+
+    def _checkpoint(self):
+        # Called with the lock held
+        if time.time() - self._last_commit > self.COMMIT_INTERVAL:
+            self._conn.commit()
+            self._last_commit = time.time()
+
+    def commit(self):
+        """Write any recorded changes to disk"""
+        with self._lock:
+            self._conn.commit()
+            self._last_commit = time.time()
+
+    def close(self):
+        """Commit and close the index"""
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,867 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from contextlib import contextmanager
+import hashlib
+import io
+import mmap
+import os
+from queue import Queue, Full
+import secrets
+import threading
+import time
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# S3 multipart limits
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * MB
+MAX_PART_SIZE = 5 * GB
+# Largest number of keys accepted by a single delete_objects request
+MAX_DELETE_KEYS = 1000
+
+
+class WorkerPool(object):
+    """Pool of worker threads that process items from a bounded queue.
+
+    Items are handed to the workers with submit(), which blocks while the queue is full.
+    Calling join() sends an end-of-work sentinel to every worker, waits for them to finish
+    and re-raises the first exception raised by a worker. After a worker fails the remaining
+    queued items are discarded and submit() raises the worker exception.
+
+    :param worker: Callable run on a worker thread for each submitted item
+    :type worker: method
+    :param threads: Number of worker threads
+    :type threads: int, optional
+    :param max_queued: Maximum number of items waiting in the queue, defaults to 4 per thread
+    :type max_queued: int, optional
+    :param cancel_event: An instance of threading.Event that can be set to stop processing items
+    :type cancel_event: :class:`threading.Event`, optional
+    """
+
+    _SENTINEL = object()
+
+    def __init__(self, worker, threads=3, max_queued=None, cancel_event=None):
+        """Constructor method"""
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+        self._worker = worker
+        self._threads = threads
+        self._queue = Queue(max_queued if max_queued else threads * 4)
+        self._cancel_event = cancel_event if cancel_event else threading.Event()
+        self._abort = threading.Event()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._pool = []
+
+    @property
+    def cancelled(self):
+        """True if the cancel_event has been set"""
+        return self._cancel_event.is_set()
+
+    @property
+    def queued(self):
+        """Number of items waiting in the queue"""
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the worker threads"""
+        for i in range(self._threads):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self._pool.append(t)
+
+    def submit(self, item):
+        """
+        Queue an item for processing, blocking until there is space in the queue
+            :param item: Item to pass to the worker
+            :type item: object
+
+            :return: False if the pool has been cancelled and the item was not queued
+            :rtype: bool
+        """
+        while True:
+            self._raise_errors()
+            if self._cancel_event.is_set() or self._abort.is_set():
+                return False
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+
+    def join(self):
+        """Signal the end of work, wait for the workers to finish and re-raise any worker exception"""
+        for t in self._pool:
+            self._queue.put(self._SENTINEL)
+        for t in self._pool:
+            t.join()
+        self._pool = []
+        self._raise_errors()
+
+    def _raise_errors(self):
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._SENTINEL:
+                break
+            if self._abort.is_set() or self._cancel_event.is_set():
+                # Drain the queue so the producer is never blocked
+                continue
+            try:
+                self._worker(item)
+            except Exception as e:
+                with self._lock:
+                    self._errors.append(e)
+                self._abort.set()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._abort.set()
+            for t in self._pool:
+                self._queue.put(self._SENTINEL)
+            for t in self._pool:
+                t.join()
+            return False
+        self.join()
+
+
+class BandwidthLimiter(object):
+    """Token bucket that caps the total transfer rate of every thread sharing it.
+    Transfers report the bytes they move with consume(), which sleeps while the bucket is in debt.
+
+    :param bytes_per_second: Maximum average transfer rate
+    :type bytes_per_second: int
+    :param burst: Number of bytes that can be transferred at full speed after an idle period, defaults to one second's worth
+    :type burst: int, optional
+    """
+
+    def __init__(self, bytes_per_second, burst=None):
+        """Constructor method"""
+        if bytes_per_second <= 0:
+            raise ValueError("bytes_per_second must be positive")
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst if burst is not None else bytes_per_second
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        """Take amount bytes from the bucket, sleeping until the rate is back under the cap"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.bytes_per_second
+            )
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.bytes_per_second
+        if wait > 0:
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency(object):
+    """Controller for the number of files transferred at once, adjusted in the style of AIMD.
+
+    Every interval seconds the throughput of the last interval is compared with the one before.
+    The limit grows by one while throughput improves and shrinks by one when it falls.
+    The limit is multiplied by backoff whenever S3 asks the client to slow down with a
+    SlowDown or 503 response.
+
+    :param min_workers: Lowest number of concurrent transfers
+    :type min_workers: int, optional
+    :param max_workers: Highest number of concurrent transfers, this many threads are started
+    :type max_workers: int, optional
+    :param initial: Starting number of concurrent transfers, defaults to a quarter of max_workers
+    :type initial: int, optional
+    :param interval: Seconds between adjustments
+    :type interval: float, optional
+    :param backoff: Factor the limit is multiplied by when throttled
+    :type backoff: float, optional
+    """
+
+    THROTTLE_CODES = frozenset(
+        [
+            "SlowDown",
+            "ServiceUnavailable",
+            "503",
+            "Throttling",
+            "ThrottlingException",
+            "RequestLimitExceeded",
+        ]
+    )
+
+    def __init__(
+        self, min_workers=1, max_workers=32, initial=None, interval=2.0, backoff=0.5
+    ):
+        """Constructor method"""
+        if not 1 <= min_workers <= max_workers:
+            raise ValueError("min_workers must be between 1 and max_workers")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+        self.backoff = backoff
+        self.limit = max(min_workers, initial if initial else max_workers // 4)
+        self.throttled = 0
+        self._in_flight = 0
+        self._bytes = 0
+        self._last_throughput = None
+        self._window_start = time.monotonic()
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a transfer slot"""
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        """Return a transfer slot"""
+        with self._condition:
+            self._in_flight -= 1
+            self._adjust()
+            self._condition.notify_all()
+
+    def record(self, amount):
+        """Record amount bytes transferred"""
+        with self._condition:
+            self._bytes += amount
+
+    def wrap(self, worker):
+        """Wrap a WorkerPool worker so that each item holds a transfer slot while it runs"""
+
+        def run(item):
+            self.acquire()
+            try:
+                return worker(item)
+            finally:
+                self.release()
+
+        return run
+
+    def on_retry(self, response=None, **kwargs):
+        """botocore needs-retry event handler that backs off when S3 throttles requests"""
+        if response is None:
+            return None
+        http_response, parsed = response
+        code = parsed.get("Error", {}).get("Code")
+        if code in self.THROTTLE_CODES or http_response.status_code == 503:
+            with self._condition:
+                self.throttled += 1
+                self.limit = max(self.min_workers, int(self.limit * self.backoff))
+                self._reset_window()
+        # Let botocore decide whether to retry
+        return None
+
+    def watch(self, s3_client):
+        """Start observing the throttling responses of s3_client"""
+        s3_client.meta.events.register(
+            "needs-retry.s3", self.on_retry, unique_id=self._unique_id
+        )
+
+    def unwatch(self, s3_client):
+        """Stop observing s3_client"""
+        s3_client.meta.events.unregister(
+            "needs-retry.s3", self.on_retry, unique_id=self._unique_id
+        )
+
+    @property
+    def _unique_id(self):
+        return "pyepic-adaptive-concurrency-{}".format(id(self))
+
+    def _reset_window(self):
+        self._bytes = 0
+        self._last_throughput = None
+        self._window_start = time.monotonic()
+
+    def _adjust(self):
+        # Called with the condition held
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if elapsed < self.interval:
+            return
+        throughput = self._bytes / elapsed
+        if self._last_throughput is None or throughput > self._last_throughput * 1.05:
+            self.limit = min(self.max_workers, int(self.limit) + 1)
+        elif throughput < self._last_throughput * 0.8:
+            self.limit = max(self.min_workers, int(self.limit) - 1)
+        self._last_throughput = throughput
+        self._bytes = 0
+        self._window_start = now
+
+
+def delete_batch(s3_client, bucket_name, keys, retries=3, backoff=0.5):
+    """
+    Delete up to MAX_DELETE_KEYS keys with delete_objects, retrying any keys S3 reports as failed
+        :param s3_client: boto3 S3 client
+        :param bucket_name: Bucket holding the keys
+        :type bucket_name: str
+        :param keys: Keys to delete
+        :type keys: list
+        :param retries: Number of times failed keys are retried
+        :type retries: int, optional
+        :param backoff: Seconds to wait before the first retry, doubled for each retry after
+        :type backoff: float, optional
+
+        :return: List of deleted keys and dictionary of key to error message for the keys that could not be deleted
+        :rtype: tuple
+    """
+    failed = {}
+    pending = list(keys)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        response = s3_client.delete_objects(
+            Bucket=bucket_name,
+            Delete={"Objects": [{"Key": key} for key in pending], "Quiet": True},
+        )
+        failed = {
+            error["Key"]: "{}: {}".format(error.get("Code"), error.get("Message"))
+            for error in response.get("Errors", [])
+        }
+        pending = [key for key in pending if key in failed]
+        if not pending:
+            break
+    return [key for key in keys if key not in failed], failed
+
+
+def read_into(body, view):
+    """
+    Read a streaming response body into a writable buffer
+        :param body: Streaming body of an S3 response
+        :type body: :class:`botocore.response.StreamingBody`
+        :param view: Buffer to fill, must be exactly the length of the body
+        :type view: memoryview
+    """
+    pos = 0
+    length = len(view)
+    while pos < length:
+        if hasattr(body, "readinto"):
+            # Release the slice even if the read fails, a slice left alive by
+            # a traceback would stop a memory map behind view being closed
+            with view[pos:] as remaining:
+                count = body.readinto(remaining)
+        else:
+            data = body.read(length - pos)
+            count = len(data)
+            view[pos : pos + count] = data
+        if not count:
+            raise IOError("Unexpected end of stream after {} bytes".format(pos))
+        pos += count
+
+
+@contextmanager
+def replace_on_success(file_path):
+    """
+    Write a file through a temporary file in the same folder. The temporary file replaces
+    file_path when the block completes and is removed if it raises, so a failed download
+    never leaves a partial file in place.
+        :param file_path: Path of the file to write
+        :type file_path: str
+
+        :return: Context manager yielding the path of the temporary file
+    """
+    tmp_path = "{}.{}.part".format(file_path, secrets.token_hex(4))
+    try:
+        yield tmp_path
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def ranged_download(
+    s3_client,
+    bucket_name,
+    key_name,
+    file_path,
+    size,
+    etag,
+    chunksize,
+    threads,
+    callback=None,
+):
+    """
+    Download an object with concurrent ranged GETs. A temporary file in the same folder is
+    preallocated and each range is read straight into a memory map of its region of the file.
+    The temporary file replaces file_path once every range is written and is removed on failure.
+        :param s3_client: boto3 S3 client
+        :param bucket_name: Bucket containing the object
+        :type bucket_name: str
+        :param key_name: Key of the object
+        :type key_name: str
+        :param file_path: Local path to download to
+        :type file_path: str
+        :param size: Size of the object in bytes
+        :type size: int
+        :param etag: ETag of the object, used to make sure every range comes from the same version
+        :type etag: str
+        :param chunksize: Size in bytes of each range
+        :type chunksize: int
+        :param threads: Number of ranges to download concurrently
+        :type threads: int
+        :param callback: Called with the number of bytes in each range as it completes
+        :type callback: method, optional
+    """
+    # The file only appears at file_path once every range has been written, so
+    # a failed or changed object never leaves a full size file of mixed data
+    with replace_on_success(file_path) as tmp_path:
+        _ranged_download(
+            s3_client,
+            bucket_name,
+            key_name,
+            tmp_path,
+            size,
+            etag,
+            chunksize,
+            threads,
+            callback,
+        )
+
+
+def _ranged_download(
+    s3_client,
+    bucket_name,
+    key_name,
+    file_path,
+    size,
+    etag,
+    chunksize,
+    threads,
+    callback,
+):
+    with open(file_path, "w+b") as f:
+        f.truncate(size)
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), size) as mm:
+            view = memoryview(mm)
+
+            def fetch(byte_range):
+                start, end = byte_range
+                response = s3_client.get_object(
+                    Bucket=bucket_name,
+                    Key=key_name,
+                    Range="bytes={}-{}".format(start, end - 1),
+                    IfMatch=etag,
+                )
+                with view[start:end] as part:
+                    read_into(response["Body"], part)
+                if callback is not None:
+                    callback(end - start)
+
+            try:
+                with WorkerPool(fetch, threads=threads) as pool:
+                    for start in range(0, size, chunksize):
+                        pool.submit((start, min(start + chunksize, size)))
+                mm.flush()
+            finally:
+                view.release()
+
+
+def resumable_upload(
+    s3_client,
+    bucket_name,
+    key_name,
+    rel_path,
+    local_file,
+    chunksize,
+    threads,
+    journal,
+    extra_args={},
+    cancel_event=None,
+    callback=None,
+    delta=False,
+):
+    """
+    Upload a file in parts, recording each completed part in a journal.
+    If the journal holds an unfinished upload of the same file only the missing parts are sent.
+    The MD5 of each part is recorded once the upload completes. In delta mode the parts that are
+    unchanged since the last upload are copied from the existing object with upload_part_copy,
+    so only the changed parts are sent.
+        :param s3_client: boto3 S3 client
+        :param bucket_name: Bucket to upload to
+        :type bucket_name: str
+        :param key_name: Key to upload to
+        :type key_name: str
+        :param rel_path: Path of the file relative to the synced folder, used as the journal key
+        :type rel_path: str
+        :param local_file: File to upload
+        :type local_file: :class:`pyepic.client.sync.LocalFile`
+        :param chunksize: Size in bytes of each part
+        :type chunksize: int
+        :param threads: Number of parts to upload concurrently
+        :type threads: int
+        :param journal: Journal of multipart uploads
+        :type journal: :class:`pyepic.client.sync_state.SyncIndex`
+        :param extra_args: Extra arguments for create_multipart_upload, such as Metadata
+        :type extra_args: dict, optional
+        :param cancel_event: An instance of threading.Event that can be set to stop the upload, leaving it to be resumed later
+        :type cancel_event: :class:`threading.Event`, optional
+        :param callback: Called with the number of bytes in each part before it is sent
+        :type callback: method, optional
+        :param delta: Copy the parts that have not changed from the existing object
+        :type delta: bool, optional
+
+        :return: ETag of the uploaded object, None if the upload was cancelled
+        :rtype: str
+    """
+    state = journal.multipart_upload(rel_path)
+    if state is not None and (
+        state.key != key_name
+        or state.size != local_file.size
+        or state.mtime != local_file.mtime
+        or state.chunksize != chunksize
+        or not _upload_exists(s3_client, bucket_name, state.key, state.upload_id)
+    ):
+        # The file has changed since the upload was started
+        _abort_upload(s3_client, bucket_name, state.key, state.upload_id)
+        journal.finish_multipart_upload(rel_path)
+        state = None
+    if state is None:
+        upload_id = s3_client.create_multipart_upload(
+            Bucket=bucket_name, Key=key_name, **extra_args
+        )["UploadId"]
+        journal.start_multipart_upload(
+            rel_path, key_name, upload_id, local_file.size, local_file.mtime, chunksize
+        )
+        parts = {}
+    else:
+        upload_id = state.upload_id
+        parts = dict(state.parts)
+    # The ETag of an uploaded part is its MD5
+    checksums = {number: etag.strip('"') for number, etag in parts.items()}
+    previous = journal.part_checksums(rel_path) if delta else None
+    if previous is not None and previous.chunksize != chunksize:
+        previous = None
+    # Set once the existing object has changed and parts can no longer be copied from it
+    stale = threading.Event()
+
+    def send(part):
+        part_number, start = part
+        length = min(chunksize, local_file.size - start)
+        # Parts are streamed from the file rather than read into memory, as
+        # large files can have parts of hundreds of MB on every thread
+        with _FilePart(local_file.path, start, length) as body:
+            checksum = body.md5()
+            etag = None
+            if (
+                previous is not None
+                and not stale.is_set()
+                and part_number <= len(previous.checksums)
+                and previous.checksums[part_number - 1] == checksum
+                and min(chunksize, previous.size - start) == length
+            ):
+                etag = _copy_part(
+                    s3_client,
+                    bucket_name,
+                    key_name,
+                    upload_id,
+                    part_number,
+                    (start, start + length),
+                    previous.etag,
+                    checksum,
+                )
+                if etag is None:
+                    stale.set()
+            if etag is None:
+                if callback is not None:
+                    callback(length)
+                etag = s3_client.upload_part(
+                    Bucket=bucket_name,
+                    Key=key_name,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                )["ETag"]
+        parts[part_number] = etag
+        checksums[part_number] = checksum
+        journal.record_part(upload_id, part_number, etag)
+
+    with WorkerPool(send, threads=threads, cancel_event=cancel_event) as pool:
+        for part_number, start in enumerate(range(0, local_file.size, chunksize), 1):
+            if part_number not in parts and not pool.submit((part_number, start)):
+                break
+    if pool.cancelled:
+        return None
+    response = s3_client.complete_multipart_upload(
+        Bucket=bucket_name,
+        Key=key_name,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": number, "ETag": parts[number]}
+                for number in sorted(parts)
+            ]
+        },
+    )
+    journal.finish_multipart_upload(rel_path)
+    journal.record_part_checksums(
+        rel_path,
+        response["ETag"],
+        local_file.size,
+        chunksize,
+        [checksums[number] for number in sorted(checksums)],
+    )
+    return response["ETag"]
+
+
+class _FilePart(io.RawIOBase):
+    # Read-only, seekable view of one part of a file, passed to upload_part as
+    # the body so the part is streamed from disk instead of held in memory
+
+    def __init__(self, path, start, length):
+        super().__init__()
+        self._file = open(path, "rb")
+        self._start = start
+        self._length = length
+        self._pos = 0
+
+    def __len__(self):
+        return self._length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._length + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if pos < 0:
+            raise ValueError("Negative seek position {}".format(pos))
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        count = max(0, min(len(b), self._length - self._pos))
+        if count == 0:
+            return 0
+        self._file.seek(self._start + self._pos)
+        count = self._file.readinto(memoryview(b)[:count])
+        self._pos += count
+        return count
+
+    def md5(self):
+        # MD5 of the part, read through in blocks
+        md5 = hashlib.md5()
+        self.seek(0)
+        buffer = bytearray(MB)
+        while True:
+            count = self.readinto(buffer)
+            if not count:
+                break
+            md5.update(memoryview(buffer)[:count])
+        self.seek(0)
+        return md5.hexdigest()
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def _copy_part(
+    s3_client, bucket_name, key_name, upload_id, part_number, byte_range, etag, checksum
+):
+    # Copy a part from the existing object, None if the object has changed
+    start, end = byte_range
+    try:
+        response = s3_client.upload_part_copy(
+            Bucket=bucket_name,
+            Key=key_name,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={"Bucket": bucket_name, "Key": key_name},
+            CopySourceRange="bytes={}-{}".format(start, end - 1),
+            CopySourceIfMatch=etag,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in (
+            "412",
+            "PreconditionFailed",
+            "404",
+            "NoSuchKey",
+            "InvalidRange",
+        ):
+            return None
+        raise e
+    part_etag = response["CopyPartResult"]["ETag"]
+    if part_etag.strip('"') != checksum:
+        # Not the data that was expected, it is replaced by uploading the part
+        return None
+    return part_etag
+
+
+def _upload_exists(s3_client, bucket_name, key_name, upload_id):
+    try:
+        s3_client.list_parts(
+            Bucket=bucket_name, Key=key_name, UploadId=upload_id, MaxParts=1
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchUpload"):
+            return False
+        raise e
+    return True
+
+
+def _abort_upload(s3_client, bucket_name, key_name, upload_id):
+    try:
+        s3_client.abort_multipart_upload(
+            Bucket=bucket_name, Key=key_name, UploadId=upload_id
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ("404", "NoSuchUpload"):
+            raise e
+
+
+class TransferProfile(object):
+    """Multipart transfer settings for uploads and downloads.
+    The defaults match the boto3 defaults.
+
+    :param multipart_threshold: Files larger than this many bytes are transferred in parts
+    :type multipart_threshold: int, optional
+    :param multipart_chunksize: Size in bytes of each part
+    :type multipart_chunksize: int, optional
+    :param max_concurrency: Number of parts of a single file transferred concurrently
+    :type max_concurrency: int, optional
+    :param max_pool_connections: Size of the botocore connection pool, defaults to enough connections for every worker to transfer max_concurrency parts at once
+    :type max_pool_connections: int, optional
+    """
+
+    def __init__(
+        self,
+        multipart_threshold=8 * MB,
+        multipart_chunksize=8 * MB,
+        max_concurrency=10,
+        max_pool_connections=None,
+    ):
+        """Constructor method"""
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.max_pool_connections = max_pool_connections
+
+    def concurrency(self, workers=1):
+        """Number of parts of a single file transferred concurrently when workers files are transferred at once"""
+        return self.max_concurrency
+
+    def chunksize(self, file_size=None):
+        """Size of each part for a file of file_size bytes"""
+        return self._limit_chunksize(self.multipart_chunksize, file_size)
+
+    @staticmethod
+    def _limit_chunksize(chunksize, file_size):
+        if file_size is not None:
+            # Never exceed the S3 limit on the number of parts
+            chunksize = max(chunksize, -(-file_size // MAX_PARTS))
+        return min(max(chunksize, MIN_PART_SIZE), MAX_PART_SIZE)
+
+    def pool_connections(self, workers=1):
+        """Size of the connection pool needed for workers concurrent file transfers"""
+        if self.max_pool_connections is not None:
+            return self.max_pool_connections
+        # Leave some spare connections for listings made while transferring
+        return workers * self.concurrency(workers) + 2
+
+    def transfer_config(self, file_size=None, workers=1):
+        """
+        Build the boto3 transfer configuration for a file
+            :param file_size: Size of the file in bytes, if known
+            :type file_size: int, optional
+            :param workers: Number of files being transferred at the same time
+            :type workers: int, optional
+
+            :return: boto3 transfer configuration
+            :rtype: :class:`boto3.s3.transfer.TransferConfig`
+        """
+        return TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.chunksize(file_size),
+            max_concurrency=self.concurrency(workers),
+        )
+
+
+class AutoTransferProfile(TransferProfile):
+    """Transfer profile that picks the part size from the size of each file and
+    shares a total connection budget between the files being transferred at once.
+
+    :param total_concurrency: Total number of parts in flight across all workers
+    :type total_concurrency: int, optional
+    :param target_parts: Number of parts to aim for when splitting a large file
+    :type target_parts: int, optional
+    :param max_chunksize: Largest part size in bytes that will be picked
+    :type max_chunksize: int, optional
+    """
+
+    def __init__(self, total_concurrency=64, target_parts=1000, max_chunksize=512 * MB):
+        """Constructor method"""
+        super().__init__(max_concurrency=16)
+        self.total_concurrency = total_concurrency
+        self.target_parts = target_parts
+        self.max_chunksize = max_chunksize
+
+    def concurrency(self, workers=1):
+        return max(1, min(self.max_concurrency, self.total_concurrency // workers))
+
+    def chunksize(self, file_size=None):
+        chunksize = self.multipart_chunksize
+        if file_size is not None:
+            # Aim for target_parts parts, rounded up to a whole MB
+            target = -(-(file_size // self.target_parts) // MB) * MB
+            chunksize = max(chunksize, min(target, self.max_chunksize))
+        return self._limit_chunksize(chunksize, file_size)
@@ -0,0 +1,104 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import datetime
+from types import SimpleNamespace
+
+import boto3
+import pytest
+
+moto = pytest.importorskip("moto")
+
+from pyepic.client.data import DataClient
+
+BUCKET = "bucket"
+PREFIX = "user1/"
+
+
+@pytest.fixture(autouse=True)
+def aws_environment(monkeypatch):
+    # Never let the tests find real credentials
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+
+@pytest.fixture
+def s3():
+    """boto3 S3 client for a mocked bucket"""
+    with moto.mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def data_client(s3, monkeypatch):
+    """DataClient connected to the mocked bucket, with the EPIC API calls stubbed"""
+    session = SimpleNamespace(
+        session_token=SimpleNamespace(
+            aws_key_id="testing",
+            aws_secret_key="testing",
+            aws_session_token="testing",
+            expiration=datetime.datetime.now(datetime.timezone.utc)
+            + datetime.timedelta(days=1),
+        ),
+        aws_region="us-east-1",
+        s3_obj_key=PREFIX,
+        s3_location=BUCKET,
+    )
+    monkeypatch.setattr(
+        DataClient, "_fetch_session_details_from_epic", lambda self: session
+    )
+    monkeypatch.setattr(
+        DataClient,
+        "_fetch_profile_details_from_epic",
+        lambda self: SimpleNamespace(id=1),
+    )
+    client = DataClient("token", connection_url="http://localhost")
+    client._connect()
+    return client
+
+
+@pytest.fixture
+def s3_calls(data_client):
+    """Counter of the S3 operations made by data_client, including clients it creates later"""
+    calls = collections.Counter()
+
+    def count(event_name, **kwargs):
+        calls[event_name.rsplit(".", 1)[-1]] += 1
+
+    data_client._s3_session.events.register("before-call.s3", count)
+    data_client._s3_client.meta.events.register("before-call.s3", count)
+    return calls
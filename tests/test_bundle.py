@@ -0,0 +1,167 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import os
+import tarfile
+import time
+
+import pytest
+
+from pyepic.client.bundle import (
+    BUNDLE_FOLDER,
+    BundleManifest,
+    TarStream,
+    extract_bundle,
+)
+
+from .conftest import BUCKET, PREFIX
+from .helpers import make_files, read_files
+
+FILES = {
+    "big.h5": b"b" * 5000,
+    "processor0/U": b"u0" * 100,
+    "processor0/p": b"p0" * 100,
+    "processor1/U": b"u1" * 100,
+    "processor1/p": b"p1" * 100,
+}
+SMALL = sorted(p for p in FILES if p != "big.h5")
+
+
+@pytest.fixture
+def case(tmp_path):
+    root = str(tmp_path / "case")
+    make_files(root, FILES)
+    return root
+
+
+def remote_keys(s3, prefix):
+    response = s3.list_objects_v2(Bucket=BUCKET, Prefix=prefix)
+    return sorted(
+        s3_obj["Key"][len(prefix) :] for s3_obj in response.get("Contents", [])
+    )
+
+
+def load_manifest(s3, s3_prefix):
+    return BundleManifest(s3, BUCKET, s3_prefix).load()
+
+
+class TestBundleSync:
+    def test_small_files_are_bundled(self, data_client, s3, case, tmp_path):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000)
+        keys = remote_keys(s3, PREFIX + "case/")
+        assert "big.h5" in keys
+        assert not any(key in keys for key in SMALL)
+        bundles = [
+            k for k in keys if k.startswith(BUNDLE_FOLDER) and k.endswith(".tar")
+        ]
+        assert len(bundles) == 1
+
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target)
+        assert read_files(target) == FILES
+
+    def test_bundles_are_split_by_size(self, data_client, s3, case):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000, bundle_size=400)
+        manifest = load_manifest(s3, PREFIX + "case/")
+        assert sorted(manifest.files) == SMALL
+        assert len(set(entry["bundle"] for entry in manifest.files.values())) == 2
+
+    def test_manifest_records_bundle_last_modified(self, data_client, s3, case):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000)
+        manifest = load_manifest(s3, PREFIX + "case/")
+        entry = manifest.files["processor0/U"]
+        head = s3.head_object(Bucket=BUCKET, Key=manifest.bundle_key(entry["bundle"]))
+        assert entry["uploaded"] == head["LastModified"].timestamp()
+
+    def test_newer_object_replaces_bundled_copy(self, data_client, s3, case, tmp_path):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000)
+        # LastModified has a resolution of one second
+        time.sleep(1.1)
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/processor0/U", Body=b"new")
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target)
+        assert read_files(target) == dict(FILES, **{"processor0/U": b"new"})
+
+    def test_mirror_upload_drops_removed_files(self, data_client, s3, case):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000)
+        os.remove(os.path.join(case, "processor0", "U"))
+        data_client.sync(case, "epic://case/", bundle_threshold=1000, mirror=True)
+        manifest = load_manifest(s3, PREFIX + "case/")
+        assert sorted(manifest.files) == SMALL[1:]
+
+        for rel_path in SMALL[1:]:
+            os.remove(os.path.join(case, *rel_path.split("/")))
+        data_client.sync(case, "epic://case/", bundle_threshold=1000, mirror=True)
+        assert load_manifest(s3, PREFIX + "case/").files == {}
+        assert not any(
+            key.endswith(".tar") for key in remote_keys(s3, PREFIX + "case/")
+        )
+
+    def test_mirror_download_keeps_bundled_files(self, data_client, case, tmp_path):
+        data_client.sync(case, "epic://case/", bundle_threshold=1000)
+        target = str(tmp_path / "copy")
+        make_files(target, {"processor2/U": b"old"})
+        data_client.sync("epic://case/", target, mirror=True)
+        assert read_files(target) == FILES
+
+
+class TestExtractBundle:
+    def bundle(self, tmp_path, files):
+        source = str(tmp_path / "source")
+        make_files(source, files)
+        members = [(p, os.path.join(source, *p.split("/"))) for p in sorted(files)]
+        return TarStream(members).read()
+
+    def test_hard_linked_target_is_replaced(self, tmp_path):
+        data = self.bundle(tmp_path, {"a": b"new"})
+        make_files(str(tmp_path), {"cached": b"old"})
+        target = str(tmp_path / "a")
+        os.link(str(tmp_path / "cached"), target)
+        extracted = list(extract_bundle(io.BytesIO(data), {"a": target}))
+        assert extracted == ["a"]
+        with open(target, "rb") as f:
+            assert f.read() == b"new"
+        with open(str(tmp_path / "cached"), "rb") as f:
+            assert f.read() == b"old"
+
+    def test_failed_extraction_leaves_file_untouched(self, tmp_path):
+        data = self.bundle(tmp_path, {"a": os.urandom(100000)})
+        target_folder = tmp_path / "target"
+        make_files(str(target_folder), {"a": b"old"})
+        with pytest.raises(tarfile.TarError):
+            list(
+                extract_bundle(
+                    io.BytesIO(data[:50000]), {"a": str(target_folder / "a")}
+                )
+            )
+        assert read_files(str(target_folder)) == {"a": b"old"}
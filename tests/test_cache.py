@@ -0,0 +1,159 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import pytest
+
+from pyepic.client.cache import DownloadCache, clone_file
+
+from .conftest import BUCKET, PREFIX
+from .helpers import make_files, read_files
+
+FILES = {
+    "a.txt": b"a" * 100,
+    "mesh/grid.h5": b"g" * 1000,
+    "results/run1/out.h5": b"r" * 500,
+}
+
+
+@pytest.fixture
+def case(tmp_path):
+    root = str(tmp_path / "case")
+    make_files(root, FILES)
+    return root
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DownloadCache(str(tmp_path / "cache"))
+    yield cache
+    cache.close()
+
+
+def write(path, contents):
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+class TestDownloadCache:
+    def test_store_and_fetch(self, cache, tmp_path):
+        source = str(tmp_path / "source")
+        write(source, b"x" * 10)
+        cache.store('"abc"', 10, source)
+        target = str(tmp_path / "target")
+        write(target, b"old")
+        assert cache.fetch('"abc"', 10, target)
+        with open(target, "rb") as f:
+            assert f.read() == b"x" * 10
+        assert not cache.fetch('"abc"', 11, target)
+        assert cache.size == 10
+
+    def test_etags_without_an_md5_are_not_cached(self, cache, tmp_path):
+        source = str(tmp_path / "source")
+        write(source, b"x")
+        cache.store('"not/an/md5"', 1, source)
+        assert cache.size == 0
+        assert not cache.fetch('"not/an/md5"', 1, str(tmp_path / "target"))
+
+    def test_least_recently_used_is_evicted(self, tmp_path):
+        cache = DownloadCache(str(tmp_path / "cache"), max_size=25)
+        for name in ["aa", "bb", "cc"]:
+            source = str(tmp_path / name)
+            write(source, b"x" * 10)
+            cache.store(name, 10, source)
+            if name == "bb":
+                assert cache.fetch("aa", 10, str(tmp_path / "target"))
+        assert cache.size == 20
+        assert not cache.fetch("bb", 10, str(tmp_path / "target"))
+        assert cache.fetch("aa", 10, str(tmp_path / "target"))
+        cache.close()
+
+    def test_changed_cache_file_is_dropped(self, tmp_path):
+        cache = DownloadCache(str(tmp_path / "cache"), hardlink=True)
+        source = str(tmp_path / "source")
+        write(source, b"x" * 10)
+        cache.store("abc", 10, source)
+        target = str(tmp_path / "target")
+        assert cache.fetch("abc", 10, target)
+        # Appending through a hard link changes the cached file
+        with open(cache._file("abc-10"), "ab") as f:
+            f.write(b"more")
+        assert not cache.fetch("abc", 10, target)
+        assert cache.size == 0
+        cache.close()
+
+
+class TestCloneFile:
+    def test_copy_is_independent(self, tmp_path):
+        source = str(tmp_path / "source")
+        write(source, b"x")
+        target = str(tmp_path / "target")
+        assert clone_file(source, target) in ("reflink", "copy")
+        write(target, b"y")
+        with open(source, "rb") as f:
+            assert f.read() == b"x"
+        assert os.stat(target).st_nlink == 1
+
+
+class TestCachedDownloads:
+    def test_sync_hits_are_copied(self, data_client, s3_calls, case, cache, tmp_path):
+        data_client.sync(case, "epic://case/")
+        data_client.set_download_cache(cache)
+        data_client.sync("epic://case/", str(tmp_path / "one"))
+        s3_calls.clear()
+        second = str(tmp_path / "two")
+        data_client.sync("epic://case/", second)
+        # Only the bundle manifest is fetched, every file comes from the cache
+        assert s3_calls["GetObject"] == 1
+        assert read_files(second) == FILES
+        assert os.stat(os.path.join(second, "a.txt")).st_nlink == 1
+
+    def test_download_file_hits(self, data_client, s3, s3_calls, cache, tmp_path):
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/a.txt", Body=b"a" * 100)
+        data_client.set_download_cache(cache)
+        data_client.download_file("epic://case/a.txt", str(tmp_path / "one"))
+        s3_calls.clear()
+        target = str(tmp_path / "two")
+        data_client.download_file("epic://case/a.txt", target)
+        assert "GetObject" not in s3_calls
+        with open(target, "rb") as f:
+            assert f.read() == b"a" * 100
+
+    def test_changed_object_is_downloaded(self, data_client, s3, cache, tmp_path):
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/a.txt", Body=b"a" * 100)
+        data_client.set_download_cache(cache)
+        data_client.sync("epic://case/", str(tmp_path / "one"))
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/a.txt", Body=b"b" * 100)
+        target = str(tmp_path / "two")
+        data_client.sync("epic://case/", target)
+        assert read_files(target) == {"a.txt": b"b" * 100}
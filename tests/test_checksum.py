@@ -0,0 +1,170 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from concurrent.futures import Future
+import os
+
+import pytest
+
+from pyepic.client.checksum import Hasher, file_hash, hash_chunksize
+from pyepic.client.sync_state import SyncIndex
+from pyepic.client.transfer import MB
+
+from .conftest import BUCKET, PREFIX
+from .helpers import make_files, read_files
+
+FILES = {
+    "a.txt": b"a" * 100,
+    "mesh/grid.h5": b"g" * 1000,
+    "big.bin": bytes(range(256)) * (36 * 1024),
+}
+
+
+@pytest.fixture
+def case(tmp_path):
+    root = str(tmp_path / "case")
+    make_files(root, FILES)
+    return root
+
+
+def touch(path, offset):
+    os.utime(path, (os.path.getmtime(path) + offset,) * 2)
+
+
+class TestHashChunksize:
+    @pytest.mark.parametrize(
+        "etag, size, expected",
+        [
+            ('"abc"', 10, 0),
+            ('"abc-2"', 9 * MB, 8 * MB),
+            ('"abc-3"', 40 * MB, 14 * MB),
+            ('"abc-0"', 10, None),
+            ('"abc-x"', 10, None),
+            ('"abc-2"', 100, None),
+        ],
+    )
+    def test_part_size_from_etag(self, etag, size, expected):
+        assert hash_chunksize(etag, size, 8 * MB) == expected
+
+
+class TestFileHash:
+    def test_etags_match_s3(self, s3, case):
+        path = os.path.join(case, "big.bin")
+        with open(path, "rb") as f:
+            data = f.read()
+        s3.put_object(Bucket=BUCKET, Key="single", Body=data)
+        assert (
+            file_hash(path).etag == s3.head_object(Bucket=BUCKET, Key="single")["ETag"]
+        )
+        upload = s3.create_multipart_upload(Bucket=BUCKET, Key="multi")
+        parts = []
+        for number, start in enumerate(range(0, len(data), 5 * MB), 1):
+            part = s3.upload_part(
+                Bucket=BUCKET,
+                Key="multi",
+                UploadId=upload["UploadId"],
+                PartNumber=number,
+                Body=data[start : start + 5 * MB],
+            )
+            parts.append({"PartNumber": number, "ETag": part["ETag"]})
+        s3.complete_multipart_upload(
+            Bucket=BUCKET,
+            Key="multi",
+            UploadId=upload["UploadId"],
+            MultipartUpload={"Parts": parts},
+        )
+        assert (
+            file_hash(path, 5 * MB).etag
+            == s3.head_object(Bucket=BUCKET, Key="multi")["ETag"]
+        )
+
+
+class TestChecksumSync:
+    def test_upload_skips_unchanged_contents(self, data_client, s3_calls, case):
+        data_client.sync(case, "epic://case/", checksum=True)
+        touch(os.path.join(case, "a.txt"), 60)
+        touch(os.path.join(case, "big.bin"), 60)
+        s3_calls.clear()
+        data_client.sync(case, "epic://case/", overwrite_existing=True, checksum=True)
+        assert "PutObject" not in s3_calls
+        assert "CreateMultipartUpload" not in s3_calls
+
+    def test_upload_replaces_changed_contents(self, data_client, s3, s3_calls, case):
+        data_client.sync(case, "epic://case/", checksum=True)
+        # Same size and an older timestamp, so only the contents tell it apart
+        path = os.path.join(case, "a.txt")
+        make_files(case, {"a.txt": b"b" * 100})
+        touch(path, -3600)
+        s3_calls.clear()
+        data_client.sync(case, "epic://case/", overwrite_existing=True, checksum=True)
+        assert s3_calls["PutObject"] == 1
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "case/a.txt")["Body"]
+        assert body.read() == b"b" * 100
+
+    def test_download_compares_contents(self, data_client, s3_calls, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        target = str(tmp_path / "copy")
+        make_files(target, dict(FILES, **{"mesh/grid.h5": b"x" * 1000}))
+        # The local files are newer, so a timestamp sync would keep them all
+        for rel_path in FILES:
+            touch(os.path.join(target, *rel_path.split("/")), 3600)
+        s3_calls.clear()
+        data_client.sync("epic://case/", target, overwrite_existing=True, checksum=True)
+        files = read_files(target)
+        del files[SyncIndex.FILE_NAME]
+        assert files == FILES
+        # The bundle manifest and the one changed file
+        assert s3_calls["GetObject"] == 2
+
+    def test_hashes_are_cached(self, data_client, case, monkeypatch):
+        hashed = []
+        original = Hasher._result
+
+        def result(self, request, result):
+            if isinstance(result, Future):
+                hashed.append(request[0])
+            return original(self, request, result)
+
+        monkeypatch.setattr(Hasher, "_result", result)
+        data_client.sync(case, "epic://case/", checksum=True)
+        for rel_path in FILES:
+            touch(os.path.join(case, *rel_path.split("/")), 60)
+        # A dry run leaves the index entries alone, so the same files are checked again
+        for _ in range(2):
+            data_client.sync(
+                case,
+                "epic://case/",
+                overwrite_existing=True,
+                checksum=True,
+                dryrun=True,
+            )
+        assert sorted(hashed) == sorted(FILES)
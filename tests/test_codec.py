@@ -0,0 +1,117 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+
+import pytest
+
+from pyepic.client.codec import ZstdCodec, decompress_stream, object_codec
+
+from .conftest import BUCKET, PREFIX
+from .helpers import make_files, read_files
+
+pytest.importorskip("zstandard")
+
+LOG = b"line\n" * 1000
+FILES = {"log.txt": LOG, "mesh.h5": b"m" * 5000, "small.txt": b"s"}
+
+
+@pytest.fixture
+def case(tmp_path):
+    root = str(tmp_path / "case")
+    make_files(root, FILES)
+    return root
+
+
+def head(s3, rel_path):
+    return s3.head_object(Bucket=BUCKET, Key=PREFIX + "z/" + rel_path)
+
+
+class TestCodec:
+    def test_eligible(self):
+        codec = ZstdCodec(extensions=["", ".txt"], min_size=10)
+        assert codec.eligible("case/0/U", 100)
+        assert codec.eligible("case/log.TXT", 100)
+        assert not codec.eligible("case/log.txt", 5)
+        assert not codec.eligible("case/mesh.h5", 100)
+        assert not codec.eligible("case/log.txt.gz", 100)
+
+    def test_stream_round_trip(self):
+        codec = ZstdCodec()
+        compressed = codec.compress_stream(io.BytesIO(LOG)).read()
+        assert len(compressed) < len(LOG)
+        assert decompress_stream(io.BytesIO(compressed), codec.name).read() == LOG
+        with pytest.raises(ValueError):
+            decompress_stream(io.BytesIO(compressed), "lz4")
+
+
+class TestCompressedSync:
+    def test_only_eligible_files_are_compressed(self, data_client, s3, case):
+        data_client.sync(case, "epic://z/", codec=ZstdCodec(extensions=[".txt"]))
+        assert object_codec(head(s3, "log.txt")["Metadata"]) == "zstd"
+        assert head(s3, "log.txt")["ContentLength"] < len(LOG)
+        for rel_path in ["mesh.h5", "small.txt"]:
+            assert object_codec(head(s3, rel_path)["Metadata"]) is None
+            assert head(s3, rel_path)["ContentLength"] == len(FILES[rel_path])
+
+    def test_decompressed_without_a_codec(self, data_client, case, tmp_path):
+        data_client.sync(case, "epic://z/", codec=ZstdCodec(extensions=[".txt"]))
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://z/", target)
+        assert read_files(target) == FILES
+        out = io.BytesIO()
+        data_client.download_file("epic://z/log.txt", out)
+        assert out.getvalue() == LOG
+        path = str(tmp_path / "log.txt")
+        data_client.download_file("epic://z/log.txt", path)
+        with open(path, "rb") as f:
+            assert f.read() == LOG
+        assert data_client.read_bytes("epic://z/log.txt") == LOG
+
+    def test_client_codec(self, data_client, s3, case):
+        data_client.set_codec(ZstdCodec(extensions=[".txt"]))
+        data_client.sync(case, "epic://z/")
+        assert object_codec(head(s3, "log.txt")["Metadata"]) == "zstd"
+
+    def test_compressed_bundles(self, data_client, s3, case, tmp_path):
+        codec = ZstdCodec(extensions=[".txt"])
+        data_client.sync(case, "epic://z/", codec=codec, bundle_threshold=2000)
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://z/", target)
+        assert read_files(target) == FILES
+
+    def test_open_raises_for_compressed_files(self, data_client, case):
+        data_client.sync(case, "epic://z/", codec=ZstdCodec(extensions=[".txt"]))
+        with pytest.raises(ValueError):
+            data_client.open("epic://z/log.txt")
+        with data_client.open("epic://z/mesh.h5") as f:
+            assert f.read() == FILES["mesh.h5"]
@@ -0,0 +1,468 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import threading
+
+import pytest
+
+from pyepic.client.sync import SyncStats
+from pyepic.client.sync_state import SyncIndex
+from pyepic.client.transfer import MB
+
+from .conftest import BUCKET, PREFIX
+from .helpers import make_files, read_files
+
+FILES = {
+    "a.txt": b"a" * 100,
+    "mesh/grid.h5": b"g" * 1000,
+    "results/run1/out.h5": b"r" * 500,
+    "results/run1/log.txt": b"log",
+}
+
+
+@pytest.fixture
+def case(tmp_path):
+    root = str(tmp_path / "case")
+    make_files(root, FILES)
+    return root
+
+
+def remote_keys(s3, prefix):
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix)
+    return sorted(
+        s3_obj["Key"][len(prefix) :]
+        for page in pages
+        for s3_obj in page.get("Contents", [])
+    )
+
+
+class TestStreamingSync:
+    def test_queues_stay_bounded(self, data_client, s3, tmp_path):
+        root = str(tmp_path / "case")
+        files = {"d{}/f{:03d}".format(i % 7, i): b"x" for i in range(300)}
+        make_files(root, files)
+        stats = SyncStats()
+        returned = data_client.sync(root, "epic://case/", threads=2, stats=stats)
+        assert returned is stats
+        assert stats.paths == 300
+        assert stats.submitted == 300
+        # Two pools of 2 threads queue at most 4 items per thread each
+        assert stats.max_queue_depth <= 16
+        assert remote_keys(s3, PREFIX + "case/") == sorted(files)
+
+        target = str(tmp_path / "copy")
+        stats = data_client.sync("epic://case/", target, threads=2)
+        assert stats.paths == 300
+        assert read_files(target) == files
+
+
+class TestSync:
+    def test_round_trip(self, data_client, s3, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        assert remote_keys(s3, PREFIX + "case/") == sorted(FILES)
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target)
+        assert read_files(target) == FILES
+
+    def test_one_listing_and_no_heads(self, data_client, s3_calls, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        s3_calls.clear()
+        data_client.sync(case, "epic://case/")
+        data_client.sync("epic://case/", str(tmp_path / "copy"))
+        assert "HeadObject" not in s3_calls
+        assert "PutObject" not in s3_calls
+
+
+class TestInvalidKeys:
+    def test_invalid_keys_are_skipped(self, data_client, s3, tmp_path):
+        for key in ["ok.txt", "a//b.txt", "a/../../escape.txt", "d/./c.txt"]:
+            s3.put_object(Bucket=BUCKET, Key=PREFIX + "bad/" + key, Body=b"x")
+        target = str(tmp_path / "copy")
+        reported = []
+        stats = data_client.sync(
+            "epic://bad/", target, callback=lambda *args: reported.append(args)
+        )
+        assert read_files(target) == {"ok.txt": b"x"}
+        assert sorted(stats.skipped) == [
+            PREFIX + "bad/a/../../escape.txt",
+            PREFIX + "bad/a//b.txt",
+            PREFIX + "bad/d/./c.txt",
+        ]
+        assert sorted(r[0] for r in reported if r[1] is None) == [
+            "epic://bad/a/../../escape.txt",
+            "epic://bad/a//b.txt",
+            "epic://bad/d/./c.txt",
+        ]
+        assert not os.path.exists(str(tmp_path / "escape.txt"))
+
+    def test_nested_folders_are_created(self, data_client, s3, tmp_path):
+        keys = ["d{}/e{}/f".format(d, e) for d in range(3) for e in range(3)]
+        for key in keys:
+            s3.put_object(Bucket=BUCKET, Key=PREFIX + "deep/" + key, Body=b"x")
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://deep/", target, threads=4)
+        assert read_files(target) == {key: b"x" for key in keys}
+
+
+class TestModifiedTimes:
+    def test_downloads_get_last_modified(self, data_client, s3, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target)
+        for rel_path in FILES:
+            head = s3.head_object(Bucket=BUCKET, Key=PREFIX + "case/" + rel_path)
+            path = os.path.join(target, *rel_path.split("/"))
+            assert os.path.getmtime(path) == pytest.approx(
+                head["LastModified"].timestamp()
+            )
+
+    @pytest.mark.parametrize("bundle_threshold", [None, 200])
+    def test_unchanged_downloads_are_not_transferred_again(
+        self, data_client, s3_calls, case, tmp_path, bundle_threshold
+    ):
+        data_client.sync(case, "epic://case/", bundle_threshold=bundle_threshold)
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target)
+        s3_calls.clear()
+        data_client.sync("epic://case/", target, overwrite_existing=True)
+        data_client.sync(
+            target,
+            "epic://case/",
+            overwrite_existing=True,
+            bundle_threshold=bundle_threshold,
+        )
+        # Each sync only reads the bundle manifest
+        assert s3_calls["GetObject"] == 2
+        assert "PutObject" not in s3_calls
+        assert "HeadObject" not in s3_calls
+
+
+class TestSyncIndex:
+    def test_second_sync_transfers_nothing(self, data_client, s3_calls, case):
+        data_client.sync(case, "epic://case/", use_index=True)
+        s3_calls.clear()
+        data_client.sync(case, "epic://case/", use_index=True)
+        assert "PutObject" not in s3_calls
+        assert "HeadObject" not in s3_calls
+
+    def test_iter_entries_in_batches(self, case):
+        index = SyncIndex(case, PREFIX + "case/")
+        for i in reversed(range(25)):
+            index.record("f{:02d}".format(i), i, 100.0, '"{}"'.format(i))
+        entries = list(index.iter_entries(batch_size=10))
+        assert [rel_path for rel_path, _ in entries] == [
+            "f{:02d}".format(i) for i in range(25)
+        ]
+        assert entries[3][1].size == 3 and entries[3][1].etag == '"3"'
+        index.close()
+
+    def test_etags_from_heads(self, data_client, s3_calls, case):
+        data_client.sync(case, "epic://case/", use_index=True)
+        make_files(case, {"a.txt": b"b" * 100})
+        path = os.path.join(case, "a.txt")
+        os.utime(path, (os.path.getmtime(path) + 60,) * 2)
+        s3_calls.clear()
+        data_client.sync(case, "epic://case/", use_index=True, overwrite_existing=True)
+        assert s3_calls["PutObject"] == 1
+        assert s3_calls["HeadObject"] == 1
+        assert s3_calls["ListObjectsV2"] == 1
+        index = SyncIndex(case, PREFIX + "case/")
+        assert all(entry.etag is not None for _, entry in index.iter_entries())
+        index.close()
+
+
+class TestCopy:
+    def test_copies_within_epic(self, data_client, s3, s3_calls, case):
+        data_client.sync(case, "epic://case/")
+        s3_calls.clear()
+        data_client.sync("epic://case/", "epic://copy/")
+        assert remote_keys(s3, PREFIX + "copy/") == sorted(FILES)
+        assert s3_calls["CopyObject"] == len(FILES)
+        assert "GetObject" not in s3_calls and "PutObject" not in s3_calls
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "copy/mesh/grid.h5")["Body"]
+        assert body.read() == FILES["mesh/grid.h5"]
+
+        s3_calls.clear()
+        data_client.sync("epic://case/", "epic://copy/", overwrite_existing=True)
+        assert "CopyObject" not in s3_calls
+
+    def test_overlapping_paths_raise(self, data_client, case):
+        data_client.sync(case, "epic://case/")
+        with pytest.raises(ValueError):
+            data_client.sync("epic://case/", "epic://case/sub/")
+
+
+class TestFilter:
+    @pytest.mark.parametrize(
+        "include, exclude, expected",
+        [
+            (["results/"], None, ["results/run1/log.txt", "results/run1/out.h5"]),
+            (["*.h5"], ["mesh/"], ["results/run1/out.h5"]),
+            (None, ["*.txt"], ["mesh/grid.h5", "results/run1/out.h5"]),
+        ],
+    )
+    def test_upload_and_download(
+        self, data_client, s3, case, tmp_path, include, exclude, expected
+    ):
+        data_client.sync(case, "epic://up/", include=include, exclude=exclude)
+        assert remote_keys(s3, PREFIX + "up/") == expected
+
+        data_client.sync(case, "epic://case/")
+        target = str(tmp_path / "copy")
+        data_client.sync("epic://case/", target, include=include, exclude=exclude)
+        assert sorted(read_files(target)) == expected
+
+
+class TestMirror:
+    def test_download_removes_extra_files(self, data_client, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        target = str(tmp_path / "copy")
+        make_files(target, {"extra/old.h5": b"old"})
+        data_client.sync("epic://case/", target, mirror=True, overwrite_existing=True)
+        assert read_files(target) == FILES
+        assert not os.path.exists(os.path.join(target, "extra"))
+
+    def test_upload_deletes_extra_objects(self, data_client, s3, case):
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/extra.h5", Body=b"x")
+        data_client.sync(case, "epic://case/", mirror=True)
+        assert remote_keys(s3, PREFIX + "case/") == sorted(FILES)
+
+    def test_filter_only_mirrors_matching_files(self, data_client, case, tmp_path):
+        data_client.sync(case, "epic://case/")
+        target = str(tmp_path / "copy")
+        make_files(target, {"extra.h5": b"x", "extra.txt": b"x"})
+        data_client.sync("epic://case/", target, mirror=True, include=["*.h5"])
+        assert sorted(read_files(target)) == [
+            "extra.txt",
+            "mesh/grid.h5",
+            "results/run1/out.h5",
+        ]
+
+    @pytest.mark.parametrize("include", [None, ["*.h5"]])
+    def test_missing_source_removes_nothing(self, data_client, tmp_path, include):
+        target = str(tmp_path / "copy")
+        make_files(target, {"keep.h5": b"x"})
+        with pytest.raises(ValueError):
+            data_client.sync("epic://typo/", target, mirror=True, include=include)
+        assert read_files(target) == {"keep.h5": b"x"}
+
+    def test_deletes_follow_the_transfers(self, data_client, s3, s3_calls, case):
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/extra.h5", Body=b"x")
+        order = []
+
+        def record(event_name, **kwargs):
+            order.append(event_name.rsplit(".", 1)[-1])
+
+        for events in (
+            data_client._s3_session.events,
+            data_client._s3_client.meta.events,
+        ):
+            events.register("before-call.s3", record)
+        data_client.sync(case, "epic://case/", mirror=True)
+        assert order.count("PutObject") == len(FILES)
+        assert order.index("DeleteObjects") > max(
+            i for i, name in enumerate(order) if name == "PutObject"
+        )
+
+    @pytest.mark.parametrize("operation", ["PutObject", "CopyObject", "GetObject"])
+    def test_failed_transfer_deletes_nothing(
+        self, data_client, s3, case, tmp_path, operation
+    ):
+        failing = threading.Event()
+
+        def fail(**kwargs):
+            if failing.is_set():
+                raise IOError("Transfer failed")
+
+        # Registered first so that the clients created by the syncs have it
+        for events in (
+            data_client._s3_session.events,
+            data_client._s3_client.meta.events,
+        ):
+            events.register("before-call.s3." + operation, fail)
+        data_client.sync(case, "epic://case/")
+        make_files(case, {"a.txt": b"changed"})
+        path = os.path.join(case, "a.txt")
+        os.utime(path, (os.path.getmtime(path) + 60,) * 2)
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/extra.h5", Body=b"x")
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "copy/extra.h5", Body=b"x")
+        target = str(tmp_path / "copy")
+        make_files(target, {"extra.h5": b"x"})
+        failing.set()
+        with pytest.raises(Exception, match="Transfer failed"):
+            if operation == "PutObject":
+                data_client.sync(
+                    case, "epic://case/", mirror=True, overwrite_existing=True
+                )
+            elif operation == "CopyObject":
+                data_client.sync("epic://case/", "epic://copy/", mirror=True)
+            else:
+                data_client.sync("epic://case/", target, mirror=True)
+        assert "extra.h5" in remote_keys(s3, PREFIX + "case/")
+        assert "extra.h5" in remote_keys(s3, PREFIX + "copy/")
+        assert "extra.h5" in read_files(target)
+
+    def test_copy_deletes_extra_objects(self, data_client, s3, case):
+        data_client.sync(case, "epic://case/")
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "copy/extra.h5", Body=b"x")
+        data_client.sync("epic://case/", "epic://copy/", mirror=True)
+        assert remote_keys(s3, PREFIX + "copy/") == sorted(FILES)
+
+
+class TestDelete:
+    @pytest.fixture
+    def big(self, s3):
+        keys = ["big/d{}/f{:04d}".format(i % 3, i) for i in range(2500)]
+        for key in keys:
+            s3.put_object(Bucket=BUCKET, Key=PREFIX + key, Body=b"x")
+        return ["epic://" + key for key in keys]
+
+    def test_deletes_in_batches(self, data_client, s3, s3_calls, big):
+        s3_calls.clear()
+        deleted = data_client.delete("epic://big/")
+        assert deleted == sorted(big)
+        assert deleted.failed == {}
+        assert s3_calls["DeleteObjects"] == 3
+        assert remote_keys(s3, PREFIX + "big/") == []
+
+    def test_dryrun(self, data_client, s3, s3_calls, big):
+        s3_calls.clear()
+        assert data_client.delete("epic://big/", dryrun=True) == sorted(big)
+        assert s3_calls["DeleteObjects"] == 0
+        assert len(remote_keys(s3, PREFIX + "big/")) == len(big)
+
+    @pytest.mark.parametrize("failures, retries", [(1, 1), (3, 2)])
+    def test_failed_keys_are_retried(self, data_client, s3, failures, retries):
+        keys = ["case/f{}".format(i) for i in range(5)]
+        for key in keys:
+            s3.put_object(Bucket=BUCKET, Key=PREFIX + key, Body=b"x")
+        attempts = []
+
+        def fail(parsed, **kwargs):
+            # Report one key as failed on the first few attempts
+            attempts.append(1)
+            if len(attempts) <= failures:
+                parsed.setdefault("Errors", []).append(
+                    {
+                        "Key": PREFIX + "case/f2",
+                        "Code": "InternalError",
+                        "Message": "Try again",
+                    }
+                )
+
+        data_client._s3_client.meta.events.register("after-call.s3.DeleteObjects", fail)
+        deleted = data_client.delete("epic://case/", retries=retries)
+        assert len(attempts) == retries + 1
+        if failures > retries:
+            assert deleted == ["epic://" + key for key in keys if key != "case/f2"]
+            assert deleted.failed == {"epic://case/f2": "InternalError: Try again"}
+        else:
+            assert deleted == ["epic://" + key for key in keys]
+            assert deleted.failed == {}
+
+    def test_single_file(self, data_client, s3):
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/a", Body=b"x")
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/b", Body=b"x")
+        assert data_client.delete("epic://case/a") == ["epic://case/a"]
+        assert remote_keys(s3, PREFIX + "case/") == ["b"]
+
+
+class TestBytes:
+    def test_write_and_read_bytes(self, data_client, s3_calls):
+        data_client.write_bytes(memoryview(b"hello"), "epic://w/a.txt")
+        assert s3_calls["PutObject"] == 1
+        assert data_client.read_text("epic://w/a.txt") == "hello"
+        data = bytearray(os.urandom(9 * MB))
+        data_client.write_bytes(data, "epic://w/big.bin")
+        assert s3_calls["UploadPart"] == 2
+        assert data_client.read_bytes("epic://w/big.bin") == data
+
+    def test_write_bytes_sets_meta_data(self, data_client, s3):
+        data_client.write_bytes(b"x", "epic://w/a.txt")
+        head = s3.head_object(Bucket=BUCKET, Key=PREFIX + "w/a.txt")
+        assert head["Metadata"]["source"] == "SDK"
+
+    def test_folder_paths_are_rejected(self, data_client):
+        with pytest.raises(ValueError):
+            data_client.write_bytes(b"x", "epic://w/")
+        with pytest.raises(ValueError):
+            data_client.read_bytes("epic://w/")
+
+
+class TestFilesMetaData:
+    def test_folder(self, data_client, s3_calls, case):
+        data_client.sync(case, "epic://case/")
+        data_client._pool_clients.clear()
+        s3_calls.clear()
+        listed = list(data_client.get_files_meta_data("epic://case/", meta_data=False))
+        assert [m.path for m in listed] == ["epic://case/" + p for p in sorted(FILES)]
+        assert listed[0].size == 100 and listed[0].meta_data is None
+        assert "HeadObject" not in s3_calls
+        found = list(data_client.get_files_meta_data("epic://case/"))
+        assert [m.path for m in found] == [m.path for m in listed]
+        assert all(m.meta_data["source"] == "SDK" for m in found)
+        assert s3_calls["HeadObject"] == len(FILES)
+        # The pool is sized for the HEAD requests alone, which fit the shared client
+        assert data_client._pool_clients == {}
+
+    def test_paths(self, data_client, s3_calls, case):
+        data_client.sync(case, "epic://case/")
+        paths = [
+            "epic://case/results/run1/out.h5",
+            "epic://case/a.txt",
+            "epic://case/missing",
+            "epic://case/results/run1/log.txt",
+        ]
+        s3_calls.clear()
+        found = list(data_client.get_files_meta_data(paths))
+        assert [m.path for m in found] == paths
+        assert found[1].size == 100 and found[1].meta_data["source"] == "SDK"
+        assert found[2].meta_data is None and found[2].size is None
+        assert s3_calls["HeadObject"] == len(paths)
+        assert "ListObjectsV2" not in s3_calls
+
+        s3_calls.clear()
+        listed = list(data_client.get_files_meta_data(paths, meta_data=False))
+        assert [(m.path, m.size, m.etag) for m in listed] == [
+            (m.path, m.size, m.etag) for m in found
+        ]
+        assert all(m.meta_data is None for m in listed)
+        assert "HeadObject" not in s3_calls
+        # One listing for each folder
+        assert s3_calls["ListObjectsV2"] == 2
+
+    def test_folder_path_required(self, data_client):
+        with pytest.raises(ValueError):
+            list(data_client.get_files_meta_data("epic://case"))
+        with pytest.raises(ValueError):
+            list(data_client.get_files_meta_data(["epic://case/"]))
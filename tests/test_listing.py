@@ -0,0 +1,313 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import time
+
+import pytest
+
+from pyepic.client.cache import ListingCache
+from pyepic.client.listing import (
+    DiskUsage,
+    ListingTree,
+    ShardedLister,
+    head_objects,
+)
+
+from .conftest import BUCKET, PREFIX
+
+
+def put_keys(s3, keys):
+    for key in keys:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"x")
+
+
+def listed_keys(pages):
+    return [s3_obj["Key"] for page in pages for s3_obj in page.get("Contents", [])]
+
+
+def names(data_objects):
+    return sorted(data_object.name for data_object in data_objects)
+
+
+class TestListingCache:
+    def test_entries_expire(self):
+        cache = ListingCache(ttl=0.05)
+        cache.put("a/", ["x"])
+        assert cache.get("a/") == ["x"]
+        time.sleep(0.06)
+        assert cache.get("a/") is None
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ListingCache(max_entries=2)
+        cache.put("a/", [1])
+        cache.put("b/", [2])
+        cache.get("a/")
+        cache.put("c/", [3])
+        assert cache.get("b/") is None
+        assert cache.get("a/") == [1] and cache.get("c/") == [3]
+
+    def test_invalidate_parents_and_children(self):
+        cache = ListingCache()
+        for prefix in ["", "a/", "a/b/", "a/b/c/", "a/x/", "b/"]:
+            cache.put(prefix, [])
+        cache.invalidate("a/b/")
+        assert [
+            p
+            for p in ["", "a/", "a/b/", "a/b/c/", "a/x/", "b/"]
+            if cache.get(p) is not None
+        ] == [
+            "a/x/",
+            "b/",
+        ]
+        cache.clear()
+        assert cache.get("b/") is None
+
+
+class TestCachedLs:
+    def test_repeat_ls_is_served_from_the_cache(self, data_client, s3, s3_calls):
+        put_keys(s3, [PREFIX + "case/a", PREFIX + "case/d/b"])
+        data_client.set_listing_cache(ListingCache())
+        s3_calls.clear()
+        assert names(data_client.ls("epic://case/")) == ["a", "d"]
+        assert names(data_client.ls("epic://case")) == ["a", "d"]
+        assert s3_calls["ListObjectsV2"] == 1
+        # Changes made outside the client are only seen once the entry expires
+        put_keys(s3, [PREFIX + "case/c"])
+        assert names(data_client.ls("epic://case/")) == ["a", "d"]
+
+    def test_writes_invalidate(self, data_client, s3, tmp_path):
+        put_keys(s3, [PREFIX + "case/a", PREFIX + "case/d/b"])
+        data_client.set_listing_cache(ListingCache())
+        assert names(data_client.ls("epic://case/")) == ["a", "d"]
+        assert names(data_client.ls("epic://case/d/")) == ["b"]
+
+        data_client.upload_file(io.BytesIO(b"x"), "epic://case/d/c")
+        assert names(data_client.ls("epic://case/d/")) == ["b", "c"]
+
+        data_client.write_bytes(b"x", "epic://case/e")
+        assert names(data_client.ls("epic://case/")) == ["a", "d", "e"]
+
+        data_client.delete("epic://case/e")
+        assert names(data_client.ls("epic://case/")) == ["a", "d"]
+
+        data_client.delete("epic://case/d/")
+        assert names(data_client.ls("epic://case/")) == ["a"]
+
+        root = tmp_path / "local"
+        root.mkdir()
+        (root / "f").write_bytes(b"x")
+        data_client.sync(str(root), "epic://case/")
+        assert names(data_client.ls("epic://case/")) == ["a", "f"]
+
+    def test_disabled(self, data_client, s3, s3_calls):
+        put_keys(s3, [PREFIX + "case/a"])
+        data_client.set_listing_cache(None)
+        s3_calls.clear()
+        list(data_client.ls("epic://case/"))
+        list(data_client.ls("epic://case/"))
+        assert s3_calls["ListObjectsV2"] == 2
+
+
+class TestShardedLister:
+    def test_merges_shards_in_key_order(self, s3):
+        keys = ["big/a-b", "big/a0", "big/z"]
+        keys += [
+            "big/out/t{}/p{}/f{:04d}".format(t, p, f)
+            for t in range(3)
+            for p in range(2)
+            for f in range(300)
+        ]
+        keys += ["big/out-x", "big/out/zz"]
+        put_keys(s3, keys + ["big2", "bi"])
+        pages = ShardedLister(s3, BUCKET, threads=4).pages("big/")
+        assert listed_keys(pages) == sorted(keys)
+
+    def test_truncated_pages_stay_in_order(self, s3, monkeypatch):
+        # Every shard is listed a few keys per page and only one page is queued
+        # ahead, so the shards' pages interleave with the loose files between them
+        original = s3.list_objects_v2
+
+        def small_pages(**kwargs):
+            kwargs.setdefault("MaxKeys", 7)
+            return original(**kwargs)
+
+        monkeypatch.setattr(s3, "list_objects_v2", small_pages)
+        keys = ["deep/{:02d}".format(i) for i in range(5)]
+        keys += ["deep/d{}/f{:02d}".format(d, f) for d in range(6) for f in range(20)]
+        keys += ["deep/d2x", "deep/d4/e/f", "deep/e", "deep/z/f"]
+        put_keys(s3, keys)
+        pages = list(
+            ShardedLister(s3, BUCKET, threads=3, queued_pages=1).pages("deep/")
+        )
+        assert pages[0]["IsTruncated"]
+        assert len(pages) > 10
+        for page in pages:
+            page_keys = [s3_obj["Key"] for s3_obj in page["Contents"]]
+            assert page_keys == sorted(page_keys)
+        assert listed_keys(pages) == sorted(keys)
+
+    def test_flat_folder(self, s3):
+        keys = ["flat/f{:04d}".format(i) for i in range(1500)]
+        put_keys(s3, keys)
+        pages = ShardedLister(s3, BUCKET, threads=4).pages("flat/")
+        assert listed_keys(pages) == keys
+
+    def test_empty_prefix(self, s3):
+        assert listed_keys(ShardedLister(s3, BUCKET).pages("missing/")) == []
+
+    def test_close_early(self, s3):
+        put_keys(
+            s3, ["big/d{}/f{:04d}".format(d, f) for d in range(3) for f in range(600)]
+        )
+        pages = ShardedLister(s3, BUCKET, threads=2, queued_pages=1).pages("big/")
+        next(pages)
+        pages.close()
+
+    def test_walk_over_shards(self, data_client, s3):
+        keys = ["d{}/f{:04d}".format(d, f) for d in range(3) for f in range(400)]
+        put_keys(s3, [PREFIX + "case/" + key for key in keys])
+        data_client.set_listing_threads(4)
+        walked = [
+            (folder, [f.name for f in files])
+            for folder, _, files in data_client.walk("epic://case/")
+        ]
+        assert [folder for folder, _ in walked] == [
+            "epic://case/",
+            "epic://case/d0/",
+            "epic://case/d1/",
+            "epic://case/d2/",
+        ]
+        assert sum(len(files) for _, files in walked) == len(keys)
+
+
+class TestListingTree:
+    def test_usage(self, s3):
+        put_keys(s3, ["case/a", "case/d/b", "case/d/e/c"])
+        tree = ListingTree(
+            s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix="case/"),
+            "case/",
+        )
+        usage = tree.usage()
+        assert usage[""].files == 3
+        assert usage["d/"].files == 2
+        assert usage["d/e/"].size == 1
+
+    def test_folder_markers_are_not_files(self):
+        pages = [{"Contents": [{"Key": "case/d/", "Size": 0}]}]
+        tree = ListingTree(pages, "case/")
+        assert len(tree) == 0
+        assert tree.folders[""][0] == {"d"}
+
+
+TREE = ["case/a", "case/d/b", "case/d/e/c.h5", "case/d/e/f.txt", "case/g.h5"]
+
+
+class TestWalk:
+    def test_walk_is_top_down(self, data_client, s3, s3_calls):
+        put_keys(s3, [PREFIX + key for key in TREE])
+        s3_calls.clear()
+        walked = [
+            (folder, [f.name for f in folders], [f.name for f in files])
+            for folder, folders, files in data_client.walk("epic://case")
+        ]
+        assert walked == [
+            ("epic://case/", ["d"], ["a", "g.h5"]),
+            ("epic://case/d/", ["e"], ["b"]),
+            ("epic://case/d/e/", [], ["c.h5", "f.txt"]),
+        ]
+        assert s3_calls["ListObjectsV2"] == 1
+
+    def test_walk_files_have_sizes(self, data_client, s3):
+        put_keys(s3, [PREFIX + key for key in TREE])
+        _, folders, files = next(data_client.walk("epic://case/"))
+        assert folders[0].obj_path == "epic://case/d/" and folders[0].folder
+        assert [(f.obj_path, f.size) for f in files] == [
+            ("epic://case/a", 1),
+            ("epic://case/g.h5", 1),
+        ]
+
+    def test_missing_path(self, data_client):
+        with pytest.raises(ValueError):
+            list(data_client.walk("epic://missing/"))
+        with pytest.raises(ValueError):
+            data_client.du("epic://missing/")
+
+
+class TestDu:
+    def test_totals_include_sub_folders(self, data_client, s3, s3_calls):
+        put_keys(s3, [PREFIX + key for key in TREE])
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/d/big", Body=b"x" * 100)
+        s3_calls.clear()
+        usage = data_client.du("epic://case/")
+        assert usage["epic://case/"] == DiskUsage(105, 6, 2)
+        assert usage["epic://case/d/"] == DiskUsage(103, 4, 1)
+        assert usage["epic://case/d/e/"] == DiskUsage(2, 2, 0)
+        assert s3_calls["ListObjectsV2"] == 1
+
+
+class TestGlob:
+    @pytest.mark.parametrize(
+        "pattern, expected",
+        [
+            ("epic://case/*.h5", ["epic://case/g.h5"]),
+            ("epic://case/**/*.h5", ["epic://case/d/e/c.h5", "epic://case/g.h5"]),
+            ("epic://case/d/*/?.txt", ["epic://case/d/e/f.txt"]),
+            ("epic://case/d/b", ["epic://case/d/b"]),
+            ("epic://case/*", ["epic://case/a", "epic://case/g.h5"]),
+        ],
+    )
+    def test_patterns(self, data_client, s3, pattern, expected):
+        put_keys(s3, [PREFIX + key for key in TREE + ["cases/x.h5"]])
+        assert sorted(f.obj_path for f in data_client.glob(pattern)) == expected
+
+    def test_lists_below_the_wildcard_folder_only(self, data_client, s3, s3_calls):
+        put_keys(s3, [PREFIX + key for key in TREE])
+        s3_calls.clear()
+        assert [f.obj_path for f in data_client.glob("epic://case/d/e/*.h5")] == [
+            "epic://case/d/e/c.h5"
+        ]
+        assert s3_calls["ListObjectsV2"] == 1
+
+
+class TestHeadObjects:
+    def test_keeps_order_and_reports_missing(self, s3):
+        keys = ["h/{:03d}".format(i) for i in range(50)]
+        put_keys(s3, keys)
+        results = list(
+            head_objects(s3, BUCKET, keys[:10] + ["h/missing"] + keys[10:], threads=3)
+        )
+        assert [key for key, _ in results] == keys[:10] + ["h/missing"] + keys[10:]
+        assert results[10][1] is None
+        assert all(
+            head["ContentLength"] == 1 for key, head in results if key != "h/missing"
+        )
@@ -0,0 +1,145 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import array
+import io
+import os
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pyepic.client.reader import BufferReader, RemoteFileReader
+
+from .conftest import BUCKET, PREFIX
+
+KB = 1024
+
+
+@pytest.fixture
+def data(s3):
+    data = os.urandom(10 * KB + 5)
+    s3.put_object(Bucket=BUCKET, Key=PREFIX + "f.bin", Body=data)
+    return data
+
+
+class TestRemoteFileReader:
+    def test_random_access(self, data_client, data):
+        with data_client.open("epic://f.bin", block_size=KB) as f:
+            assert f.size == len(data)
+            f.seek(3000)
+            assert f.read(2000) == data[3000:5000]
+            f.seek(-10, io.SEEK_END)
+            assert f.read() == data[-10:]
+            assert f.read(1) == b""
+            f.seek(5)
+            assert f.tell() == 5
+            assert f.readall() == data[5:]
+
+    def test_sequential_reads_fetch_ahead(self, data_client, s3_calls, data):
+        s3_calls.clear()
+        with data_client.open("epic://f.bin", block_size=KB, readahead=4) as f:
+            chunks = iter(lambda: f.read(KB), b"")
+            assert b"".join(chunks) == data
+        # 11 blocks: 1, then 5, then the remaining 5 blocks
+        assert s3_calls["GetObject"] == 3
+
+    def test_cached_blocks_are_not_fetched_again(self, data_client, s3_calls, data):
+        with data_client.open("epic://f.bin", block_size=KB, cache_blocks=2) as f:
+            s3_calls.clear()
+            f.seek(5 * KB)
+            f.read(10)
+            f.seek(5 * KB + 100)
+            f.read(10)
+            assert s3_calls["GetObject"] == 1
+            f.seek(0)
+            f.read(10)
+            f.seek(8 * KB)
+            f.read(10)
+            f.seek(5 * KB)
+            f.read(10)
+            # Block 5 was evicted by the two blocks read after it
+            assert s3_calls["GetObject"] == 4
+
+    def test_buffered_reader(self, data_client, data):
+        raw = data_client.open("epic://f.bin", block_size=KB)
+        with io.BufferedReader(raw, buffer_size=3 * KB) as f:
+            assert f.read(100) == data[:100]
+            assert f.read() == data[100:]
+
+    def test_changed_object_is_not_mixed(self, data_client, s3, data):
+        f = data_client.open("epic://f.bin", block_size=KB, cache_blocks=1)
+        f.read(10)
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "f.bin", Body=os.urandom(len(data)))
+        f.seek(5 * KB)
+        with pytest.raises(ClientError):
+            f.read(10)
+        f.close()
+
+    def test_invalid_paths(self, data_client, s3):
+        with pytest.raises(ValueError):
+            data_client.open("epic://folder/")
+        with pytest.raises(ClientError):
+            data_client.open("epic://missing.bin")
+
+    def test_invalid_block_size(self, s3, data):
+        with pytest.raises(ValueError):
+            RemoteFileReader(s3, BUCKET, PREFIX + "f.bin", block_size=0)
+
+
+class TestBufferReader:
+    def test_read_and_seek(self):
+        reader = BufferReader(bytearray(b"0123456789"))
+        assert reader.read(3) == b"012"
+        assert reader.seek(-2, io.SEEK_END) == 8
+        assert reader.read() == b"89"
+        assert reader.read(5) == b""
+        reader.seek(4)
+        buffer = bytearray(4)
+        assert reader.readinto(buffer) == 4
+        assert buffer == b"4567"
+        with pytest.raises(ValueError):
+            reader.seek(-1)
+
+    def test_typed_buffer_is_read_as_bytes(self):
+        values = array.array("d", [1.0, 2.0])
+        with BufferReader(values) as reader:
+            assert reader.size == 16
+            assert reader.read() == values.tobytes()
+
+    def test_close_releases_the_buffer(self):
+        data = bytearray(b"abc")
+        reader = BufferReader(data)
+        reader.close()
+        # A bytearray can only be resized once nothing holds a view of it
+        data.extend(b"d")
+        with pytest.raises(ValueError):
+            reader.read()
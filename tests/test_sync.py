@@ -0,0 +1,284 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+
+import re
+
+import pytest
+
+from pyepic.client.sync import (
+    LocalFile,
+    RemoteFile,
+    SyncFilter,
+    merge_sorted,
+    plan_copy,
+    plan_download,
+    plan_upload,
+    valid_local_path,
+    walk_local,
+)
+from pyepic.client.sync_state import IndexEntry
+
+from .helpers import make_files
+
+
+def remote(rel_path, size=1, etag='"a"', last_modified=100.0):
+    return RemoteFile("user1/case/" + rel_path, size, etag, last_modified)
+
+
+def local(rel_path, size=1, mtime=100.0):
+    return LocalFile("/case/" + rel_path, size, mtime)
+
+
+class TestMergeSorted:
+    def test_joins_streams_on_path(self):
+        merged = list(
+            merge_sorted([("a", 1), ("c", 3)], [("b", 20), ("c", 30)], {"a": 100})
+        )
+        assert merged == [
+            ("a", [1, None, 100]),
+            ("b", [None, 20, None]),
+            ("c", [3, 30, None]),
+        ]
+
+    def test_empty_streams(self):
+        assert list(merge_sorted([], {})) == []
+
+    def test_unsorted_stream_raises(self):
+        with pytest.raises(ValueError):
+            list(merge_sorted([("b", 1), ("a", 2)], []))
+
+    def test_duplicate_path_raises(self):
+        with pytest.raises(ValueError):
+            list(merge_sorted([("a", 1), ("a", 2)], []))
+
+
+class TestWalkLocal:
+    def test_key_order(self, tmp_path):
+        # S3 lists "a-b" < "a/x" < "a0" as "-" < "/" < "0"
+        make_files(str(tmp_path), {"a0": b"", "a/x": b"", "a-b": b"", "b/c/d": b""})
+        assert [rel_path for rel_path, _ in walk_local(str(tmp_path))] == [
+            "a-b",
+            "a/x",
+            "a0",
+            "b/c/d",
+        ]
+
+    def test_stats_files(self, tmp_path):
+        make_files(str(tmp_path), {"f": b"12345"})
+        ((rel_path, local_file),) = walk_local(str(tmp_path))
+        assert rel_path == "f"
+        assert local_file.path == os.path.join(str(tmp_path), "f")
+        assert local_file.size == 5
+
+    def test_filter_prunes_folders(self, tmp_path):
+        make_files(
+            str(tmp_path),
+            {"keep/a.h5": b"", "keep/a.txt": b"", "skip/b.h5": b"", "c.h5": b""},
+        )
+        sync_filter = SyncFilter(include=["*.h5"], exclude=["skip/"])
+        assert [r for r, _ in walk_local(str(tmp_path), sync_filter)] == [
+            "c.h5",
+            "keep/a.h5",
+        ]
+
+
+class TestPlanUpload:
+    def test_new_changed_and_remote_only(self):
+        planned = list(
+            plan_upload(
+                [("a", local("a")), ("b", local("b", mtime=200.0))],
+                [("b", remote("b")), ("c", remote("c"))],
+                overwrite_existing=True,
+            )
+        )
+        assert [(p[0], p[3]) for p in planned] == [
+            ("a", True),
+            ("b", True),
+            ("c", False),
+        ]
+        assert planned[2][1] is None
+
+    def test_newer_file_needs_overwrite_existing(self):
+        planned = plan_upload(
+            [("b", local("b", mtime=200.0))], [("b", remote("b"))], False
+        )
+        assert [p[3] for p in planned] == [False]
+
+    def test_index_skips_unchanged_files(self):
+        # The remote copy is older but the index shows the file was synced
+        entry = IndexEntry(1, 200.0, '"a"', 200.0)
+        planned = plan_upload(
+            [("b", local("b", mtime=200.0))],
+            [("b", remote("b"))],
+            overwrite_existing=True,
+            index=[("b", entry)],
+        )
+        assert [p[3] for p in planned] == [False]
+
+    def test_checksum_ignores_timestamps(self):
+        planned = plan_upload(
+            [("b", local("b", mtime=50.0))],
+            [("b", remote("b"))],
+            overwrite_existing=True,
+            checksum=True,
+        )
+        assert [p[3] for p in planned] == [True]
+
+
+class TestPlanDownload:
+    def test_new_changed_and_local_only(self):
+        planned = list(
+            plan_download(
+                [("a", remote("a")), ("b", remote("b", last_modified=200.0))],
+                [("b", local("b")), ("c", local("c"))],
+                overwrite_existing=True,
+            )
+        )
+        assert [(p[0], p[3]) for p in planned] == [
+            ("a", True),
+            ("b", True),
+            ("c", False),
+        ]
+        assert planned[2][1] is None
+
+    def test_only_newer_objects_replace_local_files(self):
+        planned = plan_download(
+            [("a", remote("a")), ("b", remote("b", last_modified=100.5))],
+            [("a", local("a")), ("b", local("b"))],
+            overwrite_existing=True,
+        )
+        assert [(p[0], p[3]) for p in planned] == [("a", False), ("b", True)]
+
+    def test_folder_markers_are_not_downloaded(self):
+        planned = plan_download([("d/", remote("d/", size=0))], [])
+        assert [p[3] for p in planned] == [False]
+
+    def test_index_detects_remote_change(self):
+        entry = IndexEntry(1, 100.0, '"old"', 100.0)
+        planned = plan_download(
+            [("b", remote("b", etag='"new"'))],
+            [("b", local("b"))],
+            overwrite_existing=True,
+            index=[("b", entry)],
+        )
+        assert [p[3] for p in planned] == [True]
+
+
+class TestPlanCopy:
+    def test_same_etag_is_not_copied(self):
+        planned = plan_copy(
+            [("a", remote("a")), ("b", remote("b", etag='"b"', last_modified=200.0))],
+            [("a", remote("a")), ("b", remote("b")), ("c", remote("c"))],
+            overwrite_existing=True,
+        )
+        assert [(p[0], p[3]) for p in planned] == [
+            ("a", False),
+            ("b", True),
+            ("c", False),
+        ]
+
+
+class TestValidLocalPath:
+    @pytest.mark.parametrize("rel_path", ["a", "a/b", "a/b/", "a..b", ".hidden"])
+    def test_valid(self, rel_path):
+        assert valid_local_path(rel_path)
+
+    @pytest.mark.parametrize(
+        "rel_path", ["../a", "a/../b", "a/./b", "a//b", "a\x00b", "x" * 256]
+    )
+    def test_invalid(self, rel_path):
+        assert not valid_local_path(rel_path)
+
+
+class TestSyncFilter:
+    def test_prune(self):
+        sync_filter = SyncFilter(include=["results/**/*.h5"], exclude=["tmp/"])
+        assert sync_filter.prune("tmp/")
+        assert sync_filter.prune("mesh/")
+        assert not sync_filter.prune("results/")
+        assert not sync_filter.prune("results/run1/")
+
+    def test_prune_always_include(self):
+        sync_filter = SyncFilter(
+            include=["*.h5"], exclude=[".b/"], always_include=[".b/"]
+        )
+        assert not sync_filter.prune(".b/")
+
+    def test_list_prefixes(self):
+        assert SyncFilter(include=["*.h5"]).list_prefixes() == [""]
+        assert SyncFilter(exclude=["tmp/"]).list_prefixes() == [""]
+        sync_filter = SyncFilter(
+            include=["results/a/*.h5", "results/*.log", "mesh/*"],
+            always_include=[".b/"],
+        )
+        assert sync_filter.list_prefixes() == [".b/", "mesh/", "results/"]
+
+    def test_match_checks_parents(self):
+        sync_filter = SyncFilter(exclude=["tmp/"])
+        assert sync_filter.match("tmp/a")
+        assert not sync_filter.match("tmp/a", check_parents=True)
+        assert not sync_filter.match("x/tmp/a", check_parents=True)
+
+    def test_folder_include_matches_files_below(self):
+        sync_filter = SyncFilter(include=["results/"])
+        assert sync_filter.match("results/a.h5")
+        assert sync_filter.match("results/sub/b.h5")
+        assert sync_filter.match("run1/results/c.h5")
+        assert not sync_filter.match("mesh/a.h5")
+        assert not sync_filter.match("results")
+        assert not sync_filter.prune("results/")
+        assert not sync_filter.prune("mesh/")
+
+    def test_anchored_folder_include(self):
+        sync_filter = SyncFilter(include=["case/results/"])
+        assert sync_filter.match("case/results/sub/a.h5")
+        assert not sync_filter.match("results/a.h5")
+        assert not sync_filter.match("other/case/results/a.h5")
+        assert sync_filter.list_prefixes() == ["case/results/"]
+        assert sync_filter.prune("case/mesh/")
+        assert not sync_filter.prune("case/")
+        assert not sync_filter.prune("case/results/sub/")
+
+    def test_wildcard_folder_include(self):
+        sync_filter = SyncFilter(include=["run*/"], exclude=["*.log"])
+        assert sync_filter.match("run1/a.h5")
+        assert sync_filter.match("x/run2/y/b.h5")
+        assert not sync_filter.match("run1/a.log")
+        assert not sync_filter.match("mesh/a.h5")
+
+    def test_regular_expressions(self):
+        sync_filter = SyncFilter(include=[re.compile(r"\.h5$")], exclude=["tmp/"])
+        assert sync_filter.match("a/b.h5")
+        assert not sync_filter.match("a/b.h5.bak")
+        assert sync_filter.list_prefixes() == [""]
@@ -0,0 +1,418 @@
+# BSD 3 - Clause License
+
+# Copyright(c) 2020, Zenotech
+# All rights reserved.
+
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+
+# 1. Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and / or other materials provided with the distribution.
+
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES
+#         LOSS OF USE, DATA, OR PROFITS
+#         OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import io
+import os
+import threading
+import time
+
+import pytest
+from botocore.awsrequest import AWSResponse
+
+from pyepic.client.sync import LocalFile
+from pyepic.client.sync_state import SyncIndex
+from pyepic.client.transfer import (
+    GB,
+    MB,
+    AdaptiveConcurrency,
+    AutoTransferProfile,
+    BandwidthLimiter,
+    TransferProfile,
+    WorkerPool,
+    ranged_download,
+    resumable_upload,
+)
+
+from .conftest import BUCKET, PREFIX
+
+from .helpers import make_files
+
+
+class TestWorkerPool:
+    def test_uses_every_thread(self):
+        threads = set()
+        barrier = threading.Barrier(3, timeout=10)
+
+        def work(item):
+            threads.add(threading.current_thread().name)
+            if item < 3:
+                barrier.wait()
+
+        with WorkerPool(work, threads=3) as pool:
+            for i in range(30):
+                assert pool.submit(i)
+        assert len(threads) == 3
+
+    def test_worker_error_is_raised(self):
+        def work(item):
+            if item == 5:
+                raise RuntimeError("failed")
+
+        with pytest.raises(RuntimeError):
+            with WorkerPool(work, threads=2) as pool:
+                for i in range(100):
+                    pool.submit(i)
+
+    def test_cancel_stops_submit(self):
+        cancel = threading.Event()
+        done = []
+
+        def work(item):
+            done.append(item)
+            time.sleep(0.01)
+
+        with WorkerPool(work, threads=1, cancel_event=cancel) as pool:
+            assert pool.submit(0)
+            cancel.set()
+            assert not pool.submit(1)
+        assert 1 not in done
+
+
+class TestSyncThreads:
+    def test_thread_count_is_honoured(self, data_client, tmp_path):
+        root = str(tmp_path / "case")
+        make_files(root, {"f{:02d}".format(i): b"x" for i in range(40)})
+        threads = set()
+
+        def callback(source, target, copied, dryrun):
+            threads.add(threading.current_thread().name)
+
+        data_client.sync(root, "epic://case/", threads=2, callback=callback)
+        assert 1 <= len(threads) <= 2
+
+
+class TestTransferProfile:
+    def test_defaults_match_boto3(self):
+        config = TransferProfile().transfer_config()
+        assert config.multipart_threshold == 8 * MB
+        assert config.multipart_chunksize == 8 * MB
+        assert config.max_concurrency == 10
+
+    def test_chunksize_respects_part_limits(self):
+        profile = TransferProfile(multipart_chunksize=1 * MB)
+        assert profile.chunksize() == 5 * MB
+        assert profile.chunksize(100 * GB) == -(-100 * GB // 10000)
+
+    def test_pool_connections(self):
+        assert TransferProfile(max_concurrency=4).pool_connections(3) == 14
+        assert TransferProfile(max_pool_connections=7).pool_connections(3) == 7
+
+    def test_auto_profile_shares_concurrency(self):
+        profile = AutoTransferProfile(total_concurrency=64)
+        assert profile.concurrency(1) == 16
+        assert profile.concurrency(8) == 8
+        assert profile.concurrency(100) == 1
+        assert profile.chunksize(10 * GB) == 11 * MB
+
+
+class TestPoolClient:
+    def test_default_client_is_not_replaced(self, data_client, tmp_path):
+        client = data_client._s3_client
+        root = str(tmp_path / "case")
+        make_files(root, {"a": b"x"})
+        data_client.write_bytes(b"x", "epic://p/a")
+        data_client.download_file("epic://p/a", io.BytesIO())
+        data_client.sync(root, "epic://case/", threads=16)
+        assert data_client._s3_client is client
+
+    def test_large_pools_are_kept(self, data_client):
+        large = data_client._pool_client(data_client._max_pool_connections + 1)
+        assert large is not data_client._s3_client
+        assert data_client._pool_client(data_client._max_pool_connections + 2) is large
+        assert large.meta.config.max_pool_connections % 32 == 0
+
+
+class _FailingBody(object):
+    """Body that fills part of the buffer, keeps a reference to it and then fails"""
+
+    def __init__(self, body):
+        self._body = body
+        self.kept = []
+
+    def readinto(self, b):
+        self.kept.append(b)
+        if len(self.kept) > 1:
+            raise IOError("Connection reset")
+        return self._body.readinto(b[: len(b) // 2])
+
+
+class TestRangedDownload:
+    def test_ranges_are_written_in_place(self, s3, tmp_path):
+        data = os.urandom(3 * MB + 7)
+        etag = s3.put_object(Bucket=BUCKET, Key="big", Body=data)["ETag"]
+        path = str(tmp_path / "big")
+        ranged_download(s3, BUCKET, "big", path, len(data), etag, 1 * MB, 3)
+        with open(path, "rb") as f:
+            assert f.read() == data
+        assert os.listdir(str(tmp_path)) == ["big"]
+
+    def test_failed_range_raises_its_own_error(self, s3, tmp_path):
+        data = os.urandom(2 * MB)
+        etag = s3.put_object(Bucket=BUCKET, Key="big", Body=data)["ETag"]
+        bodies = []
+
+        def fail_body(parsed, **kwargs):
+            parsed["Body"] = _FailingBody(parsed["Body"])
+            bodies.append(parsed["Body"])
+
+        s3.meta.events.register("after-call.s3.GetObject", fail_body)
+        path = str(tmp_path / "big")
+        with pytest.raises(IOError, match="Connection reset"):
+            ranged_download(s3, BUCKET, "big", path, len(data), etag, 1 * MB, 2)
+        assert bodies
+        assert os.listdir(str(tmp_path)) == []
+
+
+class TestResume:
+    def test_cancelled_upload_resumes(self, data_client, s3, s3_calls, tmp_path):
+        root = str(tmp_path / "case")
+        data = os.urandom(23 * MB)
+        make_files(root, {"big.bin": data})
+        profile = TransferProfile(
+            multipart_threshold=5 * MB, multipart_chunksize=5 * MB, max_concurrency=1
+        )
+        cancel = threading.Event()
+
+        def cancel_after_two_parts(**kwargs):
+            if s3_calls["UploadPart"] >= 2:
+                cancel.set()
+
+        for events in (
+            data_client._s3_session.events,
+            data_client._s3_client.meta.events,
+        ):
+            events.register("after-call.s3.UploadPart", cancel_after_two_parts)
+        data_client.sync(
+            root,
+            "epic://case/",
+            resume=True,
+            cancel_event=cancel,
+            transfer_profile=profile,
+            threads=1,
+        )
+        index = SyncIndex(root, PREFIX + "case/")
+        state = index.multipart_upload("big.bin")
+        index.close()
+        assert state is not None and len(state.parts) >= 2
+        sent = s3_calls["UploadPart"]
+        for events in (
+            data_client._s3_session.events,
+            data_client._s3_client.meta.events,
+        ):
+            events.unregister("after-call.s3.UploadPart", cancel_after_two_parts)
+
+        data_client.sync(root, "epic://case/", resume=True, transfer_profile=profile)
+        assert s3_calls["UploadPart"] - sent == 5 - len(state.parts)
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "case/big.bin")["Body"]
+        assert body.read() == data
+
+    def test_aborted_upload_starts_again(self, data_client, s3, tmp_path):
+        root = str(tmp_path / "case")
+        data = os.urandom(11 * MB)
+        make_files(root, {"big.bin": data})
+        local_file = LocalFile(
+            os.path.join(root, "big.bin"),
+            len(data),
+            os.path.getmtime(os.path.join(root, "big.bin")),
+        )
+        index = SyncIndex(root, PREFIX + "case/")
+        upload_id = s3.create_multipart_upload(
+            Bucket=BUCKET, Key=PREFIX + "case/big.bin"
+        )["UploadId"]
+        index.start_multipart_upload(
+            "big.bin",
+            PREFIX + "case/big.bin",
+            upload_id,
+            local_file.size,
+            local_file.mtime,
+            5 * MB,
+        )
+        s3.abort_multipart_upload(
+            Bucket=BUCKET, Key=PREFIX + "case/big.bin", UploadId=upload_id
+        )
+        etag = resumable_upload(
+            s3, BUCKET, PREFIX + "case/big.bin", "big.bin", local_file, 5 * MB, 2, index
+        )
+        assert index.multipart_upload("big.bin") is None
+        index.close()
+        head = s3.head_object(Bucket=BUCKET, Key=PREFIX + "case/big.bin")
+        assert head["ETag"] == etag and etag.endswith('-3"')
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "case/big.bin")["Body"]
+        assert body.read() == data
+
+
+class TestDelta:
+    @pytest.fixture
+    def profile(self):
+        return TransferProfile(
+            multipart_threshold=5 * MB, multipart_chunksize=5 * MB, max_concurrency=2
+        )
+
+    def change(self, root, data):
+        data[6 * MB] ^= 0xFF
+        make_files(root, {"restart.h5": data})
+        path = os.path.join(root, "restart.h5")
+        os.utime(path, (os.path.getmtime(path) + 60,) * 2)
+
+    def test_only_changed_parts_are_sent(
+        self, data_client, s3, s3_calls, tmp_path, profile
+    ):
+        root = str(tmp_path / "case")
+        data = bytearray(os.urandom(20 * MB + 5))
+        make_files(root, {"restart.h5": data})
+        data_client.sync(root, "epic://case/", delta=True, transfer_profile=profile)
+        self.change(root, data)
+        s3_calls.clear()
+        data_client.sync(
+            root,
+            "epic://case/",
+            delta=True,
+            overwrite_existing=True,
+            transfer_profile=profile,
+        )
+        assert s3_calls["UploadPart"] == 1
+        assert s3_calls["UploadPartCopy"] == 4
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "case/restart.h5")["Body"]
+        assert body.read() == bytes(data)
+
+    def test_replaced_object_is_uploaded_in_full(
+        self, data_client, s3, s3_calls, tmp_path, profile
+    ):
+        root = str(tmp_path / "case")
+        data = bytearray(os.urandom(20 * MB + 5))
+        make_files(root, {"restart.h5": data})
+        data_client.sync(root, "epic://case/", delta=True, transfer_profile=profile)
+        # The object no longer matches the part checksums in the index
+        s3.put_object(Bucket=BUCKET, Key=PREFIX + "case/restart.h5", Body=b"other")
+        self.change(root, data)
+        s3_calls.clear()
+        data_client.sync(
+            root,
+            "epic://case/",
+            delta=True,
+            overwrite_existing=True,
+            transfer_profile=profile,
+        )
+        assert s3_calls["UploadPart"] == 5
+        body = s3.get_object(Bucket=BUCKET, Key=PREFIX + "case/restart.h5")["Body"]
+        assert body.read() == bytes(data)
+
+
+class _Raw(object):
+    def __init__(self, body):
+        self._body = body
+
+    def stream(self):
+        yield self._body
+
+
+class TestBandwidthLimiter:
+    def test_sleeps_once_the_burst_is_used(self):
+        limiter = BandwidthLimiter(1 * MB, burst=0.1 * MB)
+        start = time.monotonic()
+        limiter.consume(0.1 * MB)
+        assert time.monotonic() - start < 0.05
+        limiter.consume(0.2 * MB)
+        assert time.monotonic() - start >= 0.18
+
+    def test_invalid_rate(self):
+        with pytest.raises(ValueError):
+            BandwidthLimiter(0)
+
+    def test_caps_sync(self, data_client, tmp_path):
+        root = str(tmp_path / "case")
+        make_files(root, {"a": os.urandom(3 * MB)})
+        data_client.set_max_bandwidth(2 * MB)
+        start = time.monotonic()
+        data_client.sync(root, "epic://case/")
+        # The first second's worth is a burst, the last MB is sent at the capped rate
+        assert time.monotonic() - start >= 0.45
+        data_client.set_max_bandwidth(None)
+        assert data_client._progress_callback() is None
+
+
+class TestAdaptiveConcurrency:
+    def test_limit_caps_slots(self):
+        concurrency = AdaptiveConcurrency(max_workers=8, initial=2, interval=60)
+        concurrency.acquire()
+        concurrency.acquire()
+        acquired = threading.Event()
+
+        def third():
+            concurrency.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=third)
+        thread.start()
+        assert not acquired.wait(0.1)
+        concurrency.release()
+        assert acquired.wait(5)
+        thread.join()
+
+    def test_grows_while_throughput_improves(self):
+        concurrency = AdaptiveConcurrency(max_workers=8, initial=2, interval=0)
+        for amount in (1, 10, 100):
+            concurrency.acquire()
+            concurrency.record(amount)
+            concurrency.release()
+        assert concurrency.limit == 5
+        concurrency.acquire()
+        concurrency.release()
+        assert concurrency.limit == 4
+
+    def test_invalid_workers(self):
+        with pytest.raises(ValueError):
+            AdaptiveConcurrency(min_workers=4, max_workers=2)
+
+    def test_backs_off_when_throttled(self, data_client, tmp_path):
+        root = str(tmp_path / "case")
+        make_files(root, {"f{}".format(i): b"x" for i in range(10)})
+        concurrency = AdaptiveConcurrency(max_workers=8, initial=8, interval=60)
+        throttled = []
+
+        def slow_down(request, **kwargs):
+            if not throttled:
+                throttled.append(request.url)
+                body = b"<Error><Code>SlowDown</Code><Message>Slow</Message></Error>"
+                return AWSResponse(request.url, 503, {}, _Raw(body))
+            return None
+
+        for events in (
+            data_client._s3_session.events,
+            data_client._s3_client.meta.events,
+        ):
+            events.register("before-send.s3.PutObject", slow_down)
+        stats = data_client.sync(root, "epic://case/", concurrency=concurrency)
+        assert stats.submitted == 10
+        assert throttled
+        assert concurrency.throttled == 1
+        assert concurrency.limit == 4